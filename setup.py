@@ -28,6 +28,12 @@ setup(
                 'parse_typing_results = hla_typing_benchmark.parse_typing_results:main',
                 'create_gold_standard = hla_typing_benchmark.create_gold_standard:main',
                 'summarise_results = hla_typing_benchmark.summarise_results:main',
+                'imgt_release_store = hla_typing_benchmark.imgt_release_store:main',
+                'synthetic_cohort = hla_typing_benchmark.synthetic_cohort:main',
+                'performance_benchmark = hla_typing_benchmark.performance_benchmark:main',
+                'hla-bench = hla_typing_benchmark.cli:main',
+                'create_config = hla_typing_benchmark.create_config:main',
+                'plan_run = hla_typing_benchmark.plan_run:main',
             ]
         },
 )
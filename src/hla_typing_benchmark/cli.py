@@ -0,0 +1,252 @@
+"""
+hla-bench: the evaluation steps of the benchmark as subcommands of one command.
+
+    hla-bench run ...             build the gold standard, parse and score the typing results and summarise them in one process
+    hla-bench gold-standard ...   same as create_gold_standard
+    hla-bench parse ...           same as parse_typing_results
+    hla-bench summarise ...       same as summarise_results
+
+run passes the nomenclature tables, the gold standard, the typing results and the per-sample scores for the
+bootstrap from stage to stage in memory. The outputs of all stages are still written, but never read back. The
+modules of a stage (e.g. matplotlib and seaborn for the summary) are only imported when the stage runs.
+"""
+
+import argparse
+import importlib
+import sys
+
+from hla_typing_benchmark.parse_data import (DELETED_ALLELES_PATH, E_GROUP_PATH, G_GROUP_PATH, NOMENCLATURE_CACHE_DIR, P_GROUP_PATH,
+                                             all_resolutions, configure_nomenclature, get_nomenclature, set_nomenclature)
+from hla_typing_benchmark.profiling import get_profiler, start_profiling
+
+
+#Subcommands, which run the main of a module with the remaining arguments
+MODULE_COMMANDS = {'gold-standard': ('hla_typing_benchmark.create_gold_standard', 'Same as create_gold_standard'),
+                   'parse': ('hla_typing_benchmark.parse_typing_results', 'Same as parse_typing_results'),
+                   'summarise': ('hla_typing_benchmark.summarise_results', 'Same as summarise_results')}
+
+
+def build_gold_standard(args):
+    from hla_typing_benchmark.create_gold_standard import load_gs_data
+
+    with get_profiler().stage('create gold standard'):
+        return load_gs_data(gs_data_path=args.input, outfile_path=args.gs_data, resolutions=args.resolutions, config_path=args.config)
+
+
+def score_typing_results(args, gold_standard):
+    from hla_typing_benchmark.parse_typing_results import load_all_results, write_results
+
+    #The per-sample scores are only kept for the bootstrap, which needs --details
+    keep_sample_scores = args.details is not None
+
+    results = load_all_results(gs_data=gold_standard,
+                               kourami_path=args.kourami,
+                               hla_la_path=args.hla_la,
+                               optitype_path=args.optitype,
+                               hisat_genotype_path=args.hisat_genotype,
+                               resolutions=args.resolutions,
+                               jobs=args.jobs,
+                               config=args.config,
+                               walk_result_folders=args.walk_result_folders,
+                               cache_dir=args.evaluation_cache,
+                               details_path=args.details,
+                               candidates=args.candidates,
+                               sample_scores=keep_sample_scores)
+    results_dict, sample_scores = results if keep_sample_scores else (results, None)
+
+    write_results(results_dict, args.typing_results)
+
+    return results_dict, sample_scores
+
+
+def summarise_typing_results(args, results_dict, sample_scores):
+    from hla_typing_benchmark.summarise_results import summarise
+
+    #The bootstrap uses the per-sample scores of the scoring stage instead of reading the details back
+    summarise(results_dict,
+              args.results_table,
+              args.class_plot,
+              args.loci_plot,
+              sample_scores=sample_scores,
+              bootstrap_replicates=args.bootstrap_replicates,
+              confidence=args.confidence,
+              seed=args.seed)
+
+
+def run(args):
+    if args.profile is not None:
+        start_profiling(cprofile=args.cprofile is not None)
+
+    #Loaded once and shared by all stages
+    if args.imgt_store is not None:
+        from hla_typing_benchmark.imgt_release_store import ImgtReleaseStore
+
+        set_nomenclature(ImgtReleaseStore(args.imgt_store).nomenclature(args.imgt_release,
+                                                                        e_group_filepath=args.pseudosequences,
+                                                                        cache_dir=args.nomenclature_cache))
+    else:
+        configure_nomenclature(deleted_filepath=args.deleted_alleles,
+                               p_group_filepath=args.p_group,
+                               e_group_filepath=args.pseudosequences,
+                               g_group_filepath=args.g_group,
+                               cache_dir=args.nomenclature_cache)
+
+    gold_standard = build_gold_standard(args)
+    results_dict, sample_scores = score_typing_results(args, gold_standard)
+    summarise_typing_results(args, results_dict, sample_scores)
+
+    if args.profile is not None:
+        get_profiler().write(args.profile, 'hla-bench run', get_nomenclature(), args.cprofile)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+
+    #The module parses its own arguments, so its help and defaults stay in one place
+    if len(argv) > 0 and argv[0] in MODULE_COMMANDS:
+        module = importlib.import_module(MODULE_COMMANDS[argv[0]][0])
+        sys.argv = [f'hla-bench {argv[0]}'] + argv[1:]
+        return module.main()
+
+    parser = get_argparser()
+    args = parser.parse_args(argv)
+
+    if args.command is None:
+        parser.error('a command is required')
+
+    run(args)
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(prog='hla-bench', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', metavar='{run,gold-standard,parse,summarise}')
+
+    run_parser = subparsers.add_parser('run',
+                                       help='Build the gold standard, parse and score the typing results and summarise them in one process',
+                                       formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    for command, (module, help_text) in MODULE_COMMANDS.items():
+        subparsers.add_parser(command, help=help_text, add_help=False)
+
+    #Gold standard
+    run_parser.add_argument('--input',
+                            help='Path to 1000G_hla_diversity_2014.txt',
+                            default='results/00_1000G_reference/1000G_hla_diversity_2014.txt')
+
+    run_parser.add_argument('--gs-data',
+                            help='Path to write the formatted gold standard to (see create_gold_standard --output)',
+                            default='results/01_1000G_reference/1000G_2014_cleaned.gs')
+
+    #Typing results
+    run_parser.add_argument('--kourami',
+                            help='Folder with HLA typing results from Kourami')
+
+    run_parser.add_argument('--optitype',
+                            help='Folder with HLA typing results from Optitype')
+
+    run_parser.add_argument('--hla-la',
+                            help='Folder with HLA typing results from HLA*LA')
+
+    run_parser.add_argument('--hisat-genotype',
+                            help='Folder with HLA typing results from HISAT-genotype')
+
+    run_parser.add_argument('--config',
+                            help='Snakemake config.yaml with the samples to include in the gold standard and to evaluate',
+                            default='snakemake/config.yaml')
+
+    run_parser.add_argument('--walk-result-folders',
+                            help='Search the whole result folders for output files instead of looking up the output of each sample in the config',
+                            action='store_true')
+
+    run_parser.add_argument('--resolutions',
+                            help='Resolutions to store the reference alleles at and score the typing results at',
+                            nargs='+',
+                            choices=all_resolutions(),
+                            default=all_resolutions())
+
+    run_parser.add_argument('--candidates',
+                            help='Number of candidate alleles per prediction to score (see parse_typing_results --candidates)',
+                            type=int,
+                            default=1)
+
+    run_parser.add_argument('--evaluation-cache',
+                            help='Folder to cache the predictions and scores of each sample in (see parse_typing_results --evaluation-cache)')
+
+    run_parser.add_argument('--jobs',
+                            help='Number of processes used to parse the result files (0 uses all CPUs)',
+                            type=int,
+                            default=1)
+
+    run_parser.add_argument('--typing-results',
+                            help='Path to write the collected typing results (.json) to',
+                            default='results/05_collected_typing_results/typing_results.json')
+
+    run_parser.add_argument('--details',
+                            help='Path to write the per-sample results to as JSON lines (.jsonl or .jsonl.gz). If given, bootstrap confidence intervals are added to the table and plots')
+
+    #Nomenclature
+    run_parser.add_argument('--deleted-alleles',
+                            help='IMGT/HLA Deleted_alleles.txt used to rename deleted alleles',
+                            default=DELETED_ALLELES_PATH)
+
+    run_parser.add_argument('--p-group',
+                            help='IMGT/HLA hla_nom_p.txt used for P group conversion',
+                            default=P_GROUP_PATH)
+
+    run_parser.add_argument('--pseudosequences',
+                            help='Table with MHC pseudosequences used for pseudosequence conversion',
+                            default=E_GROUP_PATH)
+
+    run_parser.add_argument('--g-group',
+                            help='IMGT/HLA hla_nom_g.txt used for G group conversion',
+                            default=G_GROUP_PATH)
+
+    run_parser.add_argument('--nomenclature-cache',
+                            help='Folder for the cached nomenclature tables. They are rebuilt when the source files change',
+                            default=NOMENCLATURE_CACHE_DIR)
+
+    run_parser.add_argument('--imgt-store',
+                            help='IMGT release store (see imgt_release_store). If given, --deleted-alleles, --p-group and --g-group are ignored')
+
+    run_parser.add_argument('--imgt-release',
+                            help="Release in the IMGT release store to use ('latest' is the newest release)",
+                            default='latest')
+
+    #Summary
+    run_parser.add_argument('--bootstrap-replicates',
+                            help='Number of bootstrap replicates for the confidence intervals',
+                            type=int,
+                            default=10000)
+
+    run_parser.add_argument('--confidence',
+                            help='Confidence level of the bootstrap confidence intervals',
+                            type=float,
+                            default=0.95)
+
+    run_parser.add_argument('--seed',
+                            help='Seed for the bootstrap resampling, for reproducible confidence intervals',
+                            type=int)
+
+    run_parser.add_argument('--results-table',
+                            help='Path to write a table with a summary of results',
+                            default='results/01_1000G_reference/1000G_2014_cleaned.tsv')
+
+    run_parser.add_argument('--class-plot',
+                            help='Path to write the plot with an overview of HLA class I and class II performance',
+                            default='results/05_collected_typing_results/HLA_class_performance.jpg')
+
+    run_parser.add_argument('--loci-plot',
+                            help='Path to write the plot with an overview of the performance per locus',
+                            default='results/05_collected_typing_results/HLA_loci_performance.jpg')
+
+    run_parser.add_argument('--profile',
+                            help='Path to write a profile of the run as json: wall time per stage of all steps, files parsed, alleles converted and peak memory')
+
+    run_parser.add_argument('--cprofile',
+                            help='Path to write cProfile statistics of the run to (used together with --profile)')
+
+    return parser
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+Columnar concordance engine used by validate_typing.
+
+The typing results and the gold standard are brought into long format, one row per call or reference candidate:
+
+    calls:          tool, subject, locus, haplotype, allele
+    gold standard:  subject, locus, haplotype, allele  (see GoldStandardTable.to_long)
+
+A call can hold several candidate alleles (ambiguous or lower ranked alleles, see tool_parsers), just as every
+reference haplotype can. At a resolution, every unique allele is converted once (the reference alleles can come
+converted already, see GoldStandardTable.add_labels) and interned per locus, so the candidates of each haplotype
+become a bitset over the labels of its locus. Predicted and reference haplotypes match, if their bitsets share a bit:
+all four pairings of all cells are a bitwise AND over the whole cohort. As in validate_call, the better pairing counts.
+"""
+
+import numpy as np
+import pandas as pd
+
+from hla_typing_benchmark.parse_data import get_nomenclature
+
+
+CALL_COLUMNS = ['tool', 'subject', 'locus', 'haplotype', 'allele']
+COUNT_COLUMNS = ['tool', 'subject', 'locus', 'count']
+
+#None can't be factorized next to strings - alleles, which don't convert, all share the label of this string
+NO_LABEL = ''
+
+
+def calls_to_long(typing_results_dict, subject_id_list, loci, candidates=1):
+    """
+    Bring the typing results of all tools into long format for the given subjects and loci.
+    Returns the calls of the first two predictions per locus (the ones validate_call scores) and the number of calls per locus.
+    Each prediction gives a row for each of its first candidates (0 for all of them).
+    """
+    subjects = set(subject_id_list)
+    loci = set(loci)
+
+    calls = []
+    counts = []
+
+    for tool, tool_results in typing_results_dict.items():
+        for subject, subject_predictions in tool_results.items():
+            if subject not in subjects:
+                continue
+
+            for locus, predictions in subject_predictions.items():
+                if locus not in loci:
+                    continue
+
+                counts.append((tool, subject, locus, len(predictions)))
+
+                for haplotype, prediction in enumerate(predictions[:2]):
+                    for allele in prediction[:candidates or None]:
+                        calls.append((tool, subject, locus, haplotype, allele))
+
+    return pd.DataFrame(calls, columns=CALL_COLUMNS), pd.DataFrame(counts, columns=COUNT_COLUMNS)
+
+
+def convert_alleles(alleles, resolution, nomenclature=None):
+    """
+    Every allele converted to the given resolution, converting each unique allele once. Alleles without a label get NO_LABEL.
+    """
+    if nomenclature is None:
+        nomenclature = get_nomenclature()
+
+    #Missing alleles (None) are kept as a value of their own, they convert to None
+    allele_codes, unique_alleles = pd.factorize(pd.Series(alleles, dtype=object), use_na_sentinel=False)
+
+    converted_alleles = np.array([NO_LABEL if allele is None else allele
+                                  for allele in (nomenclature.converter.convert(allele if isinstance(allele, str) else None, resolution) for allele in unique_alleles)], dtype=object)
+
+    return converted_alleles[allele_codes]
+
+
+def reference_labels(gold_standard, resolution, nomenclature=None):
+    #Use the reference alleles converted by create_gold_standard, if they are there
+    if resolution in gold_standard.columns:
+        return gold_standard[resolution].astype(object).fillna(NO_LABEL).to_numpy()
+
+    return convert_alleles(gold_standard['allele'], resolution, nomenclature)
+
+
+def cell_keys(frame, subject_codes, locus_codes, n_loci, tool_codes=None):
+    #One integer per (tool, subject, locus) cell, so the cells can be matched without comparing strings
+    keys = subject_codes.get_indexer(frame['subject']).astype(np.int64) * n_loci + locus_codes.get_indexer(frame['locus'])
+
+    if tool_codes is not None:
+        keys += tool_codes.get_indexer(frame['tool']).astype(np.int64) * len(subject_codes) * n_loci
+
+    return keys
+
+
+def locus_bits(locus_codes, labels):
+    """
+    Intern the labels per locus: the bit of each label in the bitsets of its locus, and the number of 64 bit words per bitset.
+    """
+    locus_labels = locus_codes.astype(np.int64) * (int(labels.max()) + 1) + labels
+    unique_locus_labels, label_index = np.unique(locus_labels, return_inverse=True)
+
+    #The labels of a locus are numbered from 0, starting at the first label of the locus
+    unique_loci = unique_locus_labels // (int(labels.max()) + 1)
+    bits = np.arange(len(unique_locus_labels)) - np.searchsorted(unique_loci, unique_loci)
+
+    return bits[label_index.ravel()], int(bits.max()) // 64 + 1
+
+
+def haplotype_bitsets(n_cells, cell_index, haplotypes, bits, n_words):
+    #One bitset per cell and haplotype, with the bits of all candidates set
+    bitsets = np.zeros((n_cells, 2, n_words), dtype=np.uint64)
+    np.bitwise_or.at(bitsets, (cell_index, haplotypes, bits // 64), np.left_shift(np.uint64(1), (bits % 64).astype(np.uint64)))
+
+    return bitsets
+
+
+def score_calls(calls, counts, gold_standard, resolution, nomenclature=None):
+    """
+    Score all calls at a resolution.
+    Returns counts with an added score column: the number of correctly called haplotypes (0-2) of each cell.
+    """
+    scores = np.zeros(len(counts), dtype=np.int64)
+
+    if len(calls) == 0 or len(gold_standard) == 0:
+        return counts.assign(score=scores)
+
+    subject_codes = pd.Index(pd.unique(pd.concat([counts['subject'], gold_standard['subject']])))
+    locus_codes = pd.Index(pd.unique(pd.concat([counts['locus'], gold_standard['locus']])))
+    tool_codes = pd.Index(pd.unique(counts['tool']))
+    n_loci = len(locus_codes)
+
+    #Integer labels shared by calls and reference, equal labels mean equal alleles at this resolution
+    labels, _ = pd.factorize(np.concatenate([convert_alleles(calls['allele'], resolution, nomenclature),
+                                              reference_labels(gold_standard, resolution, nomenclature)]))
+
+    bits, n_words = locus_bits(np.concatenate([locus_codes.get_indexer(calls['locus']), locus_codes.get_indexer(gold_standard['locus'])]), labels)
+
+    #Bitsets of the predictions per (tool, subject, locus) cell and of the reference per (subject, locus)
+    reference_cells = pd.Index(pd.unique(cell_keys(gold_standard, subject_codes, locus_codes, n_loci)))
+    reference_bitsets = haplotype_bitsets(len(reference_cells) + 1,
+                                          reference_cells.get_indexer(cell_keys(gold_standard, subject_codes, locus_codes, n_loci)),
+                                          gold_standard['haplotype'].to_numpy(), bits[len(calls):], n_words)
+
+    prediction_bitsets = haplotype_bitsets(len(counts),
+                                           pd.Index(cell_keys(counts, subject_codes, locus_codes, n_loci, tool_codes)).get_indexer(cell_keys(calls, subject_codes, locus_codes, n_loci, tool_codes)),
+                                           calls['haplotype'].to_numpy(), bits[:len(calls)], n_words)
+
+    #Cells without reference get the empty bitset in the last row
+    reference_bitsets = reference_bitsets[reference_cells.get_indexer(cell_keys(counts, subject_codes, locus_codes, n_loci))]
+
+    #matches[:, i, j] is set, if predicted haplotype i and reference haplotype j share a candidate
+    matches = (prediction_bitsets[:, :, None, :] & reference_bitsets[:, None, :, :]).any(axis=3)
+
+    #Pairing 1: call 1 - reference 1 and call 2 - reference 2. Pairing 2: call 1 - reference 2 and call 2 - reference 1
+    pairing_1 = matches[:, 0, 0].astype(np.int64) + matches[:, 1, 1]
+    pairing_2 = matches[:, 0, 1].astype(np.int64) + matches[:, 1, 0]
+    scores = np.maximum(pairing_1, pairing_2)
+
+    return counts.assign(score=scores)
+
+
+def add_summary_scores(tool_results_dict, n_subjects):
+    #Add entries for all class I, class II and all alleles
+    tool_results_dict['HLA-I'] = {}
+    tool_results_dict['HLA-II'] = {}
+    tool_results_dict['Total'] = {}
+
+    tool_results_dict['HLA-I']['count'] = sum([tool_results_dict[locus]['count'] for locus in ['A', 'B', 'C']])
+    tool_results_dict['HLA-II']['count'] = sum([tool_results_dict[locus]['count'] for locus in ['DRB1', 'DQB1']])
+    tool_results_dict['Total']['count'] = sum([tool_results_dict[locus]['count'] for locus in ['HLA-I', 'HLA-II']])
+
+    tool_results_dict['HLA-I']['score'] = sum([tool_results_dict[locus]['score'] for locus in ['A', 'B', 'C']])
+    tool_results_dict['HLA-II']['score'] = sum([tool_results_dict[locus]['score'] for locus in ['DRB1', 'DQB1']])
+    tool_results_dict['Total']['score'] = sum([tool_results_dict[locus]['score'] for locus in ['HLA-I', 'HLA-II']])
+
+
+    #Find total counts and calculate call rate and typing accuracy
+    for locus in tool_results_dict:
+        if locus in ['A', 'B', 'C', 'DRB1', 'DQB1']:
+            multiplier = 1
+        elif locus == 'HLA-I':
+            multiplier = 3
+        elif locus == 'HLA-II':
+            multiplier = 2
+        elif locus == 'Total':
+            multiplier = 5
+
+        #No subjects are scored in a shard without gold standard samples
+        total_correct_calls = max(multiplier * n_subjects * 2, 1)
+        tool_results_dict[locus]['call_rate'] = tool_results_dict[locus]['count'] * 100  / total_correct_calls
+        tool_results_dict[locus]['typing_accuracy'] = tool_results_dict[locus]['score'] * 100 / total_correct_calls
+
+    return tool_results_dict
+
+
+def summarise_scores(cell_scores, tools, loci, n_subjects):
+    """
+    Sum the cell scores per tool and locus and add the summary scores, as {tool: {locus: {count, score, call_rate, typing_accuracy}}}.
+    """
+    totals = cell_scores.groupby(['tool', 'locus'])[['count', 'score']].sum()
+    totals = dict(zip(totals.index, totals.itertuples(index=False)))
+
+    results_dict = {}
+
+    for tool in tools:
+        results_dict[tool] = {}
+
+        for locus in loci:
+            count, score = totals.get((tool, locus), (0, 0))
+            #Plain ints, so the results can be written as json
+            results_dict[tool][locus] = {'count': int(count), 'score': int(score)}
+
+        add_summary_scores(results_dict[tool], n_subjects)
+
+    return results_dict
@@ -1,38 +1,307 @@
-import http.client
+"""
+Create the Snakemake config.yaml with the exome alignments of the gold standard samples.
+
+The exome CRAM of every sample in the 1000G gold standard is probed with a HEAD request, and the samples with an
+exome alignment are written to the config. The requests run concurrently on keep-alive connections, which are
+pooled per host. Failed requests (connection errors, timeouts, 429 and 5xx responses) are retried with exponential backoff.
+
+The CRAM index (<cram>.crai) of every sample is probed as well. The sizes of both (Content-Length) are written to a
+manifest next to the config, which plan_run uses to estimate the storage and runtime of the pipeline:
+
+    sample_id  population  url  cram_bytes  crai_bytes
+
+ftp:// URLs are probed over HTTP on the same host and path (the 1000 Genomes FTP site serves both), but written to
+the config as they are. For a test run, --url-template can point to a local HTTP server.
+"""
+
+import argparse
+import asyncio
+import os
+import ssl
+from collections import namedtuple
 from urllib.parse import urlparse
 
+import pandas as pd
+
+
+URL_TEMPLATE = 'ftp://ftp.1000genomes.ebi.ac.uk/vol1/ftp/data_collections/1000_genomes_project/data/{population}/{sample_id}/exome_alignment/{sample_id}.alt_bwamem_GRCh38DH.20150826.{population}.exome.cram'
+REFERENCE_GENOME_URL = 'ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/reference/GRCh38_reference_genome/GRCh38_full_analysis_set_plus_decoy_hla.fa'
+
+MANIFEST_FILENAME = 'manifest.tsv'
+MANIFEST_COLUMNS = ['sample_id', 'population', 'url', 'cram_bytes', 'crai_bytes']
+
+#Responses worth asking again for
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+#Errors of a single request, which are recorded in its ProbeResult. A malformed response raises ValueError
+#(e.g. a non-integer status or an over-long header line) or IncompleteReadError/LimitOverrunError
+PROBE_ERRORS = (OSError, asyncio.TimeoutError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError)
+
+ProbeResult = namedtuple('ProbeResult', ['url', 'status', 'headers', 'error'])
+
+
+def is_available(probe_result):
+    return probe_result.status is not None and probe_result.status < 400
+
+
+def content_length(probe_result):
+    #None if the URL isn't available or the server didn't send a Content-Length
+    if not is_available(probe_result):
+        return None
+
+    try:
+        return int(probe_result.headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+
+def probe_address(url):
+    #(scheme, host, port, path) the HEAD request is sent to
+    parsed_url = urlparse(url)
+    scheme = 'https' if parsed_url.scheme == 'https' else 'http'
+    port = parsed_url.port or (443 if scheme == 'https' else 80)
+    path = parsed_url.path or '/'
+
+    if parsed_url.query:
+        path += '?' + parsed_url.query
+
+    return scheme, parsed_url.hostname, port, path
+
+
+class UrlProber:
+    """
+    HEAD requests over pooled keep-alive connections, at most `concurrency` at a time.
+    """
+
+    def __init__(self, concurrency=32, retries=3, backoff=0.5, timeout=30):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        #Idle connections per (scheme, host, port)
+        self._idle_connections = {}
+        self._semaphore = None
+
+    async def _connect(self, scheme, host, port):
+        idle_connections = self._idle_connections.get((scheme, host, port), [])
+
+        while idle_connections:
+            reader, writer = idle_connections.pop()
+
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+
+            writer.close()
+
+        ssl_context = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context)
+
+        return reader, writer, False
+
+    def _release(self, scheme, host, port, reader, writer, keep_alive):
+        if keep_alive:
+            self._idle_connections.setdefault((scheme, host, port), []).append((reader, writer))
+        else:
+            writer.close()
+
+    async def _head(self, scheme, host, port, path):
+        reader, writer, reused = await self._connect(scheme, host, port)
+
+        try:
+            writer.write(f'HEAD {path} HTTP/1.1\r\nHost: {host}\r\nUser-Agent: hla-typing-benchmark\r\nConnection: keep-alive\r\n\r\n'.encode('latin-1'))
+            await writer.drain()
+
+            status_line = await reader.readline()
+
+            #A pooled connection may have been closed by the server in the meantime
+            if not status_line:
+                raise ConnectionResetError('Connection closed by the server')
+
+            version, status = status_line.decode('latin-1').split()[:2]
+            status = int(status)
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except BaseException as head_error:
+            writer.close()
+
+            #Only a stale pooled connection is tried again right away, a malformed response waits for the backoff
+            if reused and isinstance(head_error, OSError):
+                return await self._head(scheme, host, port, path)
+            raise
+
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' or (version == 'HTTP/1.1' and connection != 'close')
+        self._release(scheme, host, port, reader, writer, keep_alive)
+
+        return status, headers
+
+    async def probe(self, url):
+        scheme, host, port, path = probe_address(url)
+        status, headers, error = None, {}, None
+
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(self.backoff * 2**(attempt - 1))
+
+                try:
+                    status, headers = await asyncio.wait_for(self._head(scheme, host, port, path), self.timeout)
+                    error = None
+                except PROBE_ERRORS as probe_error:
+                    status, headers, error = None, {}, f'{type(probe_error).__name__}: {probe_error}'
+                    continue
+
+                if status not in RETRY_STATUSES:
+                    break
+
+        return ProbeResult(url, status, headers, error)
+
+    async def probe_all(self, urls):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        try:
+            probe_results = await asyncio.gather(*[self.probe(url) for url in urls], return_exceptions=True)
+        finally:
+            for connections in self._idle_connections.values():
+                for reader, writer in connections:
+                    writer.close()
+            self._idle_connections = {}
+
+        #Any other error only fails its own URL
+        return [ProbeResult(url, None, {}, f'{type(probe_result).__name__}: {probe_result}') if isinstance(probe_result, Exception) else probe_result
+                for url, probe_result in zip(urls, probe_results)]
+
+
+def probe_urls(urls, concurrency=32, retries=3, backoff=0.5, timeout=30):
+    """
+    Send a HEAD request to every URL. Returns a ProbeResult per URL, in the order of the URLs.
+    """
+    return asyncio.run(UrlProber(concurrency, retries, backoff, timeout).probe_all(list(urls)))
+
+
+def load_sample_populations(gs_data_path):
+    #One row per sample with its population, as named in the 1000 Genomes data folders
+    gs_df = pd.read_csv(gs_data_path, sep = " ", comment='#', usecols=['id', 'sbgroup'])
+    gs_df = gs_df.replace({'\"':''}, regex=True).replace('CEPH', 'CEU')
+
+    #Samples typed twice are listed twice
+    return gs_df.drop_duplicates('id').rename(columns={'id': 'sample_id', 'sbgroup': 'population'}).reset_index(drop=True)
+
+
+def make_sample_urls(samples_df, url_template=URL_TEMPLATE):
+    return [url_template.format(sample_id=sample_id, population=population) for sample_id, population in zip(samples_df['sample_id'], samples_df['population'])]
+
+
+def write_config(sample_urls, outfile_path, reference_genome_url=REFERENCE_GENOME_URL):
+    os.makedirs(os.path.dirname(outfile_path) or '.', exist_ok=True)
+
+    with open(outfile_path, 'w') as outfile:
+        outfile.write('reference_genome:\n')
+        outfile.write(f'  GRCh38: "{reference_genome_url}"\n')
+
+        outfile.write('sample_urls:\n')
+        for sample_id, url in sample_urls.items():
+            outfile.write(f'  {sample_id}: "{url}"\n')
+
+
+def write_manifest(samples_df, outfile_path):
+    os.makedirs(os.path.dirname(outfile_path) or '.', exist_ok=True)
+    samples_df[MANIFEST_COLUMNS].to_csv(outfile_path, sep='\t', index=False)
+
+
+def read_manifest(manifest_path):
+    return pd.read_csv(manifest_path, sep='\t', dtype={'cram_bytes': 'Int64', 'crai_bytes': 'Int64'})
+
+
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    samples_df = load_sample_populations(args.input)
+    samples_df['url'] = make_sample_urls(samples_df, args.url_template)
+
+    #The indexes are probed in the same run, on the same connections
+    n_samples = len(samples_df)
+    probe_results = probe_urls(list(samples_df['url']) + [url + '.crai' for url in samples_df['url']],
+                               concurrency=args.concurrency,
+                               retries=args.retries,
+                               backoff=args.backoff,
+                               timeout=args.timeout)
+    cram_results, crai_results = probe_results[:n_samples], probe_results[n_samples:]
+
+    samples_df['available'] = [is_available(probe_result) for probe_result in cram_results]
+    samples_df['cram_bytes'] = pd.array([content_length(probe_result) for probe_result in cram_results], dtype='Int64')
+    samples_df['crai_bytes'] = pd.array([content_length(probe_result) for probe_result in crai_results], dtype='Int64')
+
+    failed = [probe_result for probe_result in probe_results if probe_result.error is not None]
+    if len(failed) > 0:
+        print(f'{len(failed)} of {len(probe_results)} URLs could not be probed, e.g. {failed[0].url}: {failed[0].error}')
+
+    available_df = samples_df[samples_df['available']]
+    print(f'Samples with exome data: {len(available_df)} of {len(samples_df)}')
+
+    write_config(dict(zip(available_df['sample_id'], available_df['url'])), args.output, args.reference_genome)
+
+    manifest_path = args.manifest if args.manifest is not None else os.path.join(os.path.dirname(args.output), MANIFEST_FILENAME)
+    write_manifest(available_df, manifest_path)
+
+    missing_sizes = available_df['cram_bytes'].isna().sum()
+    if missing_sizes > 0:
+        print(f'{missing_sizes} samples have no CRAM size in {manifest_path}')
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--input',
+                        help='Path to 1000G_hla_diversity_2014.txt (the gold standard)',
+                        default='results/00_1000G_reference/1000G_hla_diversity_2014.txt')
+
+    parser.add_argument('--output',
+                        help='Path to write the config to',
+                        default='snakemake/config.yaml')
+
+    parser.add_argument('--manifest',
+                        help=f'Path to write the manifest with the CRAM and CRAI sizes to (default: {MANIFEST_FILENAME} next to the config)')
 
-def checkUrl(url):
-    p = urlparse(url)
-    conn = http.client.HTTPConnection(p.netloc)
-    conn.request('HEAD', p.path)
-    resp = conn.getresponse()
-    return resp.status < 400
+    parser.add_argument('--url-template',
+                        help='URL of the exome alignment of a sample, with {sample_id} and {population}',
+                        default=URL_TEMPLATE)
 
+    parser.add_argument('--reference-genome',
+                        help='URL of the reference genome written to the config',
+                        default=REFERENCE_GENOME_URL)
 
-#Check all exome links to create a list of id's with exome data
-gold_standard_id_list = []
-gold_standard_url_list = []
+    parser.add_argument('--concurrency',
+                        help='Maximum number of requests at a time',
+                        type=int,
+                        default=32)
 
-#Load gold standard data (refers to output from Snakemake run)
-#If Snakemake has not been run, the dataset can be found at http://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20140725_hla_genotypes/20140702_hla_diversity.txt
-gs_2014_df = pd.read_csv('../../results/00_1000G_reference/1000G_hla_diversity_2014.txt', sep = " ", comment='#')
+    parser.add_argument('--retries',
+                        help='Number of retries of a failed request',
+                        type=int,
+                        default=3)
 
-for sample_id in gs_2014_df['id']:
-    sbgroup = gs_2014_df[gs_2014_df['id'] == sample_id]['sbgroup'].iloc[0]         
-    wget_url = "ftp://ftp.1000genomes.ebi.ac.uk/vol1/ftp/data_collections/1000_genomes_project/data/{}/{}/exome_alignment/{}.alt_bwamem_GRCh38DH.20150826.{}.exome.cram".format(sbgroup, identity, identity, sbgroup, )
-    
-    if checkUrl(wget_url):
-        gold_standard_id_list.append(sample_id)
-        gold_standard_url_list.append(wget_url)
+    parser.add_argument('--backoff',
+                        help='Seconds to wait before the first retry, doubled for every further retry',
+                        type=float,
+                        default=0.5)
 
+    parser.add_argument('--timeout',
+                        help='Timeout of a request in seconds',
+                        type=float,
+                        default=30)
 
-with open(configfile_1, 'w') as outfile:
-    outfile.write('sample_urls:\n')
-    for entry in full_sample_urllist:
-        entry_name = entry.split('/')[9]
-        outfile.write("  " + entry_name + ": " +  "\"" + entry + "\"" + '\n')
-    
-    outfile.write('reference_genome:\n\tGRCh38: "ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/reference/GRCh38_reference_genome/GRCh38_full_analysis_set_plus_decoy_hla.fa"')
+    return parser
 
 
+if __name__ == '__main__':
+    main()
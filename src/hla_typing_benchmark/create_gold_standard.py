@@ -1,164 +1,123 @@
-import os
-from os import walk
-
 import pandas as pd
 import numpy as np
-import sys
-import re
 import yaml
 import argparse
-import pickle
-
-import numpy as np
 
 from hla_typing_benchmark.parse_data import *
+from hla_typing_benchmark.imgt_release_store import ImgtReleaseStore
+from hla_typing_benchmark.gold_standard_table import write_gold_standard
+from hla_typing_benchmark.profiling import get_profiler, start_profiling
 
-import http.client
-from urllib.parse import urlparse
 
+#Columns of the two haplotypes of every locus in the 1000G gold standard
+GS_COLUMNS = ['A', 'A.1', 'B', 'B.1', 'C', 'C.1', 'DRB1', 'DRB1.1', 'DQB1', 'DQB1.1']
+GS_LOCI = ['A', 'B', 'C', 'DRB1', 'DQB1']
 
-def checkUrl(url):
-    p = urlparse(url)
-    conn = http.client.HTTPConnection(p.netloc)
-    conn.request('HEAD', p.path)
-    resp = conn.getresponse()
-    return resp.status < 400
 
-
-def load_gs_data(gs_data_path = 'results/00_1000G_reference/1000G_hla_diversity_2014.txt', outfile_path = 'results/01_1000G_reference/1000G_2014_cleaned.tsv'):
+def load_gs_data(gs_data_path = 'results/00_1000G_reference/1000G_hla_diversity_2014.txt', outfile_path = 'results/01_1000G_reference/1000G_2014_cleaned.gs', resolutions = None, config_path = 'snakemake/config.yaml'):
     #Load gold standard data (refers to output from Snakemake run)
     #If Snakemake has not been run, the dataset can be found at http://ftp.1000genomes.ebi.ac.uk/vol1/ftp/technical/working/20140725_hla_genotypes/20140702_hla_diversity.txt
-    MG_exome_df = pd.read_csv(gs_data_path, sep = " ", comment='#')
+    with get_profiler().stage('read gold standard'):
+        MG_exome_df = pd.read_csv(gs_data_path, sep = " ", comment='#')
 
     #Remove quotes
     #Change name of Utah individuals from CEPH to CEU as seen in the 1000 genomes database:
     #Remove samples with NaN (non typed alleles)
-    MG_exome_df = MG_exome_df.replace({'\"':''}, regex=True).replace('CEPH','CEU').dropna()     
+    MG_exome_df = MG_exome_df.replace({'\"':''}, regex=True).replace('CEPH','CEU').dropna()
 
     #Only include Sample ID's that has been typed in the pipeline (read from config)
-    with open("/work/nthu/publications/springers-hla-benchmark/snakemake/config.yaml", 'r') as stream:
+    with open(config_path, 'r') as stream:
         config = yaml.safe_load(stream)
     MG_exome_df = MG_exome_df[MG_exome_df['id'].isin(list(config['sample_urls']))].drop('sbgroup', axis = 1)
 
     #Replace 0000 with empty string:
     MG_exome_df = MG_exome_df.replace('0000', '')
 
-    #Merge rows, where a person has been typed twice.
-    #Check for non-identical rows
-    print(f"Samples in gold standard dataset: {len(set(list(MG_exome_df['id'])))}")
+    print(f"Samples in gold standard dataset: {MG_exome_df['id'].nunique()}")
+
+    #Merge rows, where a person has been typed twice, and remove the '/' left by empty entries at either end.
+    #The merged rows are added after the other samples, sorted by id
+    duplicated = MG_exome_df['id'].duplicated(keep=False)
+    clean_duplicates_df = MG_exome_df[duplicated].groupby('id')[GS_COLUMNS].agg('/'.join)
+    clean_duplicates_df = clean_duplicates_df.apply(lambda column: column.str.strip('/'))
 
-    non_unique = list({x for x in list(MG_exome_df['id']) if list(MG_exome_df['id']).count(x) > 1})
-    non_unique_df = MG_exome_df[MG_exome_df['id'].isin(non_unique)]
+    MG_exome_df = pd.concat([MG_exome_df[~duplicated], clean_duplicates_df.reset_index()], ignore_index=True, sort=False)
 
-    clean_duplicates_df = pd.DataFrame()
-    for column in ['A','A.1','B','B.1','C','C.1','DRB1','DRB1.1','DQB1','DQB1.1']:
-        clean_duplicates_df[column] = non_unique_df.groupby(['id'])[column].apply('/'.join)
-        
-        #Remove potentaial starting '/'
-        for identity in clean_duplicates_df.index:
-            entry = clean_duplicates_df.loc[identity, column]
-            
-            if entry.startswith('/'):
-                clean_duplicates_df.at[identity, column] = entry[1:]
-            if entry.endswith('/'):
-                clean_duplicates_df.at[identity, column] = entry[:-1]
-            
-    clean_duplicates_df = clean_duplicates_df.reset_index(drop=True)
+    #Check that only unique entries exist now.
+    assert MG_exome_df['id'].is_unique
 
-    #Remove the duplicate rows from the full dataframe"
-    MG_exome_df = MG_exome_df[~MG_exome_df['id'].isin(non_unique)]
+    #Set id as index
+    MG_exome_df = MG_exome_df.set_index('id')
 
-    #Add back the clean duplicate rows:
-    MG_exome_df = MG_exome_df.append(clean_duplicates_df, sort=False)
+    get_profiler().count('gold standard samples', len(MG_exome_df))
 
-    #Reset index
-    MG_exome_df = MG_exome_df.reset_index(drop = True)
+    #One row per candidate allele of every sample and haplotype, in the order of the samples, columns and candidates
+    haplotype_entries = MG_exome_df[GS_COLUMNS].stack()
+    candidates = haplotype_entries.str.split('/').explode()
 
-    #Check that only uniwue entries exist now.
-    assert len(set(list(MG_exome_df['id']))) == len(list(MG_exome_df['id']))
+    #Put gene name in front of all entries
+    loci = candidates.index.get_level_values(1).str.split('.').str[0]
+    candidates = pd.Series(np.asarray(loci, dtype=object) + '*' + candidates.to_numpy(dtype=object), index=candidates.index)
 
-    #Set id as index
-    MG_exome_df = MG_exome_df.set_index('id')
+    #Convert all predictions to 2-field resolution. Entries without at least two fields are not valid and removed
+    two_field = convert_many(candidates, ('two_field',))['two_field']
+    two_field = two_field[two_field.notna()]
 
+    #Merge the candidates of each haplotype. The candidates of a haplotype are consecutive rows, so the haplotypes
+    #are split at the rows where the (sample, column) changes, which is much faster than a groupby with a Python function
+    haplotype_codes, haplotype_index = pd.factorize(two_field.index)
+    candidate_groups = np.split(two_field.to_numpy(dtype=object), np.flatnonzero(np.diff(haplotype_codes)) + 1) if len(two_field) > 0 else []
+    haplotypes = pd.Series([list(set(alleles)) for alleles in candidate_groups], index=haplotype_index, dtype=object)
 
-    #Look  for samples without gold standard data from 2014 Gorroud
     #Remember entries, which are not typed
-    non_typed_samples = list()
-
-    #Furthermore - in cases, where 2 field resolution is not available, use 2018 data.
-    for identity in list(MG_exome_df.index):
-        
-        for col in MG_exome_df.columns:
-            #get list of predictions
-            predictions_list = MG_exome_df.loc[identity,col].split('/')
-            
-            #Put gene name in front of all entries in the list
-            for i in range(len(predictions_list)):
-                predictions_list[i] = col.split('.')[0] + "*" + predictions_list[i]
-            
-            #Check, that all entries in the list have at least four field resolution:
-            for pred in predictions_list:
-                
-                #Remove all non valid entries
-                if convert_to_two_field(pred) == None:
-                    predictions_list.remove(pred)
-            
-            #Note, if no proper typing was made in 2014
-            if len(predictions_list) == 0:
-                non_typed_samples.append(identity)
-                predictions_list = ['not_typed_in_2014']
-                            
-    
-            MG_exome_df.at[identity,col] = predictions_list
-    
+    non_typed = ~haplotype_entries.index.isin(haplotypes.index)
+    non_typed_samples = list(haplotype_entries.index[non_typed].get_level_values(0))
+
     if len(non_typed_samples) > 0:
         print(f"Non typed samples in 2014: {non_typed_samples}")
 
     assert len(non_typed_samples) == 0
 
     #Merge haplotypes
-    MG_exome_df['A_merged']= MG_exome_df[['A', 'A.1']].apply(lambda x: list(x), axis=1)
-    MG_exome_df['B_merged']= MG_exome_df[['B', 'B.1']].apply(lambda x: list(x), axis=1)
-    MG_exome_df['C_merged']= MG_exome_df[['C', 'C.1']].apply(lambda x: list(x), axis=1)
-    MG_exome_df['DRB1_merged']= MG_exome_df[['DRB1', 'DRB1.1']].apply(lambda x: list(x), axis=1)
-    MG_exome_df['DQB1_merged']= MG_exome_df[['DQB1', 'DQB1.1']].apply(lambda x: list(x), axis=1)
+    haplotypes_df = haplotypes.unstack().reindex(index=MG_exome_df.index, columns=GS_COLUMNS)
+    gs_two_field_df = pd.DataFrame({locus: [list(pair) for pair in zip(haplotypes_df[locus], haplotypes_df[f'{locus}.1'])] for locus in GS_LOCI},
+                                   index=MG_exome_df.index)
 
-    MG_exome_merged_df = MG_exome_df.drop(columns=['A', 'A.1', 'B', 'B.1', 'C', 'C.1', 'DRB1', 'DRB1.1','DQB1', 'DQB1.1'])
+    #Store the reference alleles at every resolution, so the scoring never has to convert them
+    if resolutions is None:
+        resolutions = all_resolutions()
+    check_resolutions(resolutions)
 
-    MG_exome_merged_df = MG_exome_merged_df.rename(columns={"A_merged": "A", "B_merged": "B", "C_merged": "C", "DRB1_merged": "DRB1", "DQB1_merged": "DQB1"})
+    #Columnar gold standard, unless a .pkl file is asked for
+    return write_gold_standard(gs_two_field_df, outfile_path, resolutions=resolutions, nomenclature=get_nomenclature())
 
-    #Convert all predictions to 2-field resolution 
-    gs_two_field_df = MG_exome_merged_df.copy()
 
-    #Loop over all entries and update the three gold standard dataframes, so they fit the idividual resolution
-    for identity in list(MG_exome_merged_df.index):
-        for gene in list(MG_exome_merged_df.columns):
-            
-            old_pred_list = MG_exome_merged_df.loc[identity,gene]
-            gene_pred_two_field = []
-        
-            #Loop over the two alleles
-            for allele_list in old_pred_list:             
-                allele_pred_two_field = []
 
-                #Convert each prediction to it's respective correct format:
-                for allele in allele_list:
-                    allele_pred_two_field.append(convert_to_two_field(allele))
-
-                #Merge the two alleles for each gene in a list
-                gene_pred_two_field.append(list(set(allele_pred_two_field)))
-            
-            #Update dataframes wit0h the new predictions
-            gs_two_field_df.at[identity,gene] = gene_pred_two_field
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
 
-    gs_two_field_df.to_pickle(outfile_path)
+    if args.profile is not None:
+        start_profiling(cprofile=args.cprofile is not None)
 
+    #The tables are needed to store the reference alleles at all resolutions
+    if args.imgt_store is not None:
+        set_nomenclature(ImgtReleaseStore(args.imgt_store).nomenclature(args.imgt_release,
+                                                                        e_group_filepath=args.pseudosequences,
+                                                                        cache_dir=args.nomenclature_cache))
+    else:
+        configure_nomenclature(deleted_filepath=args.deleted_alleles,
+                               p_group_filepath=args.p_group,
+                               e_group_filepath=args.pseudosequences,
+                               g_group_filepath=args.g_group,
+                               cache_dir=args.nomenclature_cache)
 
+    #Includes the conversion and writing of the gold standard, which are profiled as stages of their own
+    with get_profiler().stage('create gold standard'):
+        load_gs_data(gs_data_path=args.input, outfile_path=args.output, resolutions=args.resolutions, config_path=args.config)
 
-def main():
-    parser = get_argparser()
-    args = parser.parse_args()
-    load_gs_data(gs_data_path=args.input, outfile_path=args.output)
+    if args.profile is not None:
+        get_profiler().write(args.profile, 'create_gold_standard', get_nomenclature(), args.cprofile)
 
 
 def get_argparser():
@@ -170,8 +129,62 @@ def get_argparser():
                          required=False)
 
     parser.add_argument('--output',
-                        help='Path to write formatted gold standard dataset.',
-                        default='results/01_1000G_reference/1000G_2014_cleaned.pkl',
+                        help='Path to write formatted gold standard dataset. A folder with the columnar gold standard is written, or a pickled Pandas dataframe if the path ends with .pkl',
+                        default='results/01_1000G_reference/1000G_2014_cleaned.gs',
+                        required=False)
+
+    parser.add_argument('--config',
+                        help='Snakemake config.yaml with the samples to include',
+                        default='snakemake/config.yaml',
+                        required=False)
+
+    parser.add_argument('--deleted-alleles',
+                        help='IMGT/HLA Deleted_alleles.txt used to rename deleted alleles',
+                        default=DELETED_ALLELES_PATH,
+                        required=False)
+
+    parser.add_argument('--p-group',
+                        help='IMGT/HLA hla_nom_p.txt used for P group conversion',
+                        default=P_GROUP_PATH,
+                        required=False)
+
+    parser.add_argument('--pseudosequences',
+                        help='Table with MHC pseudosequences used for pseudosequence conversion',
+                        default=E_GROUP_PATH,
+                        required=False)
+
+    parser.add_argument('--g-group',
+                        help='IMGT/HLA hla_nom_g.txt used for G group conversion',
+                        default=G_GROUP_PATH,
+                        required=False)
+
+    parser.add_argument('--resolutions',
+                        help='Resolutions to store the reference alleles at',
+                        nargs='+',
+                        choices=all_resolutions(),
+                        default=all_resolutions(),
+                        required=False)
+
+    parser.add_argument('--nomenclature-cache',
+                        help='Folder for the cached nomenclature tables. They are rebuilt when the source files change',
+                        default=NOMENCLATURE_CACHE_DIR,
+                        required=False)
+
+    parser.add_argument('--imgt-store',
+                        help='IMGT release store (see imgt_release_store). If given, --deleted-alleles, --p-group and --g-group are ignored',
+                        required=False)
+
+    parser.add_argument('--imgt-release',
+                        help="Release in the IMGT release store to use ('latest' is the newest release)",
+                        default='latest',
+                        required=False)
+
+    parser.add_argument('--profile',
+                        help='Path to write a profile of the run as json: wall time per stage, alleles converted, conversion cache hits and misses and peak memory',
+                        required=False)
+
+    parser.add_argument('--cprofile',
+                        help='Path to write cProfile statistics of the run to (used together with --profile)',
                         required=False)
     return parser
 
@@ -0,0 +1,167 @@
+"""
+Incremental evaluation cache for parse_typing_results.
+
+For every tool, the cache keeps the parsed and the converted predictions of each result file and the per-resolution
+scores of each sample:
+
+    <cache>/<tool>.json
+
+Parsed predictions are reused as long as the result file is unchanged. A file counts as unchanged if its size and mtime
+are the same, or - if only the mtime changed - if its content hash is the same. Converted predictions are reused as long
+as the file is unchanged and the nomenclature tables have the same version.
+Scores are reused if the predictions and the gold standard of the sample are the same and the nomenclature tables
+have the same version. Only new or changed samples are parsed and scored again.
+Only the files of tools with new, changed or removed entries are written back.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from hla_typing_benchmark.nomenclature_cache import file_digest
+
+#Bump when the layout of the cache or the way the samples are scored changes
+EVALUATION_CACHE_VERSION = 4
+
+
+def score_key(predictions, correct_alleles, candidates=1):
+    #Everything the scores of a sample depend on, apart from the nomenclature
+    return hashlib.sha256(json.dumps([predictions, correct_alleles, candidates], sort_keys=True).encode()).hexdigest()[:20]
+
+
+class EvaluationCache:
+
+    def __init__(self, cache_dir, nomenclature_version):
+        self.cache_dir = cache_dir
+        self.nomenclature_version = nomenclature_version
+        self.hits = 0
+        self.misses = 0
+
+        self._tools = {}
+        self._used = {}
+        #Tools with entries to write back
+        self._changed = set()
+
+    def _cache_filepath(self, tool):
+        return os.path.join(self.cache_dir, f'{tool}.json')
+
+    def _tool_cache(self, tool):
+        if tool not in self._tools:
+            tool_cache = {'calls': {}, 'scores': {}}
+
+            try:
+                with open(self._cache_filepath(tool), 'r') as infile:
+                    stored_cache = json.load(infile)
+            except (FileNotFoundError, ValueError):
+                stored_cache = {}
+
+            if stored_cache.get('version') == EVALUATION_CACHE_VERSION:
+                tool_cache['calls'] = stored_cache['calls']
+
+                #The scores and the converted predictions depend on the nomenclature tables, the parsed predictions don't
+                if stored_cache.get('nomenclature_version') == self.nomenclature_version:
+                    tool_cache['scores'] = stored_cache['scores']
+                else:
+                    for entry in tool_cache['calls'].values():
+                        entry.pop('predictions', None)
+                    self._changed.add(tool)
+            elif stored_cache:
+                self._changed.add(tool)
+
+            self._tools[tool] = tool_cache
+            self._used[tool] = {'calls': set(), 'scores': set()}
+
+        return self._tools[tool]
+
+    def get_calls(self, tool, filename):
+        """
+        Return the cached predictions of a result file, or None if the file is new or has changed.
+        """
+        entry = self._tool_cache(tool)['calls'].get(filename)
+        self._used[tool]['calls'].add(filename)
+        file_stat = os.stat(filename)
+
+        if entry is not None and entry['size'] == file_stat.st_size:
+            if entry['mtime'] == file_stat.st_mtime_ns:
+                self.hits += 1
+                return entry['calls']
+
+            #Touched, but maybe not changed
+            if entry['sha256'] == file_digest(filename):
+                entry['mtime'] = file_stat.st_mtime_ns
+                self._changed.add(tool)
+                self.hits += 1
+                return entry['calls']
+
+        self.misses += 1
+        return None
+
+    def set_calls(self, tool, filename, calls):
+        file_stat = os.stat(filename)
+
+        self._tool_cache(tool)['calls'][filename] = {'size': file_stat.st_size,
+                                                     'mtime': file_stat.st_mtime_ns,
+                                                     'sha256': file_digest(filename),
+                                                     'calls': calls}
+        self._used[tool]['calls'].add(filename)
+        self._changed.add(tool)
+
+    def get_predictions(self, tool, filename):
+        """
+        Return the cached predictions of a result file converted with this nomenclature, or None if they aren't cached.
+        get_calls has to return the predictions of the file first.
+        """
+        return self._tool_cache(tool)['calls'][filename].get('predictions')
+
+    def set_predictions(self, tool, filename, predictions):
+        #Predictions of a result file converted with this nomenclature. get_calls or set_calls has to be called first
+        self._tool_cache(tool)['calls'][filename]['predictions'] = predictions
+        self._changed.add(tool)
+
+    def get_scores(self, tool, subject, key):
+        """
+        Return the cached scores of a sample as {resolution: {locus: [count, score]}}.
+        The scores are dropped if the predictions or the gold standard of the sample have changed.
+        """
+        scores = self._tool_cache(tool)['scores']
+        self._used[tool]['scores'].add(subject)
+
+        if subject not in scores or scores[subject]['key'] != key:
+            scores[subject] = {'key': key, 'resolutions': {}}
+            self._changed.add(tool)
+
+        return scores[subject]['resolutions']
+
+    def set_scores(self, tool, subject, resolution, locus_scores):
+        #Scores of a sample at a resolution, which wasn't in the cache yet. get_scores has to be called first
+        self._tool_cache(tool)['scores'][subject]['resolutions'][resolution] = locus_scores
+        self._changed.add(tool)
+
+    def save(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        for tool, tool_cache in self._tools.items():
+            #Files and samples of earlier runs, which weren't used in this run, are removed
+            if len(tool_cache['calls']) > len(self._used[tool]['calls']) or len(tool_cache['scores']) > len(self._used[tool]['scores']):
+                self._changed.add(tool)
+
+            if tool not in self._changed:
+                continue
+
+            #Only keep the files and samples of this run, so the cache doesn't grow with removed samples
+            stored_cache = {'version': EVALUATION_CACHE_VERSION,
+                            'nomenclature_version': self.nomenclature_version,
+                            'calls': {filename: entry for filename, entry in tool_cache['calls'].items() if filename in self._used[tool]['calls']},
+                            'scores': {subject: entry for subject, entry in tool_cache['scores'].items() if subject in self._used[tool]['scores']}}
+
+            #Write to a temporary file first, so an interrupted run never leaves a broken cache
+            file_descriptor, tmp_filepath = tempfile.mkstemp(prefix=f'.{tool}-', dir=self.cache_dir)
+            os.chmod(tmp_filepath, 0o644)
+
+            with os.fdopen(file_descriptor, 'w') as outfile:
+                json.dump(stored_cache, outfile)
+
+            os.replace(tmp_filepath, self._cache_filepath(tool))
+
+        self._changed = set()
@@ -0,0 +1,263 @@
+"""
+Columnar gold standard written by create_gold_standard and read by parse_typing_results.
+
+The gold standard is a folder of .npy columns with one row per (sample, locus, haplotype, candidate allele):
+
+    <gold standard>/subject.npy      int32 codes into subjects.npy
+    <gold standard>/locus.npy        int8 codes into loci.npy
+    <gold standard>/haplotype.npy    int8, 0 or 1
+    <gold standard>/allele.npy       int32 codes into alleles.npy
+    <gold standard>/format.json
+
+The reference alleles can also be stored converted to every resolution, so scoring never converts them again.
+For each resolution, label_codes.<resolution>.npy maps every allele in alleles.npy to a code into labels.<resolution>.npy
+(-1 if the allele has no label at this resolution). The labels are only valid for the nomenclature version they
+were converted with, which is recorded in format.json.
+
+Columns are loaded memory-mapped, and only when they are used. Nothing is pickled, so the gold standard
+can be shared between nodes safely. The older pickled DataFrame (one list of candidates per haplotype in each cell)
+can still be read.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from hla_typing_benchmark.profiling import get_profiler
+
+
+GOLD_STANDARD_FORMAT = 'hla-typing-benchmark-gold-standard'
+GOLD_STANDARD_FORMAT_VERSION = 1
+FORMAT_FILENAME = 'format.json'
+
+COLUMNS = ['subject', 'locus', 'haplotype', 'allele']
+COLUMN_DTYPES = {'subject': np.int32, 'locus': np.int8, 'haplotype': np.int8, 'allele': np.int32}
+
+#Columns stored as codes into a list of categories
+CATEGORIES = {'subject': 'subjects', 'locus': 'loci', 'allele': 'alleles'}
+
+
+class GoldStandardTable:
+    """
+    Gold standard in long format. Columns and categories are read from path the first time they are used,
+    unless they are passed in directly.
+    """
+
+    def __init__(self, path=None, columns=None, categories=None, file_format=None):
+        self.path = path
+        self._columns = dict(columns) if columns is not None else {}
+        self._categories = dict(categories) if categories is not None else {}
+        self._format = dict(file_format) if file_format is not None else {}
+        self._label_codes = {}
+        self._labels = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, FORMAT_FILENAME), 'r') as infile:
+            file_format = json.load(infile)
+
+        if file_format.get('format') != GOLD_STANDARD_FORMAT or file_format.get('version') != GOLD_STANDARD_FORMAT_VERSION:
+            raise ValueError(f'{path} is not a gold standard in format version {GOLD_STANDARD_FORMAT_VERSION}')
+
+        return cls(path=path, file_format=file_format)
+
+    @classmethod
+    def from_frame(cls, gold_standard_df):
+        """
+        Build the table from a DataFrame with one list of candidate alleles per haplotype in each cell.
+        """
+        subjects = list(pd.unique(gold_standard_df.index))
+        loci = list(gold_standard_df.columns)
+
+        subject_codes = {subject: code for code, subject in enumerate(subjects)}
+        allele_codes = {}
+        rows = []
+
+        for subject, row in zip(gold_standard_df.index, gold_standard_df.itertuples(index=False)):
+            for locus_code, haplotypes in enumerate(row):
+                for haplotype, alleles in enumerate(haplotypes[:2]):
+                    for allele in alleles:
+                        rows.append((subject_codes[subject], locus_code, haplotype, allele_codes.setdefault(allele, len(allele_codes))))
+
+        row_array = np.array(rows, dtype=np.int64).reshape(-1, len(COLUMNS))
+        columns = {name: row_array[:, i].astype(COLUMN_DTYPES[name]) for i, name in enumerate(COLUMNS)}
+
+        return cls(columns=columns, categories={'subject': subjects, 'locus': loci, 'allele': list(allele_codes)})
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = np.load(os.path.join(self.path, f'{name}.npy'), mmap_mode='r')
+
+        return self._columns[name]
+
+    def categories(self, name):
+        if name not in self._categories:
+            self._categories[name] = np.load(os.path.join(self.path, f'{CATEGORIES[name]}.npy')).astype(str).tolist()
+
+        return self._categories[name]
+
+    def label_codes(self, resolution):
+        if resolution not in self._label_codes:
+            self._label_codes[resolution] = np.load(os.path.join(self.path, f'label_codes.{resolution}.npy'), mmap_mode='r')
+
+        return self._label_codes[resolution]
+
+    def labels(self, resolution):
+        if resolution not in self._labels:
+            self._labels[resolution] = np.load(os.path.join(self.path, f'labels.{resolution}.npy')).astype(str).tolist()
+
+        return self._labels[resolution]
+
+    def add_labels(self, resolutions, nomenclature):
+        """
+        Convert every reference allele to the given resolutions once and keep the labels with the table.
+        """
+        for resolution in resolutions:
+            with get_profiler().stage(f'conversion/{resolution}'):
+                converted_alleles = [nomenclature.converter.convert(allele, resolution) for allele in self.categories('allele')]
+
+            #Alleles without a label at this resolution get the code -1
+            label_codes, labels = pd.factorize(pd.Series(converted_alleles, dtype=object))
+            self._label_codes[resolution] = label_codes.astype(np.int32)
+            self._labels[resolution] = list(labels)
+
+        self._format['resolutions'] = list(dict.fromkeys(self._format.get('resolutions', []) + list(resolutions)))
+        self._format['nomenclature_version'] = nomenclature.version()
+
+    def label_resolutions(self, nomenclature=None):
+        """
+        Resolutions with stored labels. If a nomenclature is given, only if the labels were converted with the same version of it.
+        """
+        if nomenclature is not None and self._format.get('nomenclature_version') != nomenclature.version():
+            return []
+
+        return list(self._format.get('resolutions', []))
+
+    @property
+    def subjects(self):
+        return self.categories('subject')
+
+    @property
+    def loci(self):
+        return self.categories('locus')
+
+    def __len__(self):
+        return len(self.column('haplotype'))
+
+    def save(self, path):
+        #Write to a temporary folder first, so readers never see a half written gold standard
+        parent_dir = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{os.path.basename(path)}-', dir=parent_dir)
+        os.chmod(tmp_dir, 0o755)
+
+        for name in COLUMNS:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'), np.asarray(self.column(name), dtype=COLUMN_DTYPES[name]))
+
+        for name, categories_name in CATEGORIES.items():
+            np.save(os.path.join(tmp_dir, f'{categories_name}.npy'), np.array([category.encode() for category in self.categories(name)], dtype=bytes))
+
+        for resolution in self.label_resolutions():
+            np.save(os.path.join(tmp_dir, f'label_codes.{resolution}.npy'), np.asarray(self.label_codes(resolution), dtype=np.int32))
+            np.save(os.path.join(tmp_dir, f'labels.{resolution}.npy'), np.array([label.encode() for label in self.labels(resolution)], dtype=bytes))
+
+        with open(os.path.join(tmp_dir, FORMAT_FILENAME), 'w') as outfile:
+            json.dump(dict(self._format, format=GOLD_STANDARD_FORMAT, version=GOLD_STANDARD_FORMAT_VERSION, rows=len(self)), outfile, indent=4)
+
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+
+        os.rename(tmp_dir, path)
+
+    def subject_mask(self, subject_id_list):
+        subject_codes = pd.Index(self.subjects).get_indexer(subject_id_list)
+
+        return np.isin(self.column('subject'), subject_codes[subject_codes >= 0])
+
+    def n_subjects(self, subject_id_list):
+        #Number of subjects in the list, which are in the gold standard
+        return int(pd.Index(self.subjects).isin(subject_id_list).sum())
+
+    def known_subjects(self, subject_id_list):
+        #The subjects in the list, which are in the gold standard, in the order of the list
+        known_subjects = set(self.subjects)
+
+        return [subject for subject in subject_id_list if subject in known_subjects]
+
+    def to_long(self, subject_id_list=None, resolutions=()):
+        """
+        Long DataFrame with categorical subject, locus and allele columns, optionally only for the given subjects.
+        For each of the given resolutions with stored labels, a categorical column with the converted reference alleles is added.
+        """
+        rows = slice(None) if subject_id_list is None else self.subject_mask(subject_id_list)
+
+        long_df = pd.DataFrame({name: pd.Categorical.from_codes(np.asarray(self.column(name))[rows], categories=self.categories(name))
+                                if name in CATEGORIES else np.asarray(self.column(name))[rows]
+                                for name in COLUMNS})
+
+        allele_codes = np.asarray(self.column('allele'))[rows]
+
+        for resolution in resolutions:
+            long_df[resolution] = pd.Categorical.from_codes(np.asarray(self.label_codes(resolution))[allele_codes], categories=self.labels(resolution))
+
+        return long_df
+
+    def correct_alleles(self, subject_id_list=None):
+        """
+        The candidate alleles as {subject: {locus: [[haplotype 1 candidates], [haplotype 2 candidates]]}}.
+        """
+        subjects = self.subjects if subject_id_list is None else self.known_subjects(subject_id_list)
+
+        correct_alleles_dict = {subject: {locus: [[], []] for locus in self.loci} for subject in subjects}
+
+        long_df = self.to_long(subjects)
+
+        for subject, locus, haplotype, allele in zip(long_df['subject'], long_df['locus'], long_df['haplotype'].tolist(), long_df['allele']):
+            correct_alleles_dict[subject][locus][haplotype].append(allele)
+
+        return correct_alleles_dict
+
+    def to_frame(self):
+        #DataFrame with one list of candidates per haplotype in each cell, as in the pickled gold standard
+        return pd.DataFrame.from_dict(self.correct_alleles(), orient='index', columns=self.loci)
+
+
+def as_gold_standard_table(gold_standard):
+    if isinstance(gold_standard, GoldStandardTable):
+        return gold_standard
+
+    return GoldStandardTable.from_frame(gold_standard)
+
+
+def load_gold_standard(path):
+    #Pickled DataFrames from earlier versions are still read
+    if os.path.isdir(path):
+        return GoldStandardTable.load(path)
+
+    return GoldStandardTable.from_frame(pd.read_pickle(path))
+
+
+def write_gold_standard(gold_standard_df, path, resolutions=(), nomenclature=None):
+    """
+    Write the columnar gold standard with the reference alleles converted to the given resolutions.
+    A pickled DataFrame (without converted alleles) is written only if the path ends with .pkl.
+    Returns the written gold standard, so it can be scored against without reading it back.
+    """
+    if path.endswith('.pkl'):
+        with get_profiler().stage('write/gold standard'):
+            gold_standard_df.to_pickle(path)
+        return gold_standard_df
+
+    gold_standard_table = GoldStandardTable.from_frame(gold_standard_df)
+
+    if resolutions:
+        gold_standard_table.add_labels(resolutions, nomenclature)
+
+    with get_profiler().stage('write/gold standard'):
+        gold_standard_table.save(path)
+
+    return gold_standard_table
@@ -0,0 +1,345 @@
+"""
+Local store with several IMGT/HLA releases side by side.
+
+Every release keeps its source files and its compiled deleted allele, P group and G group tables:
+
+    <store>/<release>/hla_nom_p.txt
+    <store>/<release>/hla_nom_g.txt
+    <store>/<release>/Deleted_alleles.txt
+    <store>/<release>/tables/<table>/*.npy
+    <store>/<release>/release.json
+
+A new release is compiled as a diff against a release already in the store:
+only newly deleted alleles and changed P and G group lines are recompiled.
+parse_typing_results and create_gold_standard can be pinned to a release with --imgt-store and --imgt-release.
+"""
+
+import argparse
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+from collections import Counter
+
+import pandas as pd
+
+from hla_typing_benchmark.nomenclature_cache import file_digest, load_table, save_table
+from hla_typing_benchmark.parse_data import (E_GROUP_PATH, Nomenclature, deleted_df_to_conversion_dict,
+                                             make_deleted_conversion_dict, make_g_group_dict, make_p_group_dict,
+                                             p_group_line_entries, parse_allele)
+
+
+P_GROUP_FILENAME = 'hla_nom_p.txt'
+G_GROUP_FILENAME = 'hla_nom_g.txt'
+DELETED_ALLELES_FILENAME = 'Deleted_alleles.txt'
+MANIFEST_FILENAME = 'release.json'
+TABLE_NAMES = ['deleted_conversion_dict', 'p_group_dict', 'g_group_dict']
+
+
+def release_sort_key(release):
+    #Sort numerically, so 3.9.0 comes before 3.10.0
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', release)]
+
+
+def read_lines(filepath):
+    with open(filepath, 'r') as infile:
+        return infile.readlines()
+
+
+# Incremental compilation
+
+def update_deleted_conversion_dict(base_dict, base_filepath, new_filepath):
+    """
+    Compile the deleted alleles dict of a new release from the dict of an earlier release.
+    IMGT only appends to Deleted_alleles.txt, so only the appended rows are parsed.
+    Returns (None, 0) if the rows of the earlier release have changed - then the dict has to be rebuilt.
+    """
+    #The comment lines hold the release version and date, so they are expected to differ
+    base_rows = [line for line in read_lines(base_filepath) if not line.startswith('#')]
+    new_rows = [line for line in read_lines(new_filepath) if not line.startswith('#')]
+
+    if new_rows[:len(base_rows)] != base_rows:
+        return None, 0
+
+    appended_rows = new_rows[len(base_rows):]
+    deleted_conversion_dict = dict(base_dict)
+
+    if appended_rows:
+        #Parse the appended rows with the header of the file
+        appended_df = pd.read_csv(io.StringIO(new_rows[0] + ''.join(appended_rows)), comment='#')
+        deleted_conversion_dict.update(deleted_df_to_conversion_dict(appended_df))
+
+    return deleted_conversion_dict, len(appended_rows)
+
+
+def line_patterns(alleles):
+    #Regex per gene matching lines, which may contain one of the alleles. None if an allele can't be parsed
+    fields_per_gene = {}
+
+    for allele in alleles:
+        parsed_allele = parse_allele(allele)
+        if parsed_allele is None:
+            return None
+
+        fields_per_gene.setdefault(parsed_allele.gene, set()).add(':'.join(parsed_allele.fields[:2]))
+
+    return {gene: re.compile('|'.join(re.escape(fields) for fields in sorted(fields))) for gene, fields in fields_per_gene.items()}
+
+
+def lines_containing(lines, alleles):
+    patterns = line_patterns(alleles)
+
+    if patterns is None:
+        return lines
+
+    return [line for line in lines if line.split('*')[0] in patterns and patterns[line.split('*')[0]].search(line)]
+
+
+def update_p_group_dict(base_dict, base_filepath, new_filepath, base_deleted_dict, new_deleted_dict):
+    """
+    Compile the P group dict of a new release from the dict of an earlier release.
+    Only lines, which differ between the releases or contain an allele renamed between the releases, are recompiled.
+    Returns the new dict and the number of recompiled lines. hla_nom_g.txt has the same format, so G groups are compiled the same way.
+    """
+    base_lines = read_lines(base_filepath)
+    new_lines = read_lines(new_filepath)
+
+    removed_lines = Counter(base_lines) - Counter(new_lines)
+    added_lines = Counter(new_lines) - Counter(base_lines)
+    changed_lines = list(removed_lines) + list(added_lines)
+
+    #Alleles, which are renamed differently in the two releases, change the entries of every line they appear on
+    renamed_alleles = {allele for allele in set(base_deleted_dict) | set(new_deleted_dict)
+                       if base_deleted_dict.get(allele) != new_deleted_dict.get(allele)}
+    changed_lines += lines_containing(new_lines, renamed_alleles)
+
+    #Keys, which were or will be set by any of the changed lines
+    affected_alleles = set()
+    for line in changed_lines:
+        affected_alleles.update(p_group_line_entries(line, base_deleted_dict))
+        affected_alleles.update(p_group_line_entries(line, new_deleted_dict))
+
+    p_group_dict = {allele: p_group for allele, p_group in base_dict.items() if allele not in affected_alleles}
+
+    if not affected_alleles:
+        return p_group_dict, len(changed_lines)
+
+    #Find the lines of the new release, which can set the affected keys - either directly or through a renamed allele
+    if None in affected_alleles:
+        candidate_lines = new_lines
+    else:
+        source_alleles = affected_alleles | {allele for allele, new_allele in new_deleted_dict.items() if new_allele in affected_alleles}
+        candidate_lines = lines_containing(new_lines, source_alleles)
+
+    #Lines are applied in file order, so the last line setting an allele is used - as in make_p_group_dict
+    for line in candidate_lines:
+        for allele, p_group in p_group_line_entries(line, new_deleted_dict).items():
+            if allele in affected_alleles:
+                p_group_dict[allele] = p_group
+
+    return p_group_dict, len(changed_lines) + len(candidate_lines)
+
+
+# Release store
+
+class ImgtReleaseStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def release_dir(self, release):
+        return os.path.join(self.store_dir, release)
+
+    def releases(self):
+        if not os.path.isdir(self.store_dir):
+            return []
+
+        releases = [entry for entry in os.listdir(self.store_dir) if os.path.isfile(os.path.join(self.store_dir, entry, MANIFEST_FILENAME))]
+
+        return sorted(releases, key=release_sort_key)
+
+    def latest_release(self):
+        releases = self.releases()
+
+        return releases[-1] if releases else None
+
+    def manifest(self, release):
+        with open(os.path.join(self.release_dir(release), MANIFEST_FILENAME), 'r') as infile:
+            return json.load(infile)
+
+    def load_tables(self, release):
+        return {table_name: load_table(os.path.join(self.release_dir(release), 'tables', table_name)) for table_name in TABLE_NAMES}
+
+    def add_release(self, release, p_group_filepath, deleted_filepath, g_group_filepath, base_release='latest'):
+        """
+        Add a release to the store and compile its tables. If base_release is given ('latest' is the newest release in the store),
+        the tables are compiled as a diff against that release.
+        """
+        if release in self.releases():
+            raise ValueError(f'Release {release} is already in the IMGT release store {self.store_dir}')
+
+        if base_release == 'latest':
+            base_release = self.latest_release()
+
+        #Build the release in a temporary folder, so a failed build never leaves a half compiled release behind
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=f'.{release}-', dir=self.store_dir)
+        os.chmod(tmp_dir, 0o755)
+
+        try:
+            new_p_group_filepath = os.path.join(tmp_dir, P_GROUP_FILENAME)
+            new_g_group_filepath = os.path.join(tmp_dir, G_GROUP_FILENAME)
+            new_deleted_filepath = os.path.join(tmp_dir, DELETED_ALLELES_FILENAME)
+            shutil.copyfile(p_group_filepath, new_p_group_filepath)
+            shutil.copyfile(g_group_filepath, new_g_group_filepath)
+            shutil.copyfile(deleted_filepath, new_deleted_filepath)
+
+            deleted_conversion_dict, deleted_rows_compiled = None, 0
+            p_group_dict, p_group_lines_compiled = None, 0
+            g_group_dict, g_group_lines_compiled = None, 0
+
+            #Releases added before the G groups were stored can't be used as a base
+            if base_release is not None and os.path.isfile(os.path.join(self.release_dir(base_release), G_GROUP_FILENAME)):
+                base_dir = self.release_dir(base_release)
+                base_tables = self.load_tables(base_release)
+
+                deleted_conversion_dict, deleted_rows_compiled = update_deleted_conversion_dict(base_tables['deleted_conversion_dict'],
+                                                                                                os.path.join(base_dir, DELETED_ALLELES_FILENAME),
+                                                                                                new_deleted_filepath)
+
+                if deleted_conversion_dict is not None:
+                    p_group_dict, p_group_lines_compiled = update_p_group_dict(base_tables['p_group_dict'],
+                                                                               os.path.join(base_dir, P_GROUP_FILENAME),
+                                                                               new_p_group_filepath,
+                                                                               base_tables['deleted_conversion_dict'],
+                                                                               deleted_conversion_dict)
+
+                    g_group_dict, g_group_lines_compiled = update_p_group_dict(base_tables['g_group_dict'],
+                                                                               os.path.join(base_dir, G_GROUP_FILENAME),
+                                                                               new_g_group_filepath,
+                                                                               base_tables['deleted_conversion_dict'],
+                                                                               deleted_conversion_dict)
+
+            #Full build, if there is no earlier release or it can't be used as a base
+            incremental = p_group_dict is not None
+
+            if not incremental:
+                deleted_conversion_dict = make_deleted_conversion_dict(new_deleted_filepath)
+                deleted_rows_compiled = len([line for line in read_lines(new_deleted_filepath) if not line.startswith('#')]) - 1
+                p_group_dict = make_p_group_dict(new_p_group_filepath, deleted_conversion_dict)
+                p_group_lines_compiled = len(read_lines(new_p_group_filepath))
+                g_group_dict = make_g_group_dict(new_g_group_filepath, deleted_conversion_dict)
+                g_group_lines_compiled = len(read_lines(new_g_group_filepath))
+
+            for table_name, table_dict in [('deleted_conversion_dict', deleted_conversion_dict), ('p_group_dict', p_group_dict), ('g_group_dict', g_group_dict)]:
+                table_dir = os.path.join(tmp_dir, 'tables', table_name)
+                os.makedirs(table_dir)
+                save_table(table_dict, table_dir)
+
+            manifest = {
+                'release': release,
+                'base_release': base_release if incremental else None,
+                'incremental': incremental,
+                'deleted_rows_compiled': deleted_rows_compiled,
+                'p_group_lines_compiled': p_group_lines_compiled,
+                'g_group_lines_compiled': g_group_lines_compiled,
+                'sources': {
+                    P_GROUP_FILENAME: file_digest(new_p_group_filepath),
+                    G_GROUP_FILENAME: file_digest(new_g_group_filepath),
+                    DELETED_ALLELES_FILENAME: file_digest(new_deleted_filepath),
+                },
+            }
+
+            with open(os.path.join(tmp_dir, MANIFEST_FILENAME), 'w') as outfile:
+                json.dump(manifest, outfile, indent=4)
+
+            os.rename(tmp_dir, self.release_dir(release))
+
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        return manifest
+
+    def nomenclature(self, release='latest', e_group_filepath=E_GROUP_PATH, cache_dir=None):
+        #Nomenclature pinned to a release, with its compiled tables already loaded. Only the pseudosequences aren't part of a release
+        if release == 'latest':
+            release = self.latest_release()
+
+        if release not in self.releases():
+            raise ValueError(f'Release {release} is not in the IMGT release store {self.store_dir}. Available releases: {self.releases()}')
+
+        if not os.path.isfile(os.path.join(self.release_dir(release), G_GROUP_FILENAME)):
+            raise ValueError(f'Release {release} in the IMGT release store {self.store_dir} has no G group table. Add it to the store again')
+
+        return Nomenclature(deleted_filepath=os.path.join(self.release_dir(release), DELETED_ALLELES_FILENAME),
+                            p_group_filepath=os.path.join(self.release_dir(release), P_GROUP_FILENAME),
+                            e_group_filepath=e_group_filepath,
+                            g_group_filepath=os.path.join(self.release_dir(release), G_GROUP_FILENAME),
+                            cache_dir=cache_dir,
+                            tables=self.load_tables(release))
+
+
+
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    store = ImgtReleaseStore(args.store)
+
+    if args.command == 'add':
+        base_release = None if args.full else args.base_release
+        manifest = store.add_release(args.release, args.p_group, args.deleted_alleles, args.g_group, base_release=base_release)
+        print(json.dumps(manifest, indent=4))
+
+    elif args.command == 'list':
+        for release in store.releases():
+            manifest = store.manifest(release)
+            print(f"{release}\tbase release: {manifest['base_release']}\tP group lines compiled: {manifest['p_group_lines_compiled']}\tG group lines compiled: {manifest.get('g_group_lines_compiled')}")
+
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--store',
+                        help='Folder with the IMGT release store',
+                        default='results/00_IMGT_reference/releases')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = subparsers.add_parser('add', help='Add a release to the store', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    add_parser.add_argument('--release',
+                            help='Name of the release, e.g. 3.55.0',
+                            required=True)
+
+    add_parser.add_argument('--p-group',
+                            help='hla_nom_p.txt of the release',
+                            default='results/00_IMGT_reference/hla_nom_p.txt')
+
+    add_parser.add_argument('--g-group',
+                            help='hla_nom_g.txt of the release',
+                            default='results/00_IMGT_reference/hla_nom_g.txt')
+
+    add_parser.add_argument('--deleted-alleles',
+                            help='Deleted_alleles.txt of the release',
+                            default='results/00_IMGT_reference/Deleted_alleles.txt')
+
+    add_parser.add_argument('--base-release',
+                            help="Release to compile the new release against ('latest' is the newest release in the store)",
+                            default='latest')
+
+    add_parser.add_argument('--full',
+                            help='Compile all tables from scratch instead of as a diff against an earlier release',
+                            action='store_true')
+
+    subparsers.add_parser('list', help='List the releases in the store')
+
+    return parser
+
+
+if __name__ == '__main__':
+    main()
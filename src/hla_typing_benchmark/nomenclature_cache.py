@@ -0,0 +1,99 @@
+"""
+Persistent on-disk cache for the derived nomenclature tables (deleted alleles, P groups and pseudosequences).
+
+Each table is stored as a compact table of three .npy arrays (keys, value codes and unique values), which is much faster
+to load than parsing the IMGT files again. The whole table is read into a dict, as the conversion looks up every allele in it.
+The cache entries are keyed by the content hash of the source files the table was derived from,
+so a table is rebuilt automatically when the IMGT files change.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+#Bump when the layout of the cache or the way the tables are derived changes
+CACHE_FORMAT_VERSION = 1
+
+#None can't be stored in a bytes array - it is written as an empty string, which is never a valid allele
+NONE_ENTRY = b''
+
+
+def file_digest(filepath, chunk_size=2**20):
+    digest = hashlib.sha256()
+
+    with open(filepath, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def table_cache_key(table_name, source_filepaths):
+    #The key depends on the content of every source file, not on paths or modification times
+    digest = hashlib.sha256(f'{table_name}:{CACHE_FORMAT_VERSION}'.encode())
+
+    for filepath in source_filepaths:
+        digest.update(file_digest(filepath).encode())
+
+    return f'{table_name}-{digest.hexdigest()[:20]}'
+
+
+def encode_entries(entries):
+    return np.array([NONE_ENTRY if entry is None else entry.encode() for entry in entries], dtype=bytes)
+
+
+def decode_entries(encoded_entries):
+    return [None if entry == '' else entry for entry in encoded_entries.astype(str).tolist()]
+
+
+def save_table(table_dict, table_dir):
+    #Values are stored once and referenced by code - many alleles share the same P group or pseudosequence
+    unique_values = list(dict.fromkeys(table_dict.values()))
+    value_codes = {value: code for code, value in enumerate(unique_values)}
+
+    np.save(os.path.join(table_dir, 'keys.npy'), encode_entries(table_dict.keys()))
+    np.save(os.path.join(table_dir, 'value_codes.npy'), np.array([value_codes[value] for value in table_dict.values()], dtype=np.int32))
+    np.save(os.path.join(table_dir, 'values.npy'), encode_entries(unique_values))
+
+
+def load_table(table_dir):
+    keys = np.load(os.path.join(table_dir, 'keys.npy'))
+    value_codes = np.load(os.path.join(table_dir, 'value_codes.npy'))
+    unique_values = decode_entries(np.load(os.path.join(table_dir, 'values.npy')))
+
+    return dict(zip(decode_entries(keys), [unique_values[code] for code in value_codes.tolist()]))
+
+
+def load_or_build_table(cache_dir, table_name, source_filepaths, builder):
+    """
+    Return the table from cache_dir if it was built from the same source files, otherwise build it with builder() and cache it.
+    """
+    cache_key = table_cache_key(table_name, source_filepaths)
+    table_dir = os.path.join(cache_dir, cache_key)
+
+    if os.path.isdir(table_dir):
+        return load_table(table_dir)
+
+    table_dict = builder()
+
+    #Write to a temporary directory first, so other processes never see a half written table
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=f'.{cache_key}-', dir=cache_dir)
+    os.chmod(tmp_dir, 0o755)
+
+    try:
+        save_table(table_dict, tmp_dir)
+        os.rename(tmp_dir, table_dir)
+    except OSError:
+        #Another process finished the same table first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    else:
+        #Remove entries built from older versions of the source files
+        for entry in os.listdir(cache_dir):
+            if entry.startswith(f'{table_name}-') and entry != cache_key:
+                shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+    return table_dict
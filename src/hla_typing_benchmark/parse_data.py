@@ -1,8 +1,23 @@
+import hashlib
+import numpy as np
+import os
 import pandas as pd
 import re
+import sys
+import threading
+from collections import namedtuple
+from functools import lru_cache
+
+from hla_typing_benchmark.nomenclature_cache import file_digest, load_or_build_table
+from hla_typing_benchmark.profiling import get_profiler
+
+#Default locations of the nomenclature tables (refers to output from Snakemake run)
+DELETED_ALLELES_PATH = 'results/00_IMGT_reference/Deleted_alleles.txt'
+P_GROUP_PATH = 'results/00_IMGT_reference/hla_nom_p.txt'
+E_GROUP_PATH = 'reference_data/classic.mhc_seqs.tsv'
+G_GROUP_PATH = 'results/00_IMGT_reference/hla_nom_g.txt'
+NOMENCLATURE_CACHE_DIR = 'results/00_IMGT_reference/cache'
 
-#Create dict for conversion of deleted alleles (see deleted_alleles notebook)
-deleted_df = pd.read_csv('results/00_IMGT_reference/Deleted_alleles.txt', comment='#')
 
 def extract_allele_from_description(description):
     two_field_finder = re.search(r"(A|B|C|DRB1|DQB1)\*\d{2,3}:\d{2,4}", description)
@@ -15,50 +30,84 @@ def extract_allele_from_description(description):
     return allele
 
 
-#Only include alleles, which follow 2010 naming convention and have a proper new name (not e.g. just named by an error)
-deleted_df = deleted_df[(deleted_df['Allele'].str.startswith(('A', 'B', 'C', 'DRB1', 'DQB1'))) & (~deleted_df['Allele'].str.startswith(('Cw')))]
-deleted_df['allele_new'] = deleted_df.apply(lambda x: extract_allele_from_description(x['Description']), axis=1)
-deleted_df = deleted_df[deleted_df['allele_new'] != '']
+#Create dict for conversion of deleted alleles (see deleted_alleles notebook)
+def make_deleted_conversion_dict(deleted_filepath=DELETED_ALLELES_PATH):
+    deleted_df = pd.read_csv(deleted_filepath, comment='#')
 
-#Add two field naming of deleted allele:
-deleted_df['allele_two_field'] = deleted_df.apply(lambda x: extract_allele_from_description(x['Allele']), axis=1)
+    return deleted_df_to_conversion_dict(deleted_df)
 
-#Only include alleles, that have a two field typing and where the two field typing differs from the new name
-deleted_df = deleted_df[(deleted_df['allele_two_field'] != deleted_df['allele_new']) & (deleted_df['allele_two_field'] != '')]
 
-#Ignore renaming of alleles in 3-field resolution, as the 1000G dataset and typing tools can't distinguish those
-deleted_df = deleted_df[[len(split) < 3 for split in deleted_df['Allele'].str.split(':')]]
+def deleted_df_to_conversion_dict(deleted_df):
+    #Only include alleles, which follow 2010 naming convention and have a proper new name (not e.g. just named by an error)
+    deleted_df = deleted_df[(deleted_df['Allele'].str.startswith(('A', 'B', 'C', 'DRB1', 'DQB1'))) & (~deleted_df['Allele'].str.startswith(('Cw')))]
+    deleted_df['allele_new'] = deleted_df['Description'].map(extract_allele_from_description)
+    deleted_df = deleted_df[deleted_df['allele_new'] != '']
 
-#Create dict for renaming
-deleted_df = deleted_df.set_index('allele_two_field')['allele_new']
+    #Add two field naming of deleted allele:
+    deleted_df['allele_two_field'] = deleted_df['Allele'].map(extract_allele_from_description)
 
-deleted_conversion_dict = deleted_df.to_dict()
+    #Only include alleles, that have a two field typing and where the two field typing differs from the new name
+    deleted_df = deleted_df[(deleted_df['allele_two_field'] != deleted_df['allele_new']) & (deleted_df['allele_two_field'] != '')]
 
+    #Ignore renaming of alleles in 3-field resolution, as the 1000G dataset and typing tools can't distinguish those
+    deleted_df = deleted_df[[len(split) < 3 for split in deleted_df['Allele'].str.split(':')]]
 
+    #Create dict for renaming
+    deleted_df = deleted_df.set_index('allele_two_field')['allele_new']
 
-#Function for converting an allele to one/two/three field resolution (disregarding any trailing letters - still unambiguous)
+    return deleted_df.to_dict()
+
+
+
+#Tokenizer for allele strings. The pattern is compiled once and every allele is only scanned once: 
+#the gene, up to four colon separated fields and any trailing expression/group letters (N, L, Q, G, P...) are captured in one pass.
 #For the genes A, B, C, DRB1 and DQB1 the first field always has two digits.
+ALLELE_TOKENIZER = re.compile(r"(A|B|C|DRB1|DQB1)\*(\d{2})(?::(\d{2,4}))?(?::(\d{2,4}))?(?::(\d{2,4}))?([A-Z]*)")
+
+#Number of distinct allele strings kept in the conversion caches
+ALLELE_CACHE_SIZE = 2**16
+
+#Structured, hashable representation of a parsed allele, e.g. A*02:01:01G -> Allele('A', ('02', '01', '01'), 'G')
+Allele = namedtuple('Allele', ['gene', 'fields', 'suffix'])
+
+
+@lru_cache(maxsize=ALLELE_CACHE_SIZE)
+def parse_allele(allele_string):
+    """
+    Parse an allele string into an Allele record. Returns None if no valid allele is found.
+    """
+    if allele_string is None:
+        return None
+
+    allele_finder = ALLELE_TOKENIZER.search(allele_string)
+
+    if allele_finder is None:
+        return None
+
+    gene, *fields, suffix = allele_finder.groups()
+
+    return Allele(gene, tuple(field for field in fields if field is not None), suffix)
+
+
+def format_allele(allele, n_fields):
+    #Returns None if the allele doesn't have the requested number of fields
+    if allele is None or len(allele.fields) < n_fields:
+        return None
+
+    return allele.gene + "*" + ":".join(allele.fields[:n_fields])
+
+
+#Function for converting an allele to one/two/three field resolution (disregarding any trailing letters - still unambiguous)
 
 def convert_to_one_field(allele_high_res):
-    import re
-    one_field_finder = re.search(r"(A|B|C|DRB1|DQB1)\*\d{2}", allele_high_res)
-    
-    if one_field_finder != None:
-        one_field_finder = one_field_finder.group(0)
-    else:
-        one_field_finder = None
-    
-    return one_field_finder    
+    return format_allele(parse_allele(allele_high_res), 1)
 
     
-def convert_to_two_field(allele_high_res):
-    import re
-    two_field_finder = re.search(r"(A|B|C|DRB1|DQB1)\*\d{2}:\d{2,4}", allele_high_res)
-    
-    if two_field_finder != None:
-        allele_two_field = two_field_finder.group(0)
-    else:
-        allele_two_field = None
+def convert_to_two_field(allele_high_res, deleted_conversion_dict=None):
+    if deleted_conversion_dict is None:
+        deleted_conversion_dict = get_nomenclature().deleted_conversion_dict
+
+    allele_two_field = format_allele(parse_allele(allele_high_res), 2)
     
     #Finally, update the alleles, which have been changed/renamed            
     if allele_two_field in deleted_conversion_dict:
@@ -66,15 +115,13 @@ def convert_to_two_field(allele_high_res):
 
     return allele_two_field    
 
-def convert_to_three_field(allele_high_res):
-    six_field_finder = re.search(r"(A|B|C|DRB1|DQB1)\*\d{2}:\d{2,4}:\d{2,4}", allele_high_res)
+def convert_to_three_field(allele_high_res, deleted_conversion_dict=None):
+    allele_three_field = format_allele(parse_allele(allele_high_res), 3)
     
-    if six_field_finder != None:
-        allele_six_field = six_field_finder.group(0)
-    else:
-        allele_six_field = convert_to_two_field(allele_high_res)            
+    if allele_three_field is None:
+        allele_three_field = convert_to_two_field(allele_high_res, deleted_conversion_dict)            
     
-    return allele_six_field    
+    return allele_three_field    
 
 
 # Conversion to P-group and pseudosequence resolution
@@ -85,65 +132,80 @@ def convert_to_three_field(allele_high_res):
 # Synonymous mutations are not grouped in G group, and these null alleles - even though they should be belong to a P group-
 # are not grouped.
 
-def make_p_group_dict(p_group_filepath='results/00_IMGT_reference/hla_nom_p.txt'):
+def p_group_line_entries(line, deleted_conversion_dict=None):
+    #Entries {allele_in : allele_converted_to_p_group...} from a single line of hla_nom_p.txt
+    p_group_entries = dict()
+            
+    #If allele doesn't belong to a P group, add it to dict as key and value
+    if ('/' not in line) and (line[0] != '#'):
+        gene = line.split('*')[0]
+        
+        #Only register the valid alleles:
+        if gene in ['A', 'B', 'C', 'DRB1', 'DQB1']:
+            p_group_entry = convert_to_two_field(gene + "*" + line.split(';')[-2], deleted_conversion_dict)
+            
+            p_group_entries[p_group_entry] = p_group_entry
+            
+    
+    #If several alleles map to the same one, they are separated by a "/" - this indicates a P group
+    if ('/' in line) and (line[0] != '#'):
+        gene = line.split('*')[0]
+        
+        #Only register the valid alleles:
+        if gene in ['A', 'B', 'C', 'DRB1', 'DQB1']:
+                    
+            #Find the four field, P group resolution. The P group is found at the end of the line.
+            p_group_full = gene + "*" + line.split(';')[-1][:-1]
+            p_group_two_field = convert_to_two_field(p_group_full, deleted_conversion_dict)
+        
+            #Read the rest of the alleles and clean up the front and end part
+            synonymous_alleles = line.split('/')
+            synonymous_alleles[0] = synonymous_alleles[0].split(';')[1]
+            synonymous_alleles[-1] = synonymous_alleles[-1].split(';')[0]
+            
+
+            #Convert all alleles to four field resolution
+            for i in range(len(synonymous_alleles)):
+                synonymous_alleles[i] = gene + "*" + synonymous_alleles[i]
+                synonymous_alleles[i] = convert_to_two_field(synonymous_alleles[i], deleted_conversion_dict)
+
+            #Remove duplicates when converting to four field:
+            synonymous_allels_unique_two_field = list(set(synonymous_alleles))
+            
+            #Add key in dict for each of the unique entries:
+            for synonymous_allele in synonymous_allels_unique_two_field:
+                                        
+                p_group_entries[synonymous_allele] = p_group_two_field
+
+    return p_group_entries
+
+
+def make_p_group_dict(p_group_filepath=P_GROUP_PATH, deleted_conversion_dict=None):
     #Dict with the structure: {allele_in : allele_converted_to_p_group...}
     p_group_dict = dict()
 
-    #Read the important results:
+    #Read the important results. If an allele is found on several lines, the last line is used
     with open(p_group_filepath, 'r') as infile:
         for line in infile:
-            
-            #If allele doesn't belong to a P group, add it to dict as key and value
-            if ('/' not in line) and (line[0] != '#'):
-                gene = line.split('*')[0]
-                
-                #Only register the valid alleles:
-                if gene in ['A', 'B', 'C', 'DRB1', 'DQB1']:
-                    p_group_entry = convert_to_two_field(gene + "*" + line.split(';')[-2])
-                    
-                    p_group_dict[p_group_entry] = p_group_entry
-                    
-            
-            #If several alleles map to the same one, they are separated by a "/" - this indicates a P group
-            if ('/' in line) and (line[0] != '#'):
-                gene = line.split('*')[0]
-                
-                #Only register the valid alleles:
-                if gene in ['A', 'B', 'C', 'DRB1', 'DQB1']:
-                            
-                    #Find the four field, P group resolution. The P group is found at the end of the line.
-                    p_group_full = gene + "*" + line.split(';')[-1][:-1]
-                    p_group_two_field = convert_to_two_field(p_group_full)
-                
-                    #Read the rest of the alleles and clean up the front and end part
-                    synonymous_alleles = line.split('/')
-                    synonymous_alleles[0] = synonymous_alleles[0].split(';')[1]
-                    synonymous_alleles[-1] = synonymous_alleles[-1].split(';')[0]
-                    
+            p_group_dict.update(p_group_line_entries(line, deleted_conversion_dict))
 
-                    #Convert all alleles to four field resolution
-                    for i in range(len(synonymous_alleles)):
-                        synonymous_alleles[i] = gene + "*" + synonymous_alleles[i]
-                        synonymous_alleles[i] = convert_to_two_field(synonymous_alleles[i])
+    return p_group_dict
 
-                    #Remove duplicates when converting to four field:
-                    synonymous_allels_unique_two_field = list(set(synonymous_alleles))
-                    
-                    #Add key in dict for each of the unique entries:
-                    for synonymous_allele in synonymous_allels_unique_two_field:
-                                                
-                        p_group_dict[synonymous_allele] = convert_to_two_field(p_group_full)
 
-    return p_group_dict
+#hla_nom_g.txt has the same format as hla_nom_p.txt, so G groups are found the same way as P groups:
+#two field alleles are mapped to the two field name of their G group.
+def make_g_group_dict(g_group_filepath=G_GROUP_PATH, deleted_conversion_dict=None):
+    return make_p_group_dict(g_group_filepath, deleted_conversion_dict)
 
 
 #Make P type conversion function using p_group_dict
-def convert_to_p_group(allele, p_group_dict=''):
+#The deleted alleles dict has to belong to the same nomenclature as the P group dict (the global one by default)
+def convert_to_p_group(allele, p_group_dict='', deleted_conversion_dict=None):
     if p_group_dict == '':
-        p_group_dict = make_p_group_dict()
+        p_group_dict = get_nomenclature().p_group_dict
 
     #Start by converting to two field:
-    allele_two_field = convert_to_two_field(allele)
+    allele_two_field = convert_to_two_field(allele, deleted_conversion_dict)
     
     #Find corresponding P-type if it exists. 
     if allele_two_field in p_group_dict:
@@ -159,29 +221,47 @@ def convert_to_p_group(allele, p_group_dict=''):
 
 
 
+#Stream the pseudosequence table and only keep the rows of the requested loci.
+#Only the allele and mhc_seq columns are split out, and all other species are skipped before the line is split.
+#Identical pseudosequences are interned, so alleles sharing a sequence also share one string in memory.
+def read_pseudosequences(e_group_filepath=E_GROUP_PATH, hla_loci=('HLA-A', 'HLA-B', 'HLA-C', 'HLA-DRB1', 'HLA-DQB1')):
+    hla_loci = tuple(hla_loci)
+
+    with open(e_group_filepath, 'r') as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+        allele_column = header.index('allele')
+        mhc_seq_column = header.index('mhc_seq')
+        n_splits = max(allele_column, mhc_seq_column) + 1
+
+        for line in infile:
+            if 'HLA-' not in line:
+                continue
+
+            columns = line.rstrip('\n').split('\t', n_splits)
+            allele = columns[allele_column]
+
+            if allele.startswith(hla_loci):
+                yield allele.replace('HLA-', ''), sys.intern(columns[mhc_seq_column])
+
+
 #Make dict for evaxion-group conversion
-def make_e_group_dict(e_group_filepath='reference_data/classic.mhc_seqs.tsv'):
-    hla_loci = ['HLA-A', 'HLA-B', 'HLA-C', 'HLA-DRB1', 'HLA-DQB1']
-
-    mhc_pseudo_df = pd.read_csv(e_group_filepath, sep='\t')[['allele', 'mhc_seq']]
-    mhc_pseudo_df = mhc_pseudo_df[mhc_pseudo_df['allele'].str.startswith(tuple(hla_loci))]
-    mhc_pseudo_df['allele'] = mhc_pseudo_df['allele'].str.replace('HLA-', '')
-    mhc_pseudo_df = mhc_pseudo_df.set_index('allele')
-    e_group_dict = mhc_pseudo_df['mhc_seq'].to_dict()
+def make_e_group_dict(e_group_filepath=E_GROUP_PATH):
+    #If an allele is listed more than once, the last entry is used
+    e_group_dict = dict(read_pseudosequences(e_group_filepath))
     
     return e_group_dict
             
 
 
 #Function for converting to e-group resolution:
-def convert_to_e_group(allele, e_group_dict='', p_group_dict=''):
+def convert_to_e_group(allele, e_group_dict='', p_group_dict='', deleted_conversion_dict=None):
     if e_group_dict == '':
-        e_group_dict = make_e_group_dict()
+        e_group_dict = get_nomenclature().e_group_dict
     if p_group_dict == '':
-        p_group_dict = make_p_group_dict()
+        p_group_dict = get_nomenclature().p_group_dict
 
     #Start by converting to P group:
-    allele_p_group = convert_to_p_group(allele, p_group_dict)
+    allele_p_group = convert_to_p_group(allele, p_group_dict, deleted_conversion_dict)
     
     #Find corresponding e-type if it exists
     if allele_p_group in e_group_dict:
@@ -195,3 +275,378 @@ def convert_to_e_group(allele, e_group_dict='', p_group_dict=''):
         
     return allele_e_group
 
+
+# Resolution registry
+
+# A resolution is either derived directly from the allele string (convert), 
+# or is a lookup table (a nomenclature table) applied to another resolution (base), falling back to the base allele
+# if it isn't found in the table - as for P groups and pseudosequences.
+Resolution = namedtuple('Resolution', ['name', 'label', 'convert', 'base', 'table'])
+
+#Registered resolutions in the order they are scored and reported
+RESOLUTIONS = dict()
+
+
+def register_resolution(name, label, convert=None, base=None, table=None):
+    """
+    Register a resolution, which alleles can be converted to and scored at.
+
+    input:
+    name (str):    name used in the code, e.g. 'p_group'
+    label (str):   name used in the results, e.g. 'P group'
+    convert:       function (allele, nomenclature) -> converted allele. Used for resolutions derived from the allele itself
+    base (str):    resolution the lookup table is applied to
+    table (str):   name of the Nomenclature table used as lookup table, e.g. 'p_group_dict'
+    """
+    if (convert is None) == (table is None):
+        raise ValueError('A resolution needs either a convert function or a base resolution and a lookup table')
+    if table is not None and base not in RESOLUTIONS:
+        raise ValueError(f'Unknown base resolution for {name}: {base}')
+
+    RESOLUTIONS[name] = Resolution(name, label, convert, base, table)
+
+
+register_resolution('one_field', '1-field', convert=lambda allele, nomenclature: convert_to_one_field(allele))
+register_resolution('two_field', '2-field', convert=lambda allele, nomenclature: convert_to_two_field(allele, nomenclature.deleted_conversion_dict))
+register_resolution('p_group', 'P group', base='two_field', table='p_group_dict')
+register_resolution('e_group', 'pseudosequence', base='p_group', table='e_group_dict')
+register_resolution('g_group', 'G group', base='two_field', table='g_group_dict')
+register_resolution('three_field', '3-field', convert=lambda allele, nomenclature: convert_to_three_field(allele, nomenclature.deleted_conversion_dict))
+
+#Resolutions reported in the original benchmark
+DEFAULT_RESOLUTIONS = ['one_field', 'e_group', 'p_group', 'two_field']
+
+
+def all_resolutions():
+    #All registered resolutions, starting with the original four in their usual order
+    return DEFAULT_RESOLUTIONS + [resolution for resolution in RESOLUTIONS if resolution not in DEFAULT_RESOLUTIONS]
+
+
+def check_resolutions(resolutions):
+    unknown_resolutions = [resolution for resolution in resolutions if resolution not in RESOLUTIONS]
+    if unknown_resolutions:
+        raise ValueError(f'Unknown resolution(s): {unknown_resolutions}. Choose from {list(RESOLUTIONS)}')
+
+
+# Memoized conversion
+
+class AlleleConverter:
+    """
+    Bounded, memoized conversion of allele strings to the registered resolutions.
+    Each distinct allele string is only parsed once, and every (allele, resolution) pair is only converted once.
+    The cache statistics can be followed through cache_info() and hit_rate().
+    """
+
+    def __init__(self, nomenclature=None, maxsize=ALLELE_CACHE_SIZE):
+        self.nomenclature = nomenclature
+        self.convert = lru_cache(maxsize=maxsize)(self._convert)
+
+    def _convert(self, allele, resolution='two_field'):
+        nomenclature = self.nomenclature if self.nomenclature is not None else get_nomenclature()
+        resolution = RESOLUTIONS[resolution]
+
+        if resolution.table is None:
+            return resolution.convert(allele, nomenclature)
+
+        #Fall back to the base resolution if the allele isn't found in the lookup table
+        base_allele = self.convert(allele, resolution.base)
+        lookup_table = nomenclature.table(resolution.table)
+
+        return lookup_table.get(base_allele, base_allele)
+
+    def resolve(self, allele, resolutions=None):
+        #All (or the given) resolutions of an allele
+        if resolutions is None:
+            resolutions = RESOLUTIONS
+
+        return {resolution: self.convert(allele, resolution) for resolution in resolutions}
+
+    def cache_info(self):
+        return self.convert.cache_info()
+
+    def hit_rate(self):
+        cache_info = self.convert.cache_info()
+        lookups = cache_info.hits + cache_info.misses
+
+        return cache_info.hits / lookups if lookups else 0.0
+
+
+# Integer interned alleles
+
+#ID used for missing alleles (None) in the allele vocabulary and at every resolution
+NO_ALLELE_ID = 0
+
+
+class AlleleVocabulary:
+    """
+    Maps every allele string to a dense integer ID.
+    For each resolution, mapping(resolution) is a NumPy array from allele ID to the ID of the converted allele
+    in the label vocabulary of that resolution, so a whole cohort is converted with e.g. mapping('p_group')[allele_ids]
+    and alleles can be compared as integers. The arrays are extended on demand, when new alleles have been encoded.
+    """
+
+    def __init__(self, nomenclature=None):
+        self.nomenclature = nomenclature
+
+        self.alleles = [None]
+        self.allele_ids = {None: NO_ALLELE_ID}
+
+        #Label vocabularies and mapping arrays are created the first time a resolution is used
+        self.labels = {}
+        self.label_ids = {}
+        self._mappings = {}
+
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.alleles)
+
+    def encode(self, alleles):
+        #Returns an array of allele IDs. Alleles, which haven't been seen before, are added to the vocabulary
+        codes, unique_alleles = pd.factorize(np.asarray(alleles, dtype=object))
+
+        with self._lock:
+            for allele in unique_alleles:
+                if allele not in self.allele_ids:
+                    self.allele_ids[allele] = len(self.alleles)
+                    self.alleles.append(allele)
+
+            #Missing values get code -1, which picks the last entry
+            unique_ids = np.array([self.allele_ids[allele] for allele in unique_alleles] + [NO_ALLELE_ID], dtype=np.int32)
+
+        return unique_ids[codes]
+
+    def decode(self, allele_ids):
+        return np.array(self.alleles, dtype=object)[allele_ids]
+
+    def mapping(self, resolution):
+        check_resolutions([resolution])
+
+        with self._lock:
+            if resolution not in self._mappings:
+                self.labels[resolution] = [None]
+                self.label_ids[resolution] = {None: NO_ALLELE_ID}
+                self._mappings[resolution] = np.zeros(1, dtype=np.int32)
+
+            mapping = self._mappings[resolution]
+
+            #Only convert the alleles added since the array was last extended
+            if len(mapping) < len(self.alleles):
+                converted_alleles = convert_many(self.alleles[len(mapping):], [resolution], self.nomenclature)[resolution]
+
+                labels = self.labels[resolution]
+                label_ids = self.label_ids[resolution]
+                new_label_ids = []
+
+                for label in converted_alleles:
+                    if label not in label_ids:
+                        label_ids[label] = len(labels)
+                        labels.append(label)
+                    new_label_ids.append(label_ids[label])
+
+                mapping = np.concatenate([mapping, np.array(new_label_ids, dtype=np.int32)])
+                self._mappings[resolution] = mapping
+
+        return mapping
+
+    def convert(self, allele_ids, resolution='two_field'):
+        return self.mapping(resolution)[allele_ids]
+
+    def decode_labels(self, label_ids, resolution='two_field'):
+        return np.array(self.labels[resolution], dtype=object)[label_ids]
+
+
+# Lazily loaded nomenclature tables
+
+class Nomenclature:
+    """
+    Holds the nomenclature tables (deleted alleles, P groups and pseudosequences).
+    Nothing is read when the object is created - each table is loaded the first time it is used,
+    so a stage only pays for the tables it actually needs. Loading is thread-safe.
+    If cache_dir is given, the tables are stored there and reused until the source files change.
+    Tables, which have already been compiled elsewhere (e.g. in an IMGT release store), can be passed through tables.
+    """
+
+    def __init__(self, deleted_filepath=DELETED_ALLELES_PATH, p_group_filepath=P_GROUP_PATH, e_group_filepath=E_GROUP_PATH,
+                 cache_dir=None, tables=None, g_group_filepath=G_GROUP_PATH):
+        self.deleted_filepath = deleted_filepath
+        self.p_group_filepath = p_group_filepath
+        self.e_group_filepath = e_group_filepath
+        self.g_group_filepath = g_group_filepath
+        self.cache_dir = cache_dir
+
+        #Reentrant, as building the P group dict needs the deleted alleles dict
+        self._lock = threading.RLock()
+        self._tables = dict(tables) if tables is not None else {}
+        self._converter = None
+        self._vocabulary = None
+        self._version = None
+
+    def _get_table(self, name, loader, source_filepaths):
+        #Double-checked so the lock is only taken while a table is still missing
+        if name not in self._tables:
+            with self._lock:
+                if name not in self._tables:
+                    with get_profiler().stage(f'load tables/{name}'):
+                        if self.cache_dir is None:
+                            self._tables[name] = loader()
+                        else:
+                            self._tables[name] = load_or_build_table(self.cache_dir, name, source_filepaths, loader)
+
+        return self._tables[name]
+
+    def is_loaded(self, name):
+        return name in self._tables
+
+    @property
+    def deleted_conversion_dict(self):
+        return self._get_table('deleted_conversion_dict', lambda: make_deleted_conversion_dict(self.deleted_filepath),
+                               [self.deleted_filepath])
+
+    @property
+    def p_group_dict(self):
+        return self._get_table('p_group_dict', lambda: make_p_group_dict(self.p_group_filepath, self.deleted_conversion_dict),
+                               [self.p_group_filepath, self.deleted_filepath])
+
+    @property
+    def e_group_dict(self):
+        return self._get_table('e_group_dict', lambda: make_e_group_dict(self.e_group_filepath),
+                               [self.e_group_filepath])
+
+    @property
+    def g_group_dict(self):
+        return self._get_table('g_group_dict', lambda: make_g_group_dict(self.g_group_filepath, self.deleted_conversion_dict),
+                               [self.g_group_filepath, self.deleted_filepath])
+
+    def table(self, name):
+        #Lookup table used by a registered resolution
+        return getattr(self, name)
+
+    @property
+    def converter(self):
+        if self._converter is None:
+            with self._lock:
+                if self._converter is None:
+                    self._converter = AlleleConverter(self)
+
+        return self._converter
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            with self._lock:
+                if self._vocabulary is None:
+                    self._vocabulary = AlleleVocabulary(self)
+
+        return self._vocabulary
+
+    def version(self):
+        #Fingerprint of the source files - it changes whenever one of the tables could change
+        if self._version is None:
+            digest = hashlib.sha256()
+
+            for filepath in [self.deleted_filepath, self.p_group_filepath, self.e_group_filepath, self.g_group_filepath]:
+                digest.update((file_digest(filepath) if os.path.exists(filepath) else 'missing').encode())
+
+            self._version = digest.hexdigest()[:20]
+
+        return self._version
+
+
+#Nomenclature used when no tables are passed explicitly. Set the paths with configure_nomenclature
+_default_nomenclature = Nomenclature()
+
+
+def get_nomenclature():
+    return _default_nomenclature
+
+
+def set_nomenclature(nomenclature):
+    global _default_nomenclature
+    _default_nomenclature = nomenclature
+
+    return _default_nomenclature
+
+
+def configure_nomenclature(deleted_filepath=DELETED_ALLELES_PATH, p_group_filepath=P_GROUP_PATH, e_group_filepath=E_GROUP_PATH, cache_dir=None,
+                           g_group_filepath=G_GROUP_PATH):
+    global _default_nomenclature
+    _default_nomenclature = Nomenclature(deleted_filepath=deleted_filepath,
+                                         p_group_filepath=p_group_filepath,
+                                         e_group_filepath=e_group_filepath,
+                                         g_group_filepath=g_group_filepath,
+                                         cache_dir=cache_dir)
+
+    return _default_nomenclature
+
+
+# Batch conversion
+
+def lookup_with_fallback(alleles, conversion_dict):
+    #Same as conversion_dict.get(allele, allele) for every allele, but done on the whole column
+    converted = alleles.map(conversion_dict)
+
+    return converted.where(alleles.isin(list(conversion_dict)), alleles)
+
+
+def convert_many(alleles, resolutions=('two_field',), nomenclature=None):
+    """
+    Convert many alleles to several resolutions in one pass.
+
+    input:
+    alleles:      list, NumPy array or pandas Series of allele strings
+    resolutions:  registered resolutions to return (see RESOLUTIONS)
+
+    output:
+    DataFrame with one column per resolution and one row per input allele (the index of a Series is kept).
+    Alleles which can't be converted are None, as for the single allele functions.
+    """
+    check_resolutions(resolutions)
+
+    if nomenclature is None:
+        nomenclature = get_nomenclature()
+
+    index = alleles.index if isinstance(alleles, pd.Series) else None
+
+    #Only convert every distinct allele once. Missing values get code -1
+    codes, unique_alleles = pd.factorize(np.asarray(alleles, dtype=object))
+    unique_alleles = pd.Series(unique_alleles, dtype=object)
+
+    #Tokenize all alleles at once: gene, four fields and suffix
+    tokens = unique_alleles.str.extract(ALLELE_TOKENIZER)
+    allele_prefix = tokens[0] + '*' + tokens[1]
+    two_field = allele_prefix + ':' + tokens[2]
+
+    converted = pd.DataFrame(index=unique_alleles.index)
+
+    def add_column(resolution):
+        if resolution in converted:
+            return
+
+        if resolution == 'one_field':
+            converted[resolution] = allele_prefix
+        elif resolution == 'two_field':
+            converted[resolution] = lookup_with_fallback(two_field, nomenclature.deleted_conversion_dict)
+        elif resolution == 'three_field':
+            add_column('two_field')
+            converted[resolution] = (two_field + ':' + tokens[3]).fillna(converted['two_field'])
+
+        #Lookup table on top of another resolution
+        elif RESOLUTIONS[resolution].table is not None:
+            add_column(RESOLUTIONS[resolution].base)
+            converted[resolution] = lookup_with_fallback(converted[RESOLUTIONS[resolution].base], nomenclature.table(RESOLUTIONS[resolution].table))
+
+        #Other resolutions derived from the allele string
+        else:
+            converted[resolution] = unique_alleles.map(lambda allele: RESOLUTIONS[resolution].convert(allele, nomenclature))
+
+    for resolution in resolutions:
+        add_column(resolution)
+
+    converted = converted[list(resolutions)].astype(object)
+    converted = converted.where(converted.notna(), None)
+
+    #Add a row of None at the end, so missing input values (code -1) map to None
+    converted_values = np.vstack([converted.to_numpy(), np.full((1, len(resolutions)), None, dtype=object)])
+
+    return pd.DataFrame(converted_values[codes], columns=list(resolutions), index=index, dtype=object)
@@ -1,22 +1,21 @@
 import os
 import pandas as pd
-import numpy as np
-import sys
-import re
 import yaml
 from yaml.loader import SafeLoader
 import argparse
 import json
-import pickle
-import matplotlib.pyplot as plt
-from collections import Counter
+import gzip
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from hla_typing_benchmark.parse_data import *
-
-
-#Load resolution conversion dicts globally to avoid loading them every time convert_allele is called
-p_group_dict = make_p_group_dict()
-e_group_dict = make_e_group_dict()
+from hla_typing_benchmark.concordance import calls_to_long, score_calls, summarise_scores
+from hla_typing_benchmark.gold_standard_table import as_gold_standard_table, load_gold_standard
+from hla_typing_benchmark.evaluation_cache import EvaluationCache, score_key
+from hla_typing_benchmark.imgt_release_store import ImgtReleaseStore
+from hla_typing_benchmark.partial_results import find_partials, make_partial, merge_partials, read_partial, write_partial
+from hla_typing_benchmark.profiling import get_profiler, start_profiling
+from hla_typing_benchmark.tool_parsers import TOOL_FORMATS, parse_tool_file
 
 
 def flatten(a):
@@ -31,17 +30,9 @@ def convert_allele(allele, resolution = 'two_field'):
     resolution:   the resolution, with which the allele is converted to
 
     """
-    if resolution == 'one_field':
-        converted_allele = convert_to_one_field(allele)
-    
-    elif resolution == 'two_field':
-        converted_allele = convert_to_two_field(allele)
-        
-    elif resolution == 'p_group':
-        converted_allele = convert_to_p_group(allele, p_group_dict=p_group_dict)
-    
-    elif resolution == 'e_group':
-        converted_allele = convert_to_e_group(allele, e_group_dict=e_group_dict, p_group_dict=p_group_dict)
+    if resolution in RESOLUTIONS:
+        #The conversion tables are loaded on first use and every allele string is only converted once
+        converted_allele = get_nomenclature().converter.convert(allele, resolution)
             
     else:
         print('A conversion mistake happend. Please specify a correct conversion type.')
@@ -61,172 +52,161 @@ def find_tool_results(tool_resultpath, result_extension = '_result.tsv'):
     return tool_files
 
 
-def load_kourami_results(kourami_result_filepath):
+def load_sample_ids(config_path = 'snakemake/config.yaml'):
+    #Load list of gold standard samples throug the config
+    with open(config_path, 'r') as f:
+        config = yaml.load(f, Loader=SafeLoader)
 
-    kourami_files = find_tool_results(kourami_result_filepath)
+    return list(config['sample_urls'].keys())
 
-    #Initalize result dict for single guess and for multiple typing
-    kourami_results = {}
 
-    for filename in kourami_files:
-        subject_id = filename.split('/')[-1].replace('_result.tsv', '')
+def find_manifest_results(tool, tool_resultpath, sample_ids):
+    """
+    Find the result files of a tool from the sample list and the tool's output path pattern, without walking the result folder.
+    Missing and empty outputs are reported. Empty outputs are still returned, as they count as samples without a call.
+    """
+    tool_files = []
+    missing_samples = []
+    empty_samples = []
 
-        #If file is not empty:
-        if os.stat(filename).st_size != 0:
-            temp_result_dict = {}    
+    for sample_id in sample_ids:
+        filename = os.path.join(tool_resultpath, TOOL_FORMATS[tool].output_pattern.format(sample_id=sample_id))
 
-            with open(filename, 'r') as infile:
-                for line in infile:
-                    #Find the first match / allele prediction
-                    allele_searcher = re.search(r'(A|B|C|DRB1|DQB1)\*\d{2}:\d{2,3}:?\d{0,3}G?:?\d{0,3}', line)
-                                            
-                    if allele_searcher is not None:                        
-                        found_allele = allele_searcher.group(0)
-                        
-                        gene = re.search(r'(A|B|C|DRB1|DQB1)', found_allele).group(0)
-                        
-                        #Convert alleles to right resolution:
-                        pred_converted = convert_allele(found_allele)
-
-                        if pred_converted != convert_to_two_field(found_allele):
-                            print(filename)
-
-                        #Add to list of predictions for this sample
-                        if gene not in temp_result_dict.keys():
-                            temp_result_dict[gene] = [[pred_converted]]
-                        else:
-                            temp_result_dict[gene] += [[pred_converted]]
-
-            #Add sample prediction to dict
-            kourami_results[subject_id] = temp_result_dict
-            
-        #If file is empty, add an empty dict.
-        else:
-            kourami_results[subject_id] = {}
-            #print(f'Kourami: No prediction made for {filename} ')                           
-                
-    return kourami_results
+        try:
+            file_size = os.stat(filename).st_size
+        except FileNotFoundError:
+            missing_samples.append(sample_id)
+            continue
 
+        if file_size == 0:
+            empty_samples.append(sample_id)
 
-def load_hla_la_results(hla_la_result_filepath):
+        tool_files.append(filename)
 
-    hla_la_files = find_tool_results(hla_la_result_filepath, 'R1_bestguess_G.txt')
-    hla_la_results = {}
+    if missing_samples:
+        print(f"{tool}: {len(missing_samples)} of {len(sample_ids)} samples have no output: {', '.join(missing_samples)}")
 
-    for filename in hla_la_files:
-        subject_id = filename.split('/')[2]
-        temp_results_object = pd.read_csv(filename, sep = '\t')['Allele']
-        temp_results = [i for i in temp_results_object if i.startswith(('A', 'B', 'C', 'DRB1', 'DQB1'))]
-        
-        #Make dict of dicts for results:
-        temp_result_dict = {}
-        
-        for pred in temp_results:
-            gene = re.search(r'(A|B|C|DRB1|DQB1)', pred).group(0)
-            
-            pred_converted = convert_allele(pred)
-            #pred_converted = pred          
-            
-            #Add to list of predictions for this sample
-            if gene not in temp_result_dict.keys():
-                temp_result_dict[gene] = [[pred_converted]]
-            else:
-                temp_result_dict[gene] += [[pred_converted]]
+    if empty_samples:
+        print(f"{tool}: {len(empty_samples)} of {len(sample_ids)} samples have an empty output: {', '.join(empty_samples)}")
 
-        hla_la_results[subject_id] = temp_result_dict
+    return tool_files
 
-    return hla_la_results
 
+def discover_tool_results(tool, tool_resultpath, sample_ids = None):
+    #Walk the result folder only if no sample list is given
+    if sample_ids is None:
+        return find_tool_results(tool_resultpath, TOOL_FORMATS[tool].result_extension)
 
-def load_optitype_results(optitype_result_filepath):
+    return find_manifest_results(tool, tool_resultpath, sample_ids)
 
-    optitype_files = find_tool_results(optitype_result_filepath)        
-    optitype_results = {}
 
-    for filename in optitype_files:
-        subject_id = filename.split('/')[-1].replace('_result.tsv', '')
-        
-        #Check for right file, and that the file is not empty
-        if os.stat(filename).st_size != 0:
-            temp_results_raw = list(pd.read_csv(filename, sep = '\t').iloc[0])[1:7]
+def shard_sample_ids(sample_ids, shard):
+    #Shard 'I/N' holds every N-th sample, starting with sample I (1-based)
+    shard_index, n_shards = [int(x) for x in shard.split('/')]
 
-            temp_results = [i for i in temp_results_raw if isinstance(i,str)]
-    
-            #Make dict of dicts for results:
-            temp_result_dict = {}
-            
-            for pred in temp_results:
-                gene = re.search(r'(A|B|C|DRB1|DQB1)', pred).group(0)
-                
-                pred_converted = convert_allele(pred)
-                #pred_converted = pred
-                
-                #Add to list of predictions for this sample
-                if gene not in temp_result_dict.keys():
-                    temp_result_dict[gene] = [[pred_converted]]
-                else:
-                    temp_result_dict[gene] += [[pred_converted]]
-        
-            optitype_results[subject_id] = temp_result_dict
-    
-        #Add empty entry for empty file
-        else:
-            optitype_results[subject_id] = {}
-            
-    return optitype_results
+    if not 1 <= shard_index <= n_shards:
+        raise ValueError(f'Shard {shard} does not exist, use I/N with 1 <= I <= N')
 
+    return sample_ids[shard_index - 1::n_shards]
 
-def load_hisat_genotype_results(hisatgenotype_result_filepath):
 
-    hisatgenotype_files = find_tool_results(hisatgenotype_result_filepath, 'results.txt')
-   
-    #Save two predictions. One, with one guess per allele and one with the full prediction
-    hisatgenotype_results = {}
+def subject_id_from_path(filename, tool_resultpath):
+    #All tools write their results to a folder per sample
+    return os.path.relpath(filename, tool_resultpath).split(os.sep)[0]
 
-    for filename in hisatgenotype_files:
-        subject_id = filename.split('/')[2]
-        hisatgenotype_resultlist = list()
-            
-        with open(filename) as infile:
-            for line in infile:
-                result = re.match(r'^\t+(1|2)\sranked (A|B|C|DRB1|DQB1)',line)
-            
-                if result is not None:
-                    hisatgenotype_resultlist.append(line.split()[2])              
-                    
-            #Duplicate prediction for an allele in case of homologous case, so that each gene has two predictions.
-            #In a homologous case, both result dicts only have one prediction and both needs an update.
-            for allele in ['A', 'B', 'C', 'DRB1', 'DQB1']:
-                allele_list = [pred for pred in hisatgenotype_resultlist if pred.startswith(allele)]
-
-                if len(allele_list) == 1:
-                    hisatgenotype_resultlist.append(allele_list[0])
-                    hisatgenotype_resultlist.sort()
-
-            temp_results = hisatgenotype_resultlist
-            
-        #Make dict of dicts for results:
-        temp_result_dict = {}
-        
-        for pred in temp_results:
-            gene = re.search(r'(A|B|C|DRB1|DQB1)', pred).group(0)
-            
-            pred_converted = convert_allele(pred)
-            #pred_converted = pred
-            
-            #Add to list of predictions for this sample
-            if gene not in temp_result_dict.keys():
-                temp_result_dict[gene] = [[pred_converted]]
-            else:
-                temp_result_dict[gene] += [[pred_converted]]
 
+def parse_files(file_parser, filenames, jobs = 1):
+    """
+    Apply file_parser to every file, spread over jobs processes.
+    The results are returned in the order of filenames, so the output doesn't depend on the number of jobs.
+    """
+    if jobs is None or jobs <= 0:
+        jobs = os.cpu_count()
+
+    if jobs == 1 or len(filenames) < 2:
+        return [file_parser(filename) for filename in filenames]
+
+    #Send the files in chunks, as each file on its own is parsed quickly
+    chunksize = max(1, len(filenames) // (jobs * 4))
+
+    with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as executor:
+        return list(executor.map(file_parser, filenames, chunksize=chunksize))
+
+
+def make_prediction_dict(sample_calls):
+    #Convert the raw predictions of a sample to the stored resolution: {locus: [[allele, candidates...], [allele, candidates...]]}
+    return {locus: [[convert_allele(candidate) for candidate in candidates] for candidates in predictions] for locus, predictions in sample_calls.items()}
+
+
+def load_tool_results(tool, tool_resultpath, jobs = 1, sample_ids = None, cache = None):
+    """
+    Load the results of a tool registered in tool_parsers.TOOL_FORMATS.
+    The files are parsed in worker processes if jobs > 1. The alleles are converted in the main process,
+    where the nomenclature is configured.
+    If an EvaluationCache is given, only new or changed files are parsed, and only files parsed or converted with another
+    nomenclature are converted.
+    """
+    with get_profiler().stage(f'discovery/{tool}'):
+        tool_files = discover_tool_results(tool, tool_resultpath, sample_ids)
+    tool_calls = {}
+    tool_predictions = {}
+
+    if cache is not None:
+        for filename in tool_files:
+            sample_calls = cache.get_calls(tool, filename)
+
+            if sample_calls is not None:
+                tool_calls[filename] = sample_calls
+
+                sample_predictions = cache.get_predictions(tool, filename)
+                if sample_predictions is not None:
+                    tool_predictions[filename] = sample_predictions
 
-        hisatgenotype_results[subject_id] = temp_result_dict
-                    
-    return hisatgenotype_results
+    files_to_parse = [filename for filename in tool_files if filename not in tool_calls]
+    get_profiler().count('files parsed', len(files_to_parse))
+    get_profiler().count('files from evaluation cache', len(tool_files) - len(files_to_parse))
+    get_profiler().count('converted files from evaluation cache', len(tool_predictions))
 
+    with get_profiler().stage(f'parsing/{tool}'):
+        for filename, sample_calls in zip(files_to_parse, parse_files(partial(parse_tool_file, tool), files_to_parse, jobs)):
+            tool_calls[filename] = sample_calls
 
-def validate_call(correct_alleles, predicted_alleles, resolution):
+            if cache is not None:
+                cache.set_calls(tool, filename, sample_calls)
+
+    tool_results = {}
+
+    #Empty files give an empty dict
+    with get_profiler().stage(f'conversion/{tool}'):
+        for filename in tool_files:
+            if filename not in tool_predictions:
+                tool_predictions[filename] = make_prediction_dict(tool_calls[filename])
+
+                if cache is not None:
+                    cache.set_predictions(tool, filename, tool_predictions[filename])
+
+            tool_results[subject_id_from_path(filename, tool_resultpath)] = tool_predictions[filename]
+
+    return tool_results
+
+
+def load_kourami_results(kourami_result_filepath, jobs = 1, sample_ids = None, cache = None):
+    return load_tool_results('Kourami', kourami_result_filepath, jobs, sample_ids, cache)
+
+
+def load_hla_la_results(hla_la_result_filepath, jobs = 1, sample_ids = None, cache = None):
+    return load_tool_results('HLA-LA', hla_la_result_filepath, jobs, sample_ids, cache)
+
+
+def load_optitype_results(optitype_result_filepath, jobs = 1, sample_ids = None, cache = None):
+    return load_tool_results('Optitype', optitype_result_filepath, jobs, sample_ids, cache)
+
+
+def load_hisat_genotype_results(hisatgenotype_result_filepath, jobs = 1, sample_ids = None, cache = None):
+    return load_tool_results('Hisatgenotype', hisatgenotype_result_filepath, jobs, sample_ids, cache)
+
+
+def validate_call(correct_alleles, predicted_alleles, resolution, candidates = 1):
 
     #Start by converting the alleles to the correct resolution
     correct_call_1 = {convert_allele(allele, resolution=resolution) for allele in correct_alleles[0]}
@@ -238,8 +218,9 @@ def validate_call(correct_alleles, predicted_alleles, resolution):
         pred_call = predicted_alleles
         return num_correct_hits, correct_call, pred_call
 
-    pred_1 = {convert_allele(predicted_alleles[0][0], resolution=resolution)}
-    pred_2 = {convert_allele(predicted_alleles[1][0], resolution=resolution)}
+    #The first candidates of each prediction (0 for all of them). A haplotype, which isn't called, has no candidates
+    pred_1, pred_2 = [{convert_allele(allele, resolution=resolution) for allele in prediction[:candidates or None]}
+                      for prediction in (list(predicted_alleles[:2]) + [[], []])[:2]]
     pred_call = [list(pred_1), list(pred_2)]
 
     try:
@@ -273,153 +254,436 @@ def get_count(tool_prediction, locus, subject):
         return 0
 
 
-def validate_typing(typing_results_dict, gold_standard_df, subject_id_list, resolution):
-    results_dict = {}
-    full_typing_results_dict = {}
+def score_subject(subject_predictions, correct_alleles, resolutions, candidates=1):
+    """
+    Score the predictions of one subject for every locus of the gold standard.
+    Returns {resolution: {locus: [count, num_correct_hits, correct_call, pred_call]}}.
+    """
+    subject_scores = {resolution: {} for resolution in resolutions}
 
-    #Loop over subjects, loci and tools
-    for tool in typing_results_dict:
-        results_dict[tool] = {}
-        full_typing_results_dict[tool] = {}
-        
-        for locus in gold_standard_df.columns:
-            results_dict[tool][locus] = {}
-            results_dict[tool][locus]['count'] = 0
-            results_dict[tool][locus]['score'] = 0
+    for locus, correct_alleles_list in correct_alleles.items():
+        predicted_alleles = ''
+        count = 0
+        #If typing exists:
+        if locus in subject_predictions:
+            #Count number of total calls:
+            count = len(subject_predictions[locus])
+
+            #check whether it is valid.
+            predicted_alleles = subject_predictions[locus]
+
+        for resolution in resolutions:
+            num_correct_hits, correct_call, pred_call = validate_call(correct_alleles_list, predicted_alleles, resolution, candidates)
+            subject_scores[resolution][locus] = [count, num_correct_hits, correct_call, pred_call]
+
+    return subject_scores
+
+
+#Number of subjects, for which the gold standard and the detail records are held in memory at once
+DETAILS_CHUNK_SIZE = 1000
+
+
+def iter_typing_details(typing_results_dict, gold_standard, subject_id_list, resolutions, chunk_size=DETAILS_CHUNK_SIZE, candidates=1):
+    """
+    Yield one record per tool, subject, resolution and locus with the reference, the prediction and the number of miscalls.
+    The subjects are handled in chunks, so memory use doesn't grow with the number of subjects.
+    Subjects, which aren't in the gold standard, are skipped.
+    """
+    gold_standard_table = as_gold_standard_table(gold_standard)
+    subject_id_list = gold_standard_table.known_subjects(subject_id_list)
+
+    for start in range(0, len(subject_id_list), chunk_size):
+        subject_chunk = subject_id_list[start:start + chunk_size]
+        correct_alleles_dict = gold_standard_table.correct_alleles(subject_chunk)
+
+        for tool in typing_results_dict:
+            for subject in subject_chunk:
+                subject_scores = score_subject(typing_results_dict[tool].get(subject, {}), correct_alleles_dict[subject], resolutions, candidates)
+
+                for resolution in resolutions:
+                    for locus, (count, num_correct_hits, correct_call, pred_call) in subject_scores[resolution].items():
+                        yield {'tool': tool,
+                               'subject': subject,
+                               'resolution': resolution,
+                               'locus': locus,
+                               'count': count,
+                               'reference': correct_call,
+                               'prediction': pred_call,
+                               'miscalls': 2-num_correct_hits}
+
+
+def typing_details(typing_results_dict, gold_standard, subject_id_list, loci, resolutions, candidates=1):
+    #Reference, prediction and miscalls of every subject: {resolution: {tool: {locus: {subject: ...}}}}
+    full_typing_results_dict = {resolution: {tool: {locus: {} for locus in loci} for tool in typing_results_dict} for resolution in resolutions}
+
+    for record in iter_typing_details(typing_results_dict, gold_standard, subject_id_list, resolutions, candidates=candidates):
+        full_typing_results_dict[record['resolution']][record['tool']][record['locus']][record['subject']] = {'reference': record['reference'],
+                                                                                                           'prediction': record['prediction'],
+                                                                                                           'miscalls': record['miscalls']}
+
+    return full_typing_results_dict
+
+
+def write_typing_details(records, outfile_path):
+    """
+    Write the detail records as JSON lines (gzipped if the path ends with .gz), one record at a time.
+    Returns the number of records written.
+    """
+    if os.path.dirname(outfile_path):
+        os.makedirs(os.path.dirname(outfile_path), exist_ok=True)
+
+    open_function = gzip.open if outfile_path.endswith('.gz') else open
+    n_records = 0
+
+    #The records are scored while they are written, so this includes scoring every sample once more
+    with get_profiler().stage('write/details'), open_function(outfile_path, 'wt', encoding='utf-8') as outfile:
+        for record in records:
+            #The calls come from sets - sort them, so the output is the same between runs
+            for key in ['reference', 'prediction']:
+                if record[key] != '':
+                    record[key] = [sorted(haplotype, key=str) for haplotype in record[key]]
+
+            outfile.write(json.dumps(record, ensure_ascii=False) + '\n')
+            n_records += 1
+
+    get_profiler().count('detail records written', n_records)
+
+    return n_records
 
-            full_typing_results_dict[tool][locus] = {}
 
-            #Find counts of calls and correct calls
+def merge_typing_details(details_paths, outfile_path):
+    #Concatenate the details of the partial results, line by line
+    if os.path.dirname(outfile_path):
+        os.makedirs(os.path.dirname(outfile_path), exist_ok=True)
+
+    open_function = gzip.open if outfile_path.endswith('.gz') else open
+
+    with get_profiler().stage('write/details'), open_function(outfile_path, 'wt', encoding='utf-8') as outfile:
+        for details_path in details_paths:
+            details_open_function = gzip.open if details_path.endswith('.gz') else open
+
+            with details_open_function(details_path, 'rt', encoding='utf-8') as infile:
+                for line in infile:
+                    outfile.write(line)
+
+
+def validate_typing(typing_results_dict, gold_standard_df, subject_id_list, resolutions=DEFAULT_RESOLUTIONS, cache=None, full_results=True, candidates=1, sample_scores=None):
+    """
+    Score the typing results at all the given resolutions with the columnar concordance engine.
+    The gold standard is either a GoldStandardTable or a DataFrame with one list of candidates per haplotype in each cell.
+    Returns two dicts with the structure {resolution: {tool: {locus: ...}}} - the scores and the full typing results.
+    The full typing results are only collected if full_results is set, otherwise None is returned in their place.
+    If an EvaluationCache is given, only subjects with new predictions, gold standard or resolutions are scored.
+    A prediction matches, if one of its first candidates matches (1 only scores the called allele, 0 scores all candidates).
+    If a dict is passed as sample_scores, the count and score of every tool, gold standard subject and locus are stored
+    in it per resolution, as a DataFrame with the columns tool, subject, locus, count and score.
+    """
+    gold_standard_table = as_gold_standard_table(gold_standard_df)
+
+    #Only subjects in the gold standard are scored, and only their calls count towards the call rate
+    subject_id_list = gold_standard_table.known_subjects(subject_id_list)
+
+    loci = gold_standard_table.loci
+    n_subjects = len(subject_id_list)
+
+    #Reference alleles converted by create_gold_standard are used as long as the nomenclature hasn't changed
+    precomputed_resolutions = [resolution for resolution in resolutions if resolution in gold_standard_table.label_resolutions(get_nomenclature())]
+    with get_profiler().stage('select gold standard'):
+        gold_standard = gold_standard_table.to_long(subject_id_list, resolutions=precomputed_resolutions)
+
+    correct_alleles_dict = None
+    if cache is not None:
+        correct_alleles_dict = gold_standard_table.correct_alleles(subject_id_list)
+
+    #Subjects found in the cache are not scored again
+    cached_scores = {resolution: [] for resolution in resolutions}
+    subjects_to_cache = []
+    typing_results_to_score = typing_results_dict
+
+    if cache is not None:
+        typing_results_to_score = {tool: {} for tool in typing_results_dict}
+
+        for tool in typing_results_dict:
             for subject in subject_id_list:
-                predicted_alleles = ''
-                #If typing exists:
-                if subject in typing_results_dict[tool]:
-                    if locus in typing_results_dict[tool][subject]:
-                        #Count number of total calls:
-                        results_dict[tool][locus]['count'] += get_count(typing_results_dict[tool], locus, subject)
-                    
-                        #check whether it is valid.
-                        predicted_alleles = typing_results_dict[tool][subject][locus]
-                
-                correct_alleles_list = gold_standard_df.loc[subject, locus]
-
-                num_correct_hits, correct_call, pred_call = validate_call(correct_alleles_list, predicted_alleles, resolution)
-
-                full_typing_results_dict[tool][locus][subject] = {}
-                full_typing_results_dict[tool][locus][subject]['reference'] = correct_call
-                full_typing_results_dict[tool][locus][subject]['prediction'] = pred_call
-                full_typing_results_dict[tool][locus][subject]['miscalls'] = 2-num_correct_hits
-                
-                results_dict[tool][locus]['score'] += num_correct_hits
-
-
-        #Add entries for all class I, class II and all alleles
-        results_dict[tool]['HLA-I'] = {}
-        results_dict[tool]['HLA-II'] = {}
-        results_dict[tool]['Total'] = {}
-
-        results_dict[tool]['HLA-I']['count'] = sum([results_dict[tool][locus]['count'] for locus in ['A', 'B', 'C']]) 
-        results_dict[tool]['HLA-II']['count'] = sum([results_dict[tool][locus]['count'] for locus in ['DRB1', 'DQB1']]) 
-        results_dict[tool]['Total']['count'] = sum([results_dict[tool][locus]['count'] for locus in ['HLA-I', 'HLA-II']]) 
-
-        results_dict[tool]['HLA-I']['score'] = sum([results_dict[tool][locus]['score'] for locus in ['A', 'B', 'C']]) 
-        results_dict[tool]['HLA-II']['score'] = sum([results_dict[tool][locus]['score'] for locus in ['DRB1', 'DQB1']]) 
-        results_dict[tool]['Total']['score'] = sum([results_dict[tool][locus]['score'] for locus in ['HLA-I', 'HLA-II']]) 
-
-
-        #Find total counts and calculate call rate and typing accuracy
-        for locus in results_dict[tool]:
-            if locus in ['A', 'B', 'C', 'DRB1', 'DQB1']:
-                multiplier = 1
-            elif locus == 'HLA-I':
-                multiplier = 3
-            elif locus == 'HLA-II':
-                multiplier = 2
-            elif locus == 'Total':
-                multiplier = 5
-
-            total_correct_calls = multiplier * len(gold_standard_df[gold_standard_df.index.isin(subject_id_list)]) * 2
-            results_dict[tool][locus]['call_rate'] = results_dict[tool][locus]['count'] * 100  / total_correct_calls
-            results_dict[tool][locus]['typing_accuracy'] = results_dict[tool][locus]['score'] * 100 / total_correct_calls
+                if subject not in typing_results_dict[tool]:
+                    continue
+
+                subject_predictions = typing_results_dict[tool][subject]
+                subject_scores = cache.get_scores(tool, subject, score_key(subject_predictions, correct_alleles_dict[subject], candidates))
+
+                if all(resolution in subject_scores for resolution in resolutions):
+                    for resolution in resolutions:
+                        cached_scores[resolution] += [(tool, subject, locus, count, score) for locus, (count, score) in subject_scores[resolution].items()]
+                else:
+                    typing_results_to_score[tool][subject] = subject_predictions
+                    subjects_to_cache.append((tool, subject, subject_scores))
+
+    calls, counts = calls_to_long(typing_results_to_score, subject_id_list, loci, candidates)
+
+    results_dict = {}
+
+    get_profiler().count('calls scored', len(calls))
 
+    for resolution in resolutions:
+        with get_profiler().stage(f'scoring/{resolution}'):
+            cell_scores = score_calls(calls, counts, gold_standard, resolution)
+
+            if cache is not None:
+                cell_score_dict = {}
+                for tool, subject, locus, count, score in cell_scores.itertuples(index=False):
+                    cell_score_dict.setdefault((tool, subject), {})[locus] = [int(count), int(score)]
+
+                for tool, subject, subject_scores in subjects_to_cache:
+                    cache.set_scores(tool, subject, resolution, cell_score_dict.get((tool, subject), {}))
+
+                cell_scores = pd.concat([cell_scores, pd.DataFrame(cached_scores[resolution], columns=cell_scores.columns)], ignore_index=True)
+
+            results_dict[resolution] = summarise_scores(cell_scores, typing_results_dict, loci, n_subjects)
+
+        #Every cell, also the ones without calls, so each subject is one row for the bootstrap
+        if sample_scores is not None:
+            all_cells = pd.MultiIndex.from_product([list(typing_results_dict), subject_id_list, loci], names=['tool', 'subject', 'locus'])
+            sample_scores[resolution] = cell_scores.groupby(['tool', 'subject', 'locus'])[['count', 'score']].sum().reindex(all_cells, fill_value=0).reset_index()
+
+    full_typing_results_dict = None
+    if full_results:
+        full_typing_results_dict = typing_details(typing_results_dict, gold_standard_table, subject_id_list, loci, resolutions, candidates)
 
     return results_dict, full_typing_results_dict
 
 
-def load_all_results(gs_data = 'results/01_1000G_reference/1000G_2014_cleaned.pkl',
+def load_all_results(gs_data = 'results/01_1000G_reference/1000G_2014_cleaned.gs',
                         kourami_path = None, 
                         hla_la_path = None,
                         optitype_path = None, 
-                        hisat_genotype_path = None):
+                        hisat_genotype_path = None,
+                        resolutions = None,
+                        jobs = 1,
+                        config = 'snakemake/config.yaml',
+                        walk_result_folders = False,
+                        cache_dir = None,
+                        details_path = None,
+                        candidates = 1,
+                        sample_scores = False):
+    """
+    Parse and score the typing results of the samples in the config at all given resolutions.
+    If sample_scores is set, the count and score of every tool, sample and locus are returned as well, as a DataFrame
+    with the columns resolution, tool, subject, locus, count and score (see summarise_results.sample_score_arrays).
+    """
+    #The gold standard is either read from disk or passed in memory (hla-bench run)
+    with get_profiler().stage('load gold standard'):
+        gold_standard = load_gold_standard(gs_data) if isinstance(gs_data, str) else as_gold_standard_table(gs_data)
 
-    gs_two_field_df = pd.read_pickle(gs_data)
+    gold_standard_id_list = load_sample_ids(config)
 
-    typing_results_dict = {}
+    #Find the result files from the samples in the config, unless the result folders should be searched
+    sample_ids = None if walk_result_folders else gold_standard_id_list
+
+    #Reuse the parsed and scored samples of earlier runs
+    cache = None
+    if cache_dir is not None:
+        cache = EvaluationCache(cache_dir, get_nomenclature().version())
+
+    typing_results_dict = load_typing_results(kourami_path, hla_la_path, optitype_path, hisat_genotype_path, jobs=jobs, sample_ids=sample_ids, cache=cache)
 
+    #Score all registered resolutions, unless specified otherwise
+    if resolutions is None:
+        resolutions = all_resolutions()
+    check_resolutions(resolutions)
+
+    #Score all typing resolutions in one pass
+    sample_scores_dict = {} if sample_scores else None
+    results_dict, full_typing_results_dict = validate_typing(typing_results_dict=typing_results_dict, gold_standard_df=gold_standard, subject_id_list=gold_standard_id_list, resolutions=resolutions, cache=cache, full_results=False, candidates=candidates, sample_scores=sample_scores_dict)
+
+    if cache is not None:
+        with get_profiler().stage('write/evaluation cache'):
+            cache.save()
+
+    #Stream the reference, prediction and miscalls of every sample to disk
+    if details_path is not None:
+        write_typing_details(iter_typing_details(typing_results_dict, gold_standard, gold_standard_id_list, resolutions, candidates=candidates), details_path)
+
+    all_resolutions_results = {RESOLUTIONS[resolution].label: results_dict[resolution] for resolution in resolutions}
+
+    if sample_scores:
+        sample_scores_df = pd.concat([resolution_df.assign(resolution=RESOLUTIONS[resolution].label) for resolution, resolution_df in sample_scores_dict.items()], ignore_index=True)
+        return all_resolutions_results, sample_scores_df
+
+    return all_resolutions_results
+
+
+def load_typing_results(kourami_path = None, hla_la_path = None, optitype_path = None, hisat_genotype_path = None, jobs = 1, sample_ids = None, cache = None):
+    typing_results_dict = {}
 
     #Load results of the tools:
     if kourami_path != None:
-        typing_results_dict['Kourami'] = load_kourami_results(kourami_path)
+        typing_results_dict['Kourami'] = load_kourami_results(kourami_path, jobs=jobs, sample_ids=sample_ids, cache=cache)
     
     if hla_la_path != None:
-        typing_results_dict['HLA-LA'] = load_hla_la_results(hla_la_path)
+        typing_results_dict['HLA-LA'] = load_hla_la_results(hla_la_path, jobs=jobs, sample_ids=sample_ids, cache=cache)
     
     if optitype_path != None:
-        typing_results_dict['Optitype'] = load_optitype_results(optitype_path)
+        typing_results_dict['Optitype'] = load_optitype_results(optitype_path, jobs=jobs, sample_ids=sample_ids, cache=cache)
     
     if hisat_genotype_path != None:
-        typing_results_dict['Hisatgenotype'] = load_hisat_genotype_results(hisat_genotype_path)
+        typing_results_dict['Hisatgenotype'] = load_hisat_genotype_results(hisat_genotype_path, jobs=jobs, sample_ids=sample_ids, cache=cache)
 
-    rename_resolutions = {
-        'one_field' : '1-field',
-        'e_group' : 'pseudosequence',
-        'p_group' : 'P group',
-        'two_field' : '2-field',
-    }
+    return typing_results_dict
 
-    #Load list of gold standard samples throug the config
-    with open('snakemake/config.yaml', 'r') as f:
-        config = yaml.load(f, Loader=SafeLoader)
-    
-    gold_standard_id_list = list(config['sample_urls'].keys())
 
-    #Loop over typing resolutions 
-    four_resolutions_results = {}
-    full_typing_results_dict = {}
+def map_typing_results(gs_data = 'results/01_1000G_reference/1000G_2014_cleaned.gs',
+                        kourami_path = None,
+                        hla_la_path = None,
+                        optitype_path = None,
+                        hisat_genotype_path = None,
+                        resolutions = None,
+                        jobs = 1,
+                        sample_ids = None,
+                        details_path = None,
+                        candidates = 1):
+    """
+    Score the typing results of one sample or shard of samples and return them as partial results (see partial_results).
+    Samples, which aren't in the gold standard, are skipped - the partial results of a shard without any are empty.
+    """
+    with get_profiler().stage('load gold standard'):
+        gold_standard = load_gold_standard(gs_data)
+
+    sample_ids = gold_standard.known_subjects(sample_ids)
+
+    typing_results_dict = load_typing_results(kourami_path, hla_la_path, optitype_path, hisat_genotype_path, jobs=jobs, sample_ids=sample_ids)
+
+    if resolutions is None:
+        resolutions = all_resolutions()
+    check_resolutions(resolutions)
+
+    results_dict, full_typing_results_dict = validate_typing(typing_results_dict=typing_results_dict, gold_standard_df=gold_standard, subject_id_list=sample_ids, resolutions=resolutions, full_results=False, candidates=candidates)
+
+    if details_path is not None:
+        write_typing_details(iter_typing_details(typing_results_dict, gold_standard, sample_ids, resolutions, candidates=candidates), details_path)
+
+    return make_partial(results_dict, sample_ids, gold_standard.loci, get_nomenclature().version(), details_path, candidates)
+
+
+def reduce_typing_results(partial_paths, details_path = None):
+    """
+    Merge partial results (files, or folders with *.partial.json files) into the results of a full run.
+    """
+    with get_profiler().stage('read partials'):
+        partials = [read_partial(partial_path) for partial_path in find_partials(partial_paths)]
+    get_profiler().count('partials merged', len(partials))
+
+    with get_profiler().stage('merge partials'):
+        all_resolutions_results = merge_partials(partials)
+
+    if details_path is not None:
+        missing_details = [partial for partial in partials if partial['details'] is None]
+        if len(missing_details) > 0:
+            raise ValueError(f'{len(missing_details)} partial results were written without --details')
+
+        merge_typing_details([partial['details'] for partial in partials], details_path)
+
+    return all_resolutions_results
 
-    for resolution in ['one_field', 'e_group', 'p_group', 'two_field']:
-        four_resolutions_results[rename_resolutions[resolution]], full_typing_results_dict[rename_resolutions[resolution]] = validate_typing(typing_results_dict=typing_results_dict, gold_standard_df=gs_two_field_df, subject_id_list=gold_standard_id_list, resolution=resolution)
 
-    return four_resolutions_results
- 
- 
 
 
 def main():
     parser = get_argparser()
     args = parser.parse_args()
 
-    full_results = load_all_results(gs_data = args.gs_data,
-                                    kourami_path=args.kourami,
-                                    hla_la_path=args.hla_la,
-                                    optitype_path=args.optitype,
-                                    hisat_genotype_path=args.hisat_genotype)
+    if args.profile is not None:
+        start_profiling(cprofile=args.cprofile is not None)
 
+    #Either pin the nomenclature to a release in the IMGT release store or use the given files
+    if args.imgt_store is not None:
+        set_nomenclature(ImgtReleaseStore(args.imgt_store).nomenclature(args.imgt_release,
+                                                                        e_group_filepath=args.pseudosequences,
+                                                                        cache_dir=args.nomenclature_cache))
+    else:
+        configure_nomenclature(deleted_filepath=args.deleted_alleles,
+                               p_group_filepath=args.p_group,
+                               e_group_filepath=args.pseudosequences,
+                               g_group_filepath=args.g_group,
+                               cache_dir=args.nomenclature_cache)
+
+    #Map mode: score a sample or shard of samples and write the partial results
+    if args.mode == 'map':
+        sample_ids = args.samples if args.samples is not None else load_sample_ids(args.config)
+
+        if args.shard is not None:
+            sample_ids = shard_sample_ids(sample_ids, args.shard)
+
+        partial_results = map_typing_results(gs_data = args.gs_data,
+                                             kourami_path=args.kourami,
+                                             hla_la_path=args.hla_la,
+                                             optitype_path=args.optitype,
+                                             hisat_genotype_path=args.hisat_genotype,
+                                             resolutions=args.resolutions,
+                                             jobs=args.jobs,
+                                             sample_ids=sample_ids,
+                                             details_path=args.details,
+                                             candidates=args.candidates)
+
+        with get_profiler().stage('write/partial results'):
+            write_partial(partial_results, args.output)
+
+    #Reduce mode: merge the partial results
+    elif args.mode == 'reduce':
+        if args.partials is None:
+            parser.error('--partials is required in reduce mode')
+
+        write_results(reduce_typing_results(args.partials, details_path=args.details), args.output)
 
-    if not os.path.exists(os.path.dirname(args.output)):
-        os.makedirs(os.path.dirname(args.output))
-        
-    with open(args.output, 'w', encoding='utf-8') as f:
-        json.dump(full_results, f, ensure_ascii=False, indent=4)
+    else:
+        write_results(load_all_results(gs_data = args.gs_data,
+                                       kourami_path=args.kourami,
+                                       hla_la_path=args.hla_la,
+                                       optitype_path=args.optitype,
+                                       hisat_genotype_path=args.hisat_genotype,
+                                       resolutions=args.resolutions,
+                                       jobs=args.jobs,
+                                       config=args.config,
+                                       walk_result_folders=args.walk_result_folders,
+                                       cache_dir=args.evaluation_cache,
+                                       details_path=args.details,
+                                       candidates=args.candidates),
+                      args.output)
+
+    if args.profile is not None:
+        get_profiler().write(args.profile, 'parse_typing_results', get_nomenclature(), args.cprofile)
 
 
+def write_results(full_results, outfile_path):
+    with get_profiler().stage('write/results'):
+        if not os.path.exists(os.path.dirname(outfile_path)):
+            os.makedirs(os.path.dirname(outfile_path))
+
+        with open(outfile_path, 'w', encoding='utf-8') as f:
+            json.dump(full_results, f, ensure_ascii=False, indent=4)
+
 
 def get_argparser():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
+    parser.add_argument('--mode',
+                        help="'full' scores all samples. 'map' scores a sample or shard of samples (--samples, --shard) and writes partial results to --output. 'reduce' merges partial results (--partials) into the typing results",
+                        choices=['full', 'map', 'reduce'],
+                        default='full')
+
+    parser.add_argument('--samples',
+                        help='Samples to score in map mode (default: the samples in the config)',
+                        nargs='+')
+
+    parser.add_argument('--shard',
+                        help="Only score shard I of N of the samples in map mode, given as 'I/N'")
+
+    parser.add_argument('--partials',
+                        help='Partial results to merge in reduce mode. Folders are searched for *.partial.json files',
+                        nargs='+')
+
     parser.add_argument('--gs-data',
-                        help='Gold standard data (.pkl Pandas dataframe file)',
-                        default='results/01_1000G_reference/1000G_2014_cleaned.pkl')
+                        help='Gold standard data (folder written by create_gold_standard, or a .pkl Pandas dataframe file)',
+                        default='results/01_1000G_reference/1000G_2014_cleaned.gs')
 
 
     parser.add_argument('--kourami',
@@ -434,8 +698,71 @@ def get_argparser():
     parser.add_argument('--hisat-genotype',
                          help='Folder with HLA typing results from HISAT-genotype')
 
+    parser.add_argument('--deleted-alleles',
+                        help='IMGT/HLA Deleted_alleles.txt used to rename deleted alleles',
+                        default=DELETED_ALLELES_PATH)
+
+    parser.add_argument('--p-group',
+                        help='IMGT/HLA hla_nom_p.txt used for P group conversion',
+                        default=P_GROUP_PATH)
+
+    parser.add_argument('--pseudosequences',
+                        help='Table with MHC pseudosequences used for pseudosequence conversion',
+                        default=E_GROUP_PATH)
+
+    parser.add_argument('--g-group',
+                        help='IMGT/HLA hla_nom_g.txt used for G group conversion',
+                        default=G_GROUP_PATH)
+
+    parser.add_argument('--resolutions',
+                        help='Resolutions to score the typing results at',
+                        nargs='+',
+                        choices=all_resolutions(),
+                        default=all_resolutions())
+
+    parser.add_argument('--candidates',
+                        help='Number of candidate alleles per prediction to score: the called allele, followed by the ambiguous or lower ranked alleles reported by the tool. A prediction is correct, if one of its candidates is. 0 scores all candidates',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--config',
+                        help='Snakemake config.yaml with the samples to evaluate',
+                        default='snakemake/config.yaml')
+
+    parser.add_argument('--walk-result-folders',
+                        help='Search the whole result folders for output files instead of looking up the output of each sample in the config',
+                        action='store_true')
+
+    parser.add_argument('--evaluation-cache',
+                        help='Folder to cache the predictions and scores of each sample in. Only new or changed samples are parsed and scored in later runs with the same folder. Not used in map mode')
+
+    parser.add_argument('--jobs',
+                        help='Number of processes used to parse the result files (0 uses all CPUs)',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--nomenclature-cache',
+                        help='Folder for the cached nomenclature tables. They are rebuilt when the source files change',
+                        default=NOMENCLATURE_CACHE_DIR)
+
+    parser.add_argument('--imgt-store',
+                        help='IMGT release store (see imgt_release_store). If given, --deleted-alleles, --p-group and --g-group are ignored')
+
+    parser.add_argument('--imgt-release',
+                        help="Release in the IMGT release store to score against ('latest' is the newest release)",
+                        default='latest')
+
+    parser.add_argument('--details',
+                        help='Path to write the reference, prediction and miscalls of every sample, tool, resolution and locus as JSON lines (.jsonl, or .jsonl.gz for gzip). The records are streamed to disk. In reduce mode, the details of the partial results are merged')
+
+    parser.add_argument('--profile',
+                        help='Path to write a profile of the run as json: wall time per stage, files parsed, alleles converted, conversion cache hits and misses and peak memory')
+
+    parser.add_argument('--cprofile',
+                        help='Path to write cProfile statistics of the run to (used together with --profile), e.g. for snakeviz or pstats')
+
     parser.add_argument('--output',
-                        help='Path to save .json file with complete, collected typing results including call rate, typing accuracy etc.',
+                        help='Path to save .json file with complete, collected typing results including call rate, typing accuracy etc. In map mode, the partial results are written here (*.partial.json)',
                         default='results/05_collected_typing_results/typing_results.json')
     return parser
 
@@ -0,0 +1,149 @@
+"""
+Partial typing results for the map and reduce modes of parse_typing_results.
+
+In map mode, parse_typing_results scores one sample or shard of samples and writes the sums it is made of:
+
+    {
+        "format": "hla-typing-benchmark-partial",
+        "version": 1,
+        "nomenclature_version": "...",
+        "resolutions": ["one_field", ...],
+        "loci": ["A", "B", "C", "DRB1", "DQB1"],
+        "candidates": 1,
+        "subjects": {tool: [scored subjects]},
+        "scores": {resolution: {tool: {locus: [count, score]}}},
+        "details": "<details file relative to the partial>" or null
+    }
+
+Counts and scores are integer sums, so the reduce mode merges any number of partials into exactly the results of
+a single run over all samples. Each (tool, subject) may only be scored in one partial.
+"""
+
+import json
+import os
+import tempfile
+
+from hla_typing_benchmark.concordance import add_summary_scores
+from hla_typing_benchmark.parse_data import RESOLUTIONS
+from hla_typing_benchmark.tool_parsers import TOOL_FORMATS
+
+
+PARTIAL_FORMAT = 'hla-typing-benchmark-partial'
+PARTIAL_FORMAT_VERSION = 1
+PARTIAL_EXTENSION = '.partial.json'
+
+
+def make_partial(results_dict, subjects, loci, nomenclature_version, details_path=None, candidates=1):
+    """
+    Partial results from the output of validate_typing for the given (gold standard) subjects.
+    Only the count and score of each locus are kept, the summary entries and rates are added when merging.
+    """
+    return {'format': PARTIAL_FORMAT,
+            'version': PARTIAL_FORMAT_VERSION,
+            'nomenclature_version': nomenclature_version,
+            'resolutions': list(results_dict),
+            'loci': list(loci),
+            'candidates': candidates,
+            'subjects': {tool: list(subjects) for tool in next(iter(results_dict.values()), {})},
+            'scores': {resolution: {tool: {locus: [tool_dict[locus]['count'], tool_dict[locus]['score']] for locus in loci}
+                                    for tool, tool_dict in tool_results.items()}
+                       for resolution, tool_results in results_dict.items()},
+            'details': details_path}
+
+
+def write_partial(partial, outfile_path):
+    parent_dir = os.path.dirname(os.path.abspath(outfile_path))
+    os.makedirs(parent_dir, exist_ok=True)
+
+    #Store the details file relative to the partial, so the partials can be moved together with their details
+    if partial['details'] is not None:
+        partial = dict(partial, details=os.path.relpath(os.path.abspath(partial['details']), parent_dir))
+
+    #Write to a temporary file first, so the reduce step never reads a half written partial
+    file_descriptor, tmp_filepath = tempfile.mkstemp(prefix=f'.{os.path.basename(outfile_path)}-', dir=parent_dir)
+    os.chmod(tmp_filepath, 0o644)
+
+    with os.fdopen(file_descriptor, 'w') as outfile:
+        json.dump(partial, outfile)
+
+    os.replace(tmp_filepath, outfile_path)
+
+
+def read_partial(partial_path):
+    with open(partial_path, 'r') as infile:
+        partial = json.load(infile)
+
+    if partial.get('format') != PARTIAL_FORMAT or partial.get('version') != PARTIAL_FORMAT_VERSION:
+        raise ValueError(f'{partial_path} is not a partial result in format version {PARTIAL_FORMAT_VERSION}')
+
+    if partial['details'] is not None:
+        partial['details'] = os.path.join(os.path.dirname(partial_path), partial['details'])
+
+    return partial
+
+
+def find_partials(paths):
+    #Folders are searched for partials, files are used as they are
+    partial_paths = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, subdirs, files in os.walk(path):
+                partial_paths += sorted(os.path.join(dirpath, x) for x in files if x.endswith(PARTIAL_EXTENSION))
+        else:
+            partial_paths.append(path)
+
+    return partial_paths
+
+
+def merge_partials(partials):
+    """
+    Sum the partials into the results of a full run: {resolution label: {tool: {locus: {count, score, call_rate, typing_accuracy}}}}.
+    """
+    if len(partials) == 0:
+        raise ValueError('No partial results to merge')
+
+    first = partials[0]
+    scored_subjects = set()
+    subjects = set()
+    tools = {}
+    totals = {}
+
+    for partial in partials:
+        for key in ['nomenclature_version', 'resolutions', 'loci', 'candidates']:
+            if partial[key] != first[key]:
+                raise ValueError(f'Partial results with different {key} can not be merged: {first[key]} and {partial[key]}')
+
+        for tool, tool_subjects in partial['subjects'].items():
+            tools[tool] = None
+
+            for subject in tool_subjects:
+                if (tool, subject) in scored_subjects:
+                    raise ValueError(f'{subject} is scored for {tool} in more than one partial result')
+                scored_subjects.add((tool, subject))
+                subjects.add(subject)
+
+        for resolution, tool_results in partial['scores'].items():
+            for tool, locus_dict in tool_results.items():
+                tool_totals = totals.setdefault(resolution, {}).setdefault(tool, {locus: [0, 0] for locus in first['loci']})
+
+                for locus, (count, score) in locus_dict.items():
+                    tool_totals[locus][0] += count
+                    tool_totals[locus][1] += score
+
+    #Tools in the order of a full run
+    tools = sorted(tools, key=lambda tool: list(TOOL_FORMATS).index(tool) if tool in TOOL_FORMATS else len(TOOL_FORMATS))
+
+    results_dict = {}
+
+    for resolution in first['resolutions']:
+        results_dict[RESOLUTIONS[resolution].label] = {}
+
+        for tool in tools:
+            tool_totals = totals.get(resolution, {}).get(tool, {locus: [0, 0] for locus in first['loci']})
+            tool_dict = {locus: {'count': count, 'score': score} for locus, (count, score) in tool_totals.items()}
+
+            #Rates over all subjects, also those a tool has no results for
+            results_dict[RESOLUTIONS[resolution].label][tool] = add_summary_scores(tool_dict, len(subjects))
+
+    return results_dict
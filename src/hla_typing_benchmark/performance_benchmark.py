@@ -0,0 +1,344 @@
+"""
+Performance benchmark of the evaluation stages on synthetic cohorts (see synthetic_cohort). Runs fully offline.
+
+For every cohort size the stages are timed one at a time, each in a fresh process, so the peak memory of a stage
+is the peak RSS of its process. Inputs a stage needs (gold standard, parsed typing results, details) are prepared
+in the same process before the timer starts:
+
+    create_gold_standard   create_gold_standard.load_gs_data
+    load_all_results       parse_typing_results.load_all_results (discovery, parsing and scoring)
+    validate_typing        parse_typing_results.validate_typing (scoring only)
+    summarise_results      bootstrap confidence intervals, results table and plots of summarise_results
+
+The report holds seconds, samples per second and peak RSS of every stage and cohort size:
+
+    {
+        "environment": {...},
+        "cohorts": {"1000": {"generate_seconds": 3.1, "stages": {"validate_typing": {"seconds": 0.4, "samples_per_second": 2500.0,
+                                                                                   "peak_rss_mb": 210.0, "setup_rss_mb": 190.0}, ...}}},
+        "comparison": {"1000": {"validate_typing": {"seconds": 0.95, "peak_rss_mb": 1.01}}}
+    }
+
+It can be stored as baseline with --save-baseline. Later runs are compared against the baseline as ratios (below 1 is faster or smaller).
+A stage which fails is reported with its error instead of its timings.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from hla_typing_benchmark.parse_data import E_GROUP_PATH
+from hla_typing_benchmark.profiling import peak_rss_mb
+from hla_typing_benchmark import synthetic_cohort
+
+
+STAGES = ['create_gold_standard', 'load_all_results', 'validate_typing', 'summarise_results']
+
+BASELINE_PATH = 'results/benchmark/baseline.json'
+
+
+def configure_cohort_nomenclature(cohort_dir):
+    from hla_typing_benchmark.parse_data import configure_nomenclature
+
+    with open(os.path.join(cohort_dir, synthetic_cohort.COHORT_FILENAME), 'r') as infile:
+        parameters = json.load(infile)
+
+    imgt_dir = os.path.join(cohort_dir, '00_IMGT_reference')
+    configure_nomenclature(deleted_filepath=os.path.join(imgt_dir, 'Deleted_alleles.txt'),
+                           p_group_filepath=os.path.join(imgt_dir, 'hla_nom_p.txt'),
+                           e_group_filepath=parameters['mhc_seqs_path'],
+                           g_group_filepath=os.path.join(imgt_dir, 'hla_nom_g.txt'))
+
+
+def tool_paths(cohort_dir):
+    #Keyword arguments of load_all_results and load_typing_results
+    return {f'{argument}_path': os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS[tool])
+            for argument, tool in [('kourami', 'Kourami'), ('hla_la', 'HLA-LA'), ('optitype', 'Optitype'), ('hisat_genotype', 'Hisatgenotype')]}
+
+
+def prepare_gold_standard(cohort_dir, work_dir):
+    #Columnar gold standard from the truth of the cohort, so the other stages don't depend on create_gold_standard
+    import pandas as pd
+    from hla_typing_benchmark.gold_standard_table import write_gold_standard
+    from hla_typing_benchmark.parse_data import all_resolutions, get_nomenclature
+
+    gs_path = os.path.join(work_dir, 'gold_standard.gs')
+
+    if not os.path.exists(gs_path):
+        gold_standard_df = pd.read_pickle(os.path.join(cohort_dir, 'gold_standard.pkl'))
+        write_gold_standard(gold_standard_df, gs_path, resolutions=all_resolutions(), nomenclature=get_nomenclature())
+
+    return gs_path
+
+
+def prepare_typing_results(cohort_dir, work_dir, jobs):
+    #Results and details as written by parse_typing_results, for summarise_results
+    from hla_typing_benchmark import parse_typing_results
+
+    results_path = os.path.join(work_dir, 'typing_results.json')
+    details_path = os.path.join(work_dir, 'typing_details.jsonl.gz')
+
+    if not (os.path.exists(results_path) and os.path.exists(details_path)):
+        results = parse_typing_results.load_all_results(gs_data=prepare_gold_standard(cohort_dir, work_dir),
+                                                        jobs=jobs,
+                                                        config=os.path.join(cohort_dir, 'config.yaml'),
+                                                        details_path=details_path,
+                                                        **tool_paths(cohort_dir))
+        parse_typing_results.write_results(results, results_path)
+
+    return results_path, details_path
+
+
+def setup_create_gold_standard(cohort_dir, work_dir, jobs, bootstrap_replicates):
+    from hla_typing_benchmark.create_gold_standard import load_gs_data
+
+    return lambda: load_gs_data(gs_data_path=os.path.join(cohort_dir, synthetic_cohort.GOLD_STANDARD_FILENAME),
+                                outfile_path=os.path.join(work_dir, 'created_gold_standard.gs'),
+                                config_path=os.path.join(cohort_dir, 'config.yaml'))
+
+
+def setup_load_all_results(cohort_dir, work_dir, jobs, bootstrap_replicates):
+    from hla_typing_benchmark.parse_typing_results import load_all_results
+
+    gs_path = prepare_gold_standard(cohort_dir, work_dir)
+
+    return lambda: load_all_results(gs_data=gs_path, jobs=jobs, config=os.path.join(cohort_dir, 'config.yaml'), **tool_paths(cohort_dir))
+
+
+def setup_validate_typing(cohort_dir, work_dir, jobs, bootstrap_replicates):
+    from hla_typing_benchmark.gold_standard_table import load_gold_standard
+    from hla_typing_benchmark.parse_data import all_resolutions
+    from hla_typing_benchmark.parse_typing_results import load_sample_ids, load_typing_results, validate_typing
+
+    gold_standard = load_gold_standard(prepare_gold_standard(cohort_dir, work_dir))
+    sample_ids = load_sample_ids(os.path.join(cohort_dir, 'config.yaml'))
+    typing_results_dict = load_typing_results(jobs=jobs, sample_ids=sample_ids, **tool_paths(cohort_dir))
+
+    return lambda: validate_typing(typing_results_dict, gold_standard, sample_ids, resolutions=all_resolutions(), full_results=False)
+
+
+def setup_summarise_results(cohort_dir, work_dir, jobs, bootstrap_replicates):
+    from hla_typing_benchmark import summarise_results
+
+    results_path, details_path = prepare_typing_results(cohort_dir, work_dir, jobs)
+
+    def summarise():
+        with open(results_path, 'r') as infile:
+            results_dict = json.load(infile)
+
+        summarise_results.summarise(results_dict,
+                                    os.path.join(work_dir, 'results_table.tsv'),
+                                    os.path.join(work_dir, 'HLA_class_performance.jpg'),
+                                    os.path.join(work_dir, 'HLA_loci_performance.jpg'),
+                                    details_path=details_path,
+                                    bootstrap_replicates=bootstrap_replicates,
+                                    seed=0)
+
+    return summarise
+
+
+#Each stage prepares its inputs and returns the function to time
+STAGE_SETUPS = {'create_gold_standard': setup_create_gold_standard,
+                'load_all_results': setup_load_all_results,
+                'validate_typing': setup_validate_typing,
+                'summarise_results': setup_summarise_results}
+
+
+def run_stage(stage, cohort_dir, work_dir, n_samples, jobs=1, bootstrap_replicates=1000):
+    """
+    Time a stage. Meant to run in a process of its own (see run_stage_in_process), so peak_rss_mb is the peak of
+    this stage including its setup. The peak after the setup is given as setup_rss_mb.
+    """
+    try:
+        configure_cohort_nomenclature(cohort_dir)
+        os.makedirs(work_dir, exist_ok=True)
+
+        stage_function = STAGE_SETUPS[stage](cohort_dir, work_dir, jobs, bootstrap_replicates)
+        setup_rss_mb = peak_rss_mb('self')
+
+        start = time.perf_counter()
+        stage_function()
+        seconds = time.perf_counter() - start
+    except Exception as error:
+        return {'error': ''.join(traceback.format_exception_only(type(error), error)).strip()}
+
+    return {'seconds': seconds,
+            'samples_per_second': n_samples / seconds if seconds > 0 else None,
+            'peak_rss_mb': peak_rss_mb('self'),
+            'setup_rss_mb': setup_rss_mb}
+
+
+def run_stage_in_process(stage, *args, **kwargs):
+    #Spawned, so no memory is inherited from this process
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(run_stage, stage, *args, **kwargs).result()
+
+
+def prepare_cohort(cohort_dir, n_samples, seed, mhc_seqs_path):
+    """
+    Generate the cohort, unless it is there already with the same parameters. Returns the seconds spent generating.
+    """
+    parameters_path = os.path.join(cohort_dir, synthetic_cohort.COHORT_FILENAME)
+
+    if os.path.exists(parameters_path):
+        with open(parameters_path, 'r') as infile:
+            parameters = json.load(infile)
+
+        if parameters == synthetic_cohort.cohort_parameters(n_samples, seed, mhc_seqs_path):
+            return 0.0
+
+        shutil.rmtree(cohort_dir)
+
+    start = time.perf_counter()
+    synthetic_cohort.generate_cohort(cohort_dir, n_samples, seed=seed, mhc_seqs_path=mhc_seqs_path)
+
+    return time.perf_counter() - start
+
+
+def environment():
+    import numpy as np
+    import pandas as pd
+
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+def compare_to_baseline(report, baseline):
+    #Ratio of seconds and peak memory to the baseline, for the cohort sizes and stages in both
+    comparison = {}
+
+    for n_samples, cohort in report['cohorts'].items():
+        baseline_stages = baseline['cohorts'].get(n_samples, {}).get('stages', {})
+
+        for stage, result in cohort['stages'].items():
+            baseline_result = baseline_stages.get(stage, {})
+
+            if 'error' in result or 'error' in baseline_result or not baseline_result:
+                continue
+
+            comparison.setdefault(n_samples, {})[stage] = {metric: result[metric] / baseline_result[metric] if baseline_result[metric] else None
+                                                           for metric in ['seconds', 'peak_rss_mb']}
+
+    return comparison
+
+
+def print_report(report):
+    for n_samples, cohort in report['cohorts'].items():
+        for stage, result in cohort['stages'].items():
+            if 'error' in result:
+                print(f'{n_samples:>7} samples  {stage:<22} failed: {result["error"]}')
+                continue
+
+            line = f'{n_samples:>7} samples  {stage:<22} {result["seconds"]:9.3f} s  {result["samples_per_second"]:10.0f} samples/s  {result["peak_rss_mb"]:8.0f} MB'
+
+            ratios = report.get('comparison', {}).get(n_samples, {}).get(stage)
+            if ratios is not None:
+                line += f'  ({ratios["seconds"]:.2f}x time, {ratios["peak_rss_mb"]:.2f}x memory of baseline)'
+
+            print(line)
+
+
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    report = {'environment': environment(), 'cohorts': {}}
+
+    for n_samples in args.samples:
+        cohort_dir = os.path.join(args.workdir, 'cohorts', str(n_samples))
+        work_dir = os.path.join(args.workdir, 'runs', str(n_samples))
+
+        generate_seconds = prepare_cohort(cohort_dir, n_samples, args.seed, args.mhc_seqs)
+
+        #Outputs of earlier runs are prepared again, as they may come from an older version
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+        stages = {}
+        for stage in args.stages:
+            stages[stage] = run_stage_in_process(stage, cohort_dir, work_dir, n_samples, jobs=args.jobs, bootstrap_replicates=args.bootstrap_replicates)
+
+        #json keys are strings
+        report['cohorts'][str(n_samples)] = {'generate_seconds': generate_seconds, 'stages': stages}
+
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as infile:
+            report['comparison'] = compare_to_baseline(report, json.load(infile))
+
+    print_report(report)
+
+    for outfile_path in [args.output] + ([args.baseline] if args.save_baseline else []):
+        if os.path.dirname(outfile_path):
+            os.makedirs(os.path.dirname(outfile_path), exist_ok=True)
+
+        with open(outfile_path, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+
+    if args.save_baseline:
+        print(f'Baseline written to {args.baseline}')
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--samples',
+                        help='Cohort sizes to benchmark',
+                        type=int,
+                        nargs='+',
+                        default=[100, 1000, 10000])
+
+    parser.add_argument('--stages',
+                        help='Stages to benchmark',
+                        nargs='+',
+                        choices=STAGES,
+                        default=STAGES)
+
+    parser.add_argument('--workdir',
+                        help='Folder for the synthetic cohorts and the outputs of the stages',
+                        default='results/benchmark')
+
+    parser.add_argument('--output',
+                        help='Path to write the report to',
+                        default='results/benchmark/report.json')
+
+    parser.add_argument('--baseline',
+                        help='Baseline report to compare against',
+                        default=BASELINE_PATH)
+
+    parser.add_argument('--save-baseline',
+                        help='Store the report as the baseline instead of comparing against it',
+                        action='store_true')
+
+    parser.add_argument('--seed',
+                        help='Seed of the synthetic cohorts',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--mhc-seqs',
+                        help='Table with MHC pseudosequences to draw the alleles from',
+                        default=E_GROUP_PATH)
+
+    parser.add_argument('--jobs',
+                        help='Number of processes for parsing the result files',
+                        type=int,
+                        default=1)
+
+    parser.add_argument('--bootstrap-replicates',
+                        help='Number of bootstrap replicates in summarise_results',
+                        type=int,
+                        default=1000)
+
+    return parser
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+"""
+Estimate the storage and runtime of a pipeline run before it is launched, from the manifest written by create_config.
+
+Every per-sample rule of the Snakefile is modelled by the size of its outputs and its runtime, both as a fixed part
+plus a part proportional to the size of the sample's CRAM (see RULE_COSTS):
+
+    download_wes_samples   the CRAM itself
+    cram_2_bam             name-sorted, fixmated and re-sorted BAM, with temporary sort files while it runs
+    bam2fastq              uncompressed read pairs, the largest intermediate
+    ...
+
+Only the rules in the given Snakefile are counted, so the estimates hold for both Snakefile and Snakefile_slim.
+Shared reference data (reference genome, bwa index, HLA*LA graph) is counted once.
+
+Nothing in the Snakefile is temporary, so a single run needs room for the intermediates of all samples at once.
+With a disk budget, the samples are split into batches that each fit the budget, on the assumption that the
+intermediates of a batch (results/00_cram to results/03_hla_extracted and results/02_kourami_alignment) are removed
+before the next batch starts. A config is written for every batch.
+
+The default costs are rough estimates for 1000 Genomes exomes. They can be calibrated with --costs, a json file with
+the fields of RuleCost for the rules to change: {"cram_2_bam": {"seconds_per_gb": 250}}.
+"""
+
+import argparse
+import json
+import os
+import re
+from collections import namedtuple
+
+import pandas as pd
+
+from hla_typing_benchmark.create_config import read_manifest, write_config
+
+
+GB = 10**9
+
+#Outputs and runtime of a job: output_bytes = fixed_bytes + output_factor * CRAM size, likewise for the temporary
+#files while the job runs (transient) and the runtime in seconds
+RuleCost = namedtuple('RuleCost', ['jobs_per_sample', 'fixed_bytes', 'output_factor', 'transient_factor', 'seconds', 'seconds_per_gb'])
+
+RULE_COSTS = {'download_wes_samples': RuleCost(1, 0, 1.0, 0.0, 5, 20),
+              'index_cram': RuleCost(1, 0, 0.0, 0.0, 10, 15),
+              'cram_2_bam': RuleCost(1, 0, 1.6, 1.6, 60, 300),
+              'index_bam': RuleCost(1, 5 * 10**6, 0.0, 0.0, 10, 20),
+              'bam2fastq': RuleCost(1, 0, 6.0, 1.6, 30, 200),
+              'hla_read_extraction': RuleCost(2, 50 * 10**6, 0.0, 0.0, 120, 450),
+              'hla_extract_conversion': RuleCost(2, 100 * 10**6, 0.0, 0.0, 5, 0),
+              'run_optitype': RuleCost(1, 10**6, 0.0, 0.0, 300, 0),
+              'kourami_mapping': RuleCost(1, 50 * 10**6, 0.02, 0.0, 120, 400),
+              'run_kourami': RuleCost(1, 10 * 10**6, 0.0, 0.0, 600, 0),
+              'run_hisatgenotype': RuleCost(1, 500 * 10**6, 0.0, 0.0, 300, 600),
+              'run_hla_la': RuleCost(1, 100 * 10**6, 0.05, 0.0, 600, 900)}
+
+#Reference data shared by all samples, in bytes
+SHARED_BYTES = {'download_reference_genome': 3.2 * GB,
+                'bwa_index_ref': 5.5 * GB,
+                'download_hla_la_ref': 2.7 * GB,
+                'generate_hla_la_graph': 25 * GB,
+                'index_hla_la_graph': 5 * GB}
+
+#Outputs of these rules are kept after a batch, the rest of the per-sample outputs are removed
+KEPT_RULES = {'run_optitype', 'run_kourami', 'run_hisatgenotype', 'run_hla_la'}
+
+SIZE_UNITS = {'': 1, 'K': 10**3, 'M': 10**6, 'G': 10**9, 'T': 10**12}
+
+
+def parse_size(size):
+    #'500G', '1.5T' or a number of bytes
+    size_match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)B?\s*', str(size).upper())
+
+    if size_match is None:
+        raise ValueError(f'Invalid size: {size}')
+
+    return float(size_match.group(1)) * SIZE_UNITS[size_match.group(2)]
+
+
+def format_size(n_bytes):
+    for unit in ['T', 'G', 'M', 'K']:
+        if n_bytes >= SIZE_UNITS[unit]:
+            return f'{n_bytes / SIZE_UNITS[unit]:.1f} {unit}B'
+
+    return f'{n_bytes:.0f} B'
+
+
+def read_snakefile_rules(snakefile_path):
+    #{rule: threads} of the rules in the Snakefile, 1 thread if none are given
+    with open(snakefile_path, 'r') as infile:
+        snakefile = infile.read().replace('\r\n', '\n')
+
+    rules = {}
+    for rule_block in re.split(r'^rule ', snakefile, flags=re.MULTILINE)[1:]:
+        rule_name = rule_block.split(':')[0].strip()
+        threads_match = re.search(r'^\s+threads:\s*(\d+)', rule_block, flags=re.MULTILINE)
+        rules[rule_name] = int(threads_match.group(1)) if threads_match else 1
+
+    return rules
+
+
+def load_costs(costs_path=None):
+    rule_costs = dict(RULE_COSTS)
+
+    if costs_path is not None:
+        with open(costs_path, 'r') as infile:
+            for rule, fields in json.load(infile).items():
+                rule_costs[rule] = rule_costs.get(rule, RuleCost(1, 0, 0.0, 0.0, 0, 0))._replace(**fields)
+
+    return rule_costs
+
+
+def sample_sizes(manifest_df):
+    """
+    CRAM and CRAI size of every sample. Samples without a known size get the median of the others.
+    """
+    sizes_df = manifest_df.set_index('sample_id')[['cram_bytes', 'crai_bytes']].astype('Float64')
+
+    for column in ['cram_bytes', 'crai_bytes']:
+        median = sizes_df[column].median()
+        sizes_df[column] = sizes_df[column].fillna(0.0 if pd.isna(median) else median)
+
+    return sizes_df.astype(float)
+
+
+def estimate_rules(sizes_df, snakefile_rules, rule_costs):
+    """
+    Outputs, temporary files and runtime of every modelled per-sample rule: one row per rule and sample.
+    """
+    cram_bytes = sizes_df['cram_bytes'].to_numpy()
+    estimates = []
+
+    for rule, cost in rule_costs.items():
+        if rule not in snakefile_rules:
+            continue
+
+        output_bytes = cost.jobs_per_sample * (cost.fixed_bytes + cost.output_factor * cram_bytes)
+
+        #The index is as large as the index on the server
+        if rule == 'index_cram':
+            output_bytes = output_bytes + sizes_df['crai_bytes'].to_numpy()
+
+        estimates.append(pd.DataFrame({'rule': rule,
+                                       'sample_id': sizes_df.index,
+                                       'threads': snakefile_rules[rule],
+                                       'jobs': cost.jobs_per_sample,
+                                       'output_bytes': output_bytes,
+                                       'transient_bytes': cost.transient_factor * cram_bytes,
+                                       'seconds': cost.jobs_per_sample * (cost.seconds + cost.seconds_per_gb * cram_bytes / GB)}))
+
+    return pd.concat(estimates, ignore_index=True)
+
+
+def shared_bytes(snakefile_rules):
+    return sum(n_bytes for rule, n_bytes in SHARED_BYTES.items() if rule in snakefile_rules)
+
+
+def peak_storage(rule_estimates, sample_ids, snakefile_rules, cores):
+    """
+    Peak storage of running the given samples at once: all their outputs, the reference data and the temporary files
+    of as many of the largest jobs as can run at the same time.
+    """
+    batch_estimates = rule_estimates[rule_estimates['sample_id'].isin(sample_ids)]
+
+    transient_rules = batch_estimates[batch_estimates['transient_bytes'] > 0]
+    transient_bytes = 0.0
+    for rule, rule_df in transient_rules.groupby('rule'):
+        concurrent_jobs = max(1, cores // rule_df['threads'].iloc[0])
+        transient_bytes = max(transient_bytes, rule_df['transient_bytes'].nlargest(concurrent_jobs).sum())
+
+    return shared_bytes(snakefile_rules) + batch_estimates['output_bytes'].sum() + transient_bytes
+
+
+def plan_batches(rule_estimates, snakefile_rules, disk_budget, cores):
+    """
+    Split the samples into batches, which each fit the disk budget (first fit, largest samples first).
+    The typing results of earlier batches stay on disk and count against the budget of later batches.
+    """
+    footprints = rule_estimates.groupby('sample_id')['output_bytes'].sum().sort_values(ascending=False)
+    kept_bytes = rule_estimates[rule_estimates['rule'].isin(KEPT_RULES)].groupby('sample_id')['output_bytes'].sum()
+    kept_bytes = kept_bytes.reindex(footprints.index, fill_value=0.0)
+
+    #Room for the temporary files of the largest samples, which may run in any batch
+    largest_transient = peak_storage(rule_estimates, list(footprints.index), snakefile_rules, cores) - shared_bytes(snakefile_rules) - footprints.sum()
+    capacity = disk_budget - shared_bytes(snakefile_rules) - largest_transient - kept_bytes.sum()
+
+    if capacity < footprints.iloc[0] - kept_bytes.iloc[0]:
+        raise ValueError(f'The disk budget of {format_size(disk_budget)} is too small: the largest sample needs '
+                         f'{format_size(footprints.iloc[0] - kept_bytes.iloc[0])}, but only {format_size(max(capacity, 0))} '
+                         f'are left after the reference data, the typing results and the temporary files')
+
+    batches = []
+    batch_bytes = []
+
+    for sample_id, footprint in footprints.items():
+        sample_bytes = footprint - kept_bytes[sample_id]
+
+        for i in range(len(batches)):
+            if batch_bytes[i] + sample_bytes <= capacity:
+                batches[i].append(sample_id)
+                batch_bytes[i] += sample_bytes
+                break
+        else:
+            batches.append([sample_id])
+            batch_bytes.append(sample_bytes)
+
+    return batches
+
+
+def summarise_plan(rule_estimates, snakefile_rules, cores):
+    #Per rule: jobs, outputs and runtime over all samples
+    rule_summary = rule_estimates.groupby('rule', sort=False).agg(jobs=('jobs', 'sum'),
+                                                                  threads=('threads', 'first'),
+                                                                  output_bytes=('output_bytes', 'sum'),
+                                                                  seconds=('seconds', 'sum'))
+    rule_summary['core_hours'] = rule_summary['seconds'] * rule_summary['threads'] / 3600
+
+    #Lower bound with perfect packing of the jobs on the cores
+    wall_hours = rule_summary['core_hours'].sum() / cores
+
+    return rule_summary, wall_hours
+
+
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    manifest_df = read_manifest(args.manifest)
+    sizes_df = sample_sizes(manifest_df)
+    snakefile_rules = read_snakefile_rules(args.snakefile)
+    rule_estimates = estimate_rules(sizes_df, snakefile_rules, load_costs(args.costs))
+
+    not_modelled = sorted(set(snakefile_rules) - set(rule_estimates['rule']) - set(SHARED_BYTES))
+    print(f'{len(sizes_df)} samples, {format_size(sizes_df["cram_bytes"].sum())} of CRAMs. Rules without a cost model (assumed small): {", ".join(not_modelled)}')
+
+    rule_summary, wall_hours = summarise_plan(rule_estimates, snakefile_rules, args.cores)
+
+    for rule, row in rule_summary.iterrows():
+        print(f'{rule:<24} {int(row["jobs"]):>6} jobs  {format_size(row["output_bytes"]):>10}  {row["core_hours"]:10.1f} core hours  ({row["seconds"] / row["jobs"] / 60:.1f} min per job on {int(row["threads"])} threads)')
+
+    peak_bytes = peak_storage(rule_estimates, list(sizes_df.index), snakefile_rules, args.cores)
+    print(f'Peak storage of a single run: {format_size(peak_bytes)}. Runtime on {args.cores} cores: at least {wall_hours:.1f} hours')
+
+    plan = {'samples': len(sizes_df),
+            'cores': args.cores,
+            'peak_storage_bytes': peak_bytes,
+            'wall_hours': wall_hours,
+            'rules': {rule: row.to_dict() for rule, row in rule_summary.iterrows()},
+            'batches': None}
+
+    if args.disk_budget is not None:
+        disk_budget = parse_size(args.disk_budget)
+        batches = plan_batches(rule_estimates, snakefile_rules, disk_budget, args.cores)
+
+        plan['disk_budget_bytes'] = disk_budget
+        plan['batches'] = []
+
+        if args.batch_configs is not None:
+            os.makedirs(args.batch_configs, exist_ok=True)
+
+        urls = dict(zip(manifest_df['sample_id'], manifest_df['url']))
+
+        for i, batch in enumerate(batches, start=1):
+            batch_peak_bytes = peak_storage(rule_estimates, batch, snakefile_rules, args.cores)
+            batch_wall_hours = summarise_plan(rule_estimates[rule_estimates['sample_id'].isin(batch)], snakefile_rules, args.cores)[1]
+            plan['batches'].append({'samples': batch, 'peak_storage_bytes': batch_peak_bytes, 'wall_hours': batch_wall_hours})
+
+            if args.batch_configs is not None:
+                write_config({sample_id: urls[sample_id] for sample_id in sorted(batch)}, os.path.join(args.batch_configs, f'config_batch_{i}.yaml'))
+
+        print(f'{len(batches)} batches fit the disk budget of {format_size(disk_budget)}, '
+              f'with {min(len(batch) for batch in batches)} to {max(len(batch) for batch in batches)} samples each. '
+              f'Remove the intermediates of a batch before starting the next one')
+
+    if args.output is not None:
+        with open(args.output, 'w') as outfile:
+            json.dump(plan, outfile, indent=4)
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--manifest',
+                        help='Manifest with the CRAM and CRAI sizes of the samples (output from create_config)',
+                        default='snakemake/manifest.tsv')
+
+    parser.add_argument('--snakefile',
+                        help='Snakefile of the planned run',
+                        default='snakemake/Snakefile')
+
+    parser.add_argument('--cores',
+                        help='Number of cores of the run (--cores of snakemake)',
+                        type=int,
+                        default=16)
+
+    parser.add_argument('--disk-budget',
+                        help="Disk space available for the run, e.g. '2T' or '500G'. If given, the samples are split into batches, which each fit")
+
+    parser.add_argument('--batch-configs',
+                        help='Folder to write a Snakemake config for every batch to (used together with --disk-budget)')
+
+    parser.add_argument('--costs',
+                        help='json file with calibrated costs of the rules, e.g. {"cram_2_bam": {"seconds_per_gb": 250}}')
+
+    parser.add_argument('--output',
+                        help='Path to write the plan to as json')
+
+    return parser
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Profiling of the Python stages (--profile of parse_typing_results, create_gold_standard and summarise_results).
+
+The stages are timed where they run:
+
+    with get_profiler().stage('parsing/Kourami'):
+        ...
+
+    get_profiler().count('files parsed', len(files_to_parse))
+
+Nothing is recorded until profiling is started with start_profiling, so the stages cost nothing in normal runs.
+The report is written as json:
+
+    {
+        "command": "parse_typing_results",
+        "total_seconds": 12.3,
+        "stages": {"parsing/Kourami": {"seconds": 1.2, "calls": 1}, ...},
+        "counters": {"files parsed": 829, "alleles converted": 5120, "conversion cache hits": ..., ...},
+        "peak_rss_mb": 512.0,
+        "peak_rss_children_mb": 120.0
+    }
+
+Stages can be nested (e.g. a nomenclature table loaded during scoring), so the stage times don't have to add up to the total.
+"""
+
+import cProfile
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    #Not available on Windows, the peak memory is left out of the report
+    resource = None
+
+
+def peak_rss_mb(who='self'):
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN).ru_maxrss
+
+    #ru_maxrss is in bytes on macOS and in kilobytes everywhere else
+    return max_rss / 2**20 if sys.platform == 'darwin' else max_rss / 2**10
+
+
+class Profiler:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stages = {}
+        self.counters = {}
+        self._start = time.perf_counter()
+        self._cprofile = None
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            stage['seconds'] += time.perf_counter() - start
+            stage['calls'] += 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def start_cprofile(self):
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+
+    def report(self, command, nomenclature=None):
+        counters = dict(self.counters)
+
+        #Conversions of the nomenclature, every miss is an allele actually converted
+        if nomenclature is not None:
+            cache_info = nomenclature.converter.cache_info()
+            counters['alleles converted'] = cache_info.misses
+            counters['conversion cache hits'] = cache_info.hits
+            counters['conversion cache misses'] = cache_info.misses
+
+        return {'command': command,
+                'total_seconds': time.perf_counter() - self._start,
+                'stages': self.stages,
+                'counters': counters,
+                'peak_rss_mb': peak_rss_mb('self'),
+                'peak_rss_children_mb': peak_rss_mb('children')}
+
+    def write(self, report_path, command, nomenclature=None, cprofile_path=None):
+        """
+        Write the report (and the cProfile statistics, if they were collected) and print a summary for the run log.
+        """
+        report = self.report(command, nomenclature)
+
+        if os.path.dirname(report_path):
+            os.makedirs(os.path.dirname(report_path), exist_ok=True)
+
+        with open(report_path, 'w') as outfile:
+            json.dump(report, outfile, indent=4)
+
+        if self._cprofile is not None and cprofile_path is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(cprofile_path)
+
+        slowest_stages = sorted(report['stages'].items(), key=lambda stage: stage[1]['seconds'], reverse=True)[:3]
+        slowest_stages = ', '.join(f"{name} ({stage['seconds']:.2f} s)" for name, stage in slowest_stages)
+        peak_rss = 'unknown' if report['peak_rss_mb'] is None else f"{report['peak_rss_mb']:.0f} MB"
+        print(f"Profile of {command}: {report['total_seconds']:.2f} s, peak RSS {peak_rss}. Slowest stages: {slowest_stages}")
+
+        return report
+
+
+#Profiler used by all stages. Disabled until start_profiling is called
+_profiler = Profiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def start_profiling(cprofile=False):
+    global _profiler
+    _profiler = Profiler(enabled=True)
+
+    if cprofile:
+        _profiler.start_cprofile()
+
+    return _profiler
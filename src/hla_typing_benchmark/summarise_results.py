@@ -14,6 +14,9 @@ import argparse
 
 from collections import Counter
 
+from hla_typing_benchmark.parse_data import RESOLUTIONS
+from hla_typing_benchmark.profiling import get_profiler, start_profiling
+
 
 #Set seaborn color palette:
 palette_list = list(sns.color_palette("colorblind"))
@@ -43,15 +46,30 @@ def generate_results_as_table(results_dict):
                         if locus not in reformatted_dict[(tool, metric)]:
                             reformatted_dict[(tool, metric)][locus] = value
 
+                    #Bootstrap confidence intervals, if added with add_confidence_intervals
+                    elif metric in ('typing_accuracy_ci', 'call_rate_ci'):
+                        ci_metric = resolution if metric == 'typing_accuracy_ci' else 'call_rate'
+                        for bound, bound_value in zip(['CI low', 'CI high'], value):
+                            if (tool, f'{ci_metric} {bound}') not in reformatted_dict:
+                                reformatted_dict[(tool, f'{ci_metric} {bound}')] = dict()
+                            if locus not in reformatted_dict[(tool, f'{ci_metric} {bound}')]:
+                                reformatted_dict[(tool, f'{ci_metric} {bound}')][locus] = bound_value
+
         results_df = pd.DataFrame(reformatted_dict)
 
+        #Resolutions beyond the original four (e.g. G group and 3-field) are added after them
+        table_metric_order = metric_order + [resolution for resolution in results_dict if resolution not in metric_order]
+
         multi_tuples = []
         for tool in tool_order:
             #Only add results if typing exists for this tool
             if tool in results_dict['1-field'].keys():
-                for metric in metric_order:
+                for metric in table_metric_order:
                     multi_tuples += [(tool, metric)]
 
+                    #Confidence intervals next to their metric
+                    multi_tuples += [(tool, f'{metric} {bound}') for bound in ['CI low', 'CI high'] if (tool, f'{metric} {bound}') in reformatted_dict]
+
         multi_cols = pd.MultiIndex.from_tuples(multi_tuples, names=['Tool', 'Metric'])
 
         results_df = pd.DataFrame(results_df, columns=multi_cols)
@@ -64,6 +82,126 @@ def extract_results(results_dict, allele_index, resolution, labels):
     return res_list 
 
 
+def extract_errors(results_dict, allele_index, resolution, labels, metric = 'typing_accuracy'):
+    #Error bars from the bootstrap confidence intervals, if they have been added to the results
+    if not all(f'{metric}_ci' in results_dict[resolution][l][allele_index] for l in labels):
+        return None
+
+    values = [results_dict[resolution][l][allele_index][metric] for l in labels]
+    intervals = [results_dict[resolution][l][allele_index][f'{metric}_ci'] for l in labels]
+
+    return np.array([[value - low for value, (low, high) in zip(values, intervals)],
+                     [high - value for value, (low, high) in zip(values, intervals)]])
+
+
+# Bootstrap confidence intervals
+
+#Loci summed up in the summary entries and the number of loci they span
+LOCUS_GROUPS = {'HLA-I': ['A', 'B', 'C'],
+                'HLA-II': ['DRB1', 'DQB1'],
+                'Total': ['A', 'B', 'C', 'DRB1', 'DQB1']}
+
+
+def load_sample_scores(details_path):
+    """
+    Read the per-sample records written by parse_typing_results --details as arrays (see sample_score_arrays).
+    """
+    details_df = pd.read_json(details_path, lines=True)
+    details_df['resolution'] = details_df['resolution'].map(lambda resolution: RESOLUTIONS[resolution].label)
+    details_df['score'] = 2 - details_df['miscalls']
+
+    return sample_score_arrays(details_df)
+
+
+def sample_score_arrays(sample_scores_df):
+    """
+    Per-sample scores with the columns resolution (label), tool, subject, locus, count and score, as written by
+    parse_typing_results --details or returned by load_all_results.
+    Returns the list of (resolution, tool, locus) cells and two arrays (samples x cells) with the number of calls and
+    correct calls of every sample. The summary entries HLA-I, HLA-II and Total are added as cells.
+    """
+    subject_codes, subjects = pd.factorize(sample_scores_df['subject'])
+    cell_codes, locus_cells = pd.factorize(pd.MultiIndex.from_frame(sample_scores_df[['resolution', 'tool', 'locus']]))
+
+    counts = np.zeros((len(subjects), len(locus_cells)))
+    scores = np.zeros((len(subjects), len(locus_cells)))
+    counts[subject_codes, cell_codes] = sample_scores_df['count'].to_numpy()
+    scores[subject_codes, cell_codes] = sample_scores_df['score'].to_numpy()
+
+    #Sum the loci of the summary entries with a membership matrix
+    cells = list(locus_cells)
+    cell_index = {cell: i for i, cell in enumerate(cells)}
+    group_cells = []
+    group_columns = []
+
+    for resolution, tool in dict.fromkeys((resolution, tool) for resolution, tool, locus in cells):
+        for group, loci in LOCUS_GROUPS.items():
+            members = [cell_index[(resolution, tool, locus)] for locus in loci if (resolution, tool, locus) in cell_index]
+
+            if members:
+                group_cells.append((resolution, tool, group))
+                group_columns.append(members)
+
+    membership = np.zeros((len(cells), len(group_cells)))
+    for column, members in enumerate(group_columns):
+        membership[members, column] = 1
+
+    return cells + group_cells, np.hstack([counts, counts @ membership]), np.hstack([scores, scores @ membership])
+
+
+def bootstrap_confidence_intervals(sample_scores, n_replicates = 10000, confidence = 0.95, seed = None, chunk_size = 1000):
+    """
+    Bootstrap confidence intervals of call rate and typing accuracy, resampling the samples with replacement.
+    The per-sample scores are either a details file (parse_typing_results --details) or a DataFrame (see sample_score_arrays).
+    All cells are resampled together: each replicate is a row of an index matrix, which is turned into sample weights,
+    so the sums of all cells are one matrix product. Returns {resolution: {tool: {locus: {'call_rate_ci': [low, high], 'typing_accuracy_ci': [low, high]}}}}.
+    """
+    cells, counts, scores = load_sample_scores(sample_scores) if isinstance(sample_scores, str) else sample_score_arrays(sample_scores)
+    n_samples = counts.shape[0]
+
+    #Two calls per locus and sample, as in parse_typing_results
+    n_loci = np.array([len(LOCUS_GROUPS[locus]) if locus in LOCUS_GROUPS else 1 for resolution, tool, locus in cells])
+    total_calls = 2 * n_loci * n_samples
+
+    values = np.hstack([counts, scores])
+    rng = np.random.default_rng(seed)
+    replicate_sums = []
+
+    #Draw the replicates in chunks to keep the index matrix small
+    for start in range(0, n_replicates, chunk_size):
+        n_chunk = min(chunk_size, n_replicates - start)
+        sample_index = rng.integers(0, n_samples, size=(n_chunk, n_samples))
+
+        #Number of times each sample is drawn in each replicate
+        offsets = np.arange(n_chunk)[:, None] * n_samples
+        weights = np.bincount((sample_index + offsets).ravel(), minlength=n_chunk * n_samples).reshape(n_chunk, n_samples)
+
+        replicate_sums.append(weights @ values)
+
+    replicate_sums = np.vstack(replicate_sums)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(replicate_sums, [alpha, 1 - alpha], axis=0) * 100 / np.tile(total_calls, 2)
+
+    n_cells = len(cells)
+    confidence_intervals = {}
+
+    for i, (resolution, tool, locus) in enumerate(cells):
+        confidence_intervals.setdefault(resolution, {}).setdefault(tool, {})[locus] = {'call_rate_ci': [float(low[i]), float(high[i])],
+                                                                                      'typing_accuracy_ci': [float(low[n_cells + i]), float(high[n_cells + i])]}
+
+    return confidence_intervals
+
+
+def add_confidence_intervals(results_dict, confidence_intervals):
+    for resolution, tool_dict in confidence_intervals.items():
+        for tool, locus_dict in tool_dict.items():
+            for locus, interval_dict in locus_dict.items():
+                if locus in results_dict.get(resolution, {}).get(tool, {}):
+                    results_dict[resolution][tool][locus].update(interval_dict)
+
+    return results_dict
+
+
 # Plots of the Performance of the tools
 
 tool_plot_names = {
@@ -102,12 +240,19 @@ def make_class_plot_from_allele_list(results_dict):
         x = np.arange(len(labels1)) # the label locations
         
     
+        #Bootstrap confidence intervals as error bars (None if they haven't been added)
+        error_call_rate = extract_errors(results_dict, allele_index, '1-field', labels1, 'call_rate')
+        error_one_field = extract_errors(results_dict, allele_index, '1-field', labels1)
+        error_two_field = extract_errors(results_dict, allele_index, '2-field', labels1)
+        error_p_group = extract_errors(results_dict, allele_index, 'P group', labels1)
+        error_e_group = extract_errors(results_dict, allele_index, 'pseudosequence', labels1)
+
         width = 0.18  # the width of the bars
-        rects1 = ax.bar(x - 10.3*width/5, call_rate, width, label='call rate', color = '#808080')
-        rects2 = ax.bar(x - 5*width/5, accuracy_one_field, width, label='1-field accuracy', color = palette_list[0])
-        rects3 = ax.bar(x, accuracy_e_group, width, label='Pseudoseq accuracy', color = palette_list[1])
-        rects4 = ax.bar(x + 5*width/5, accuracy_p_group, width, label='P group accuracy', color = palette_list[2])
-        rects5 = ax.bar(x + 10*width/5, accuracy_two_field, width, label='2-field accuracy', color = palette_list[3])
+        rects1 = ax.bar(x - 10.3*width/5, call_rate, width, yerr=error_call_rate, capsize=3, label='call rate', color = '#808080')
+        rects2 = ax.bar(x - 5*width/5, accuracy_one_field, width, yerr=error_one_field, capsize=3, label='1-field accuracy', color = palette_list[0])
+        rects3 = ax.bar(x, accuracy_e_group, width, yerr=error_e_group, capsize=3, label='Pseudoseq accuracy', color = palette_list[1])
+        rects4 = ax.bar(x + 5*width/5, accuracy_p_group, width, yerr=error_p_group, capsize=3, label='P group accuracy', color = palette_list[2])
+        rects5 = ax.bar(x + 10*width/5, accuracy_two_field, width, yerr=error_two_field, capsize=3, label='2-field accuracy', color = palette_list[3])
 
         # Add some text for labels, title and custom x-axis tick labels, etc.
         ax.set_ylabel('%', size = 22)
@@ -219,12 +364,19 @@ def make_loci_plot_from_allele_list(results_dict):
         x = np.arange(len(labels1))
         
 
+        #Bootstrap confidence intervals as error bars (None if they haven't been added)
+        error_call_rate = extract_errors(results_dict, allele_index, '1-field', labels1, 'call_rate')
+        error_one_field = extract_errors(results_dict, allele_index, '1-field', labels1)
+        error_two_field = extract_errors(results_dict, allele_index, '2-field', labels1)
+        error_p_group = extract_errors(results_dict, allele_index, 'P group', labels1)
+        error_e_group = extract_errors(results_dict, allele_index, 'pseudosequence', labels1)
+
         width = 0.18  # the width of the bars
-        rects1 = ax.bar(x - 10.4*width/5, call_rate, width, label='call rate', color = '#808080')
-        rects2 = ax.bar(x - 5*width/5, accuracy_one_field, width, label='1-field accuracy', color = palette_list[0])
-        rects3 = ax.bar(x, accuracy_e_group, width, label='Pseudoseq accuracy', color = palette_list[1])
-        rects4 = ax.bar(x + 5*width/5, accuracy_p_group, width, label='P group accuracy', color = palette_list[2])
-        rects5 = ax.bar(x + 10*width/5, accuracy_two_field, width, label='2-field accuracy', color = palette_list[3])
+        rects1 = ax.bar(x - 10.4*width/5, call_rate, width, yerr=error_call_rate, capsize=3, label='call rate', color = '#808080')
+        rects2 = ax.bar(x - 5*width/5, accuracy_one_field, width, yerr=error_one_field, capsize=3, label='1-field accuracy', color = palette_list[0])
+        rects3 = ax.bar(x, accuracy_e_group, width, yerr=error_e_group, capsize=3, label='Pseudoseq accuracy', color = palette_list[1])
+        rects4 = ax.bar(x + 5*width/5, accuracy_p_group, width, yerr=error_p_group, capsize=3, label='P group accuracy', color = palette_list[2])
+        rects5 = ax.bar(x + 10*width/5, accuracy_two_field, width, yerr=error_two_field, capsize=3, label='2-field accuracy', color = palette_list[3])
 
         # Add some text for labels, title and custom x-axis tick labels, etc.
         ax.set_ylabel('%', size = 20)
@@ -298,25 +450,70 @@ def make_loci_plot_from_allele_list(results_dict):
 
 
 
+def summarise(results_dict, results_table_path, class_plot_path, loci_plot_path, details_path = None, bootstrap_replicates = 10000, confidence = 0.95, seed = None, sample_scores = None):
+    """
+    Write the results table and plots for the typing results (output from parse_typing_results).
+    If the per-sample results are given, either as a details file or as the DataFrame from load_all_results,
+    bootstrap confidence intervals are added to both.
+    """
+    profiler = get_profiler()
+
+    if sample_scores is None:
+        sample_scores = details_path
+
+    #Add bootstrap confidence intervals from the per-sample results
+    if sample_scores is not None:
+        with profiler.stage('bootstrap'):
+            confidence_intervals = bootstrap_confidence_intervals(sample_scores,
+                                                                  n_replicates=bootstrap_replicates,
+                                                                  confidence=confidence,
+                                                                  seed=seed)
+            add_confidence_intervals(results_dict, confidence_intervals)
+
+    with profiler.stage('results table'):
+        results_df = generate_results_as_table(results_dict)
+
+    with profiler.stage('write/results table'):
+        results_df.to_csv(results_table_path, sep='\t')
+
+    #Generate plots
+
+    with profiler.stage('plotting/class plot'):
+        fig = make_class_plot_from_allele_list(results_dict)
+    with profiler.stage('write/class plot'):
+        fig.savefig(class_plot_path, dpi=600)
+
+    with profiler.stage('plotting/loci plot'):
+        fig = make_loci_plot_from_allele_list(results_dict)
+    with profiler.stage('write/loci plot'):
+        fig.savefig(loci_plot_path, dpi=600)
+
+
+
 def main():
     parser = get_argparser()
     args = parser.parse_args()
 
-    #Load and reformat results
-    with open(args.typing_results, 'r') as infile:
-        results_dict = json.load(infile)
-
-    results_df = generate_results_as_table(results_dict)
+    if args.profile is not None:
+        start_profiling(cprofile=args.cprofile is not None)
 
-    results_df.to_csv(args.results_table, sep='\t')
+    profiler = get_profiler()
 
-    #Generate plots
+    #Load and reformat results
+    with profiler.stage('read results'), open(args.typing_results, 'r') as infile:
+        results_dict = json.load(infile)
 
-    fig = make_class_plot_from_allele_list(results_dict)
-    fig.savefig(args.class_plot, dpi=600)
+    summarise(results_dict,
+              args.results_table,
+              args.class_plot,
+              args.loci_plot,
+              details_path=args.details,
+              bootstrap_replicates=args.bootstrap_replicates,
+              confidence=args.confidence,
+              seed=args.seed)
 
-    fig = make_loci_plot_from_allele_list(results_dict)
-    fig.savefig(args.loci_plot, dpi=600)
+    if args.profile is not None:
+        profiler.write(args.profile, 'summarise_results', cprofile_path=args.cprofile)
 
 
 
@@ -327,6 +524,23 @@ def get_argparser():
                          help='Path to typing_results.json (output from parse_typing_results)',
                          default='results/05_collected_typing_results/typing_results.json')
 
+    parser.add_argument('--details',
+                         help='Per-sample results (output from parse_typing_results --details). If given, bootstrap confidence intervals are added to the table and plots')
+
+    parser.add_argument('--bootstrap-replicates',
+                        help='Number of bootstrap replicates for the confidence intervals',
+                        type=int,
+                        default=10000)
+
+    parser.add_argument('--confidence',
+                        help='Confidence level of the bootstrap confidence intervals',
+                        type=float,
+                        default=0.95)
+
+    parser.add_argument('--seed',
+                        help='Seed for the bootstrap resampling, for reproducible confidence intervals',
+                        type=int)
+
     parser.add_argument('--results-table',
                         help='Path to write a table with a summary of results',
                         default='results/01_1000G_reference/1000G_2014_cleaned.tsv')
@@ -339,6 +553,12 @@ def get_argparser():
                         help='Generate plot with an overview of HLA-A, -B, -C and -DRB1 performance',
                         default='results/05_collected_typing_results/HLA_loci_performance.jpg')
 
+    parser.add_argument('--profile',
+                        help='Path to write a profile of the run as json: wall time per stage and peak memory')
+
+    parser.add_argument('--cprofile',
+                        help='Path to write cProfile statistics of the run to (used together with --profile)')
+
     return parser
 
 
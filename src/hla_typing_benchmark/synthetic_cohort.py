@@ -0,0 +1,328 @@
+"""
+Synthetic cohorts for the performance benchmark (see performance_benchmark).
+
+For N samples, format-correct outputs of all four typing tools, a gold standard in the 1000G format and matching
+IMGT nomenclature tables are written, with alleles drawn from classic.mhc_seqs.tsv:
+
+    <cohort>/cohort.json                                      parameters of the cohort
+    <cohort>/config.yaml                                      sample_urls of all samples
+    <cohort>/1000G_hla_diversity_2014.txt                     gold standard, as downloaded
+    <cohort>/gold_standard.pkl                                gold standard, as written by create_gold_standard
+    <cohort>/00_IMGT_reference/{Deleted_alleles.txt, hla_nom_p.txt, hla_nom_g.txt}
+    <cohort>/04_kourami/<sample>/<sample>_result.tsv
+    <cohort>/04_optitype/<sample>/<sample>_result.tsv
+    <cohort>/04_hla-la/<sample>/hla/R1_bestguess_G.txt
+    <cohort>/04_hisat-genotype/<sample>/<sample>_results.txt
+
+Alleles are drawn with Zipf-like frequencies, so a few alleles are common as in real cohorts. Every tool calls the
+gold standard allele with a fixed accuracy and otherwise an allele of the same locus. Some samples have an empty
+output, have ambiguous gold standard alleles or are typed twice in the gold standard, as in the real data.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from hla_typing_benchmark.parse_data import E_GROUP_PATH, parse_allele, read_pseudosequences
+from hla_typing_benchmark.tool_parsers import LOCI, TOOL_FORMATS
+
+
+#Result folders of the tools, as in the Snakefile
+TOOL_FOLDERS = {'Kourami': '04_kourami', 'HLA-LA': '04_hla-la', 'Optitype': '04_optitype', 'Hisatgenotype': '04_hisat-genotype'}
+
+#Fraction of correct calls per tool
+TOOL_ACCURACY = {'Kourami': 0.95, 'HLA-LA': 0.9, 'Optitype': 0.97, 'Hisatgenotype': 0.85}
+
+CLASS_I_LOCI = ('A', 'B', 'C')
+POPULATIONS = ['GBR', 'FIN', 'CEPH', 'TSI', 'IBS', 'CHS', 'CHB', 'JPT', 'YRI', 'LWK', 'ASW', 'MXL', 'PUR', 'CLM']
+
+GOLD_STANDARD_FILENAME = '1000G_hla_diversity_2014.txt'
+COHORT_FILENAME = 'cohort.json'
+
+
+def allele_pool(mhc_seqs_path=E_GROUP_PATH):
+    """
+    Two field alleles of each locus with their pseudosequence: {locus: [(allele, pseudosequence)]}.
+    Only alleles with a two digit first field and two or three digit second field are used, which all tools can report.
+    """
+    pool = {locus: {} for locus in LOCI}
+
+    for allele, pseudosequence in read_pseudosequences(mhc_seqs_path):
+        parsed_allele = parse_allele(allele)
+
+        #The table lists an allele once for each of its sequences, the first one is kept
+        if parsed_allele is not None and len(parsed_allele.fields) == 2 and len(parsed_allele.fields[1]) <= 3 and parsed_allele.gene in pool:
+            pool[parsed_allele.gene].setdefault(allele, pseudosequence)
+
+    return {locus: list(alleles.items()) for locus, alleles in pool.items()}
+
+
+def field_string(allele):
+    #The 1000G gold standard lists the alleles without the locus
+    return allele.split('*')[1]
+
+
+def cohort_parameters(n_samples, seed=0, mhc_seqs_path=E_GROUP_PATH, empty_fraction=0.01, duplicate_fraction=0.01, ambiguous_fraction=0.05):
+    #Stored as cohort.json, a cohort with the same parameters is the same cohort
+    return {'n_samples': n_samples,
+            'seed': seed,
+            'mhc_seqs_path': os.path.abspath(mhc_seqs_path),
+            'empty_fraction': empty_fraction,
+            'duplicate_fraction': duplicate_fraction,
+            'ambiguous_fraction': ambiguous_fraction}
+
+
+class SyntheticCohort:
+    """
+    Draws the gold standard and the calls of all tools for a synthetic cohort.
+    """
+
+    def __init__(self, n_samples, seed=0, mhc_seqs_path=E_GROUP_PATH, empty_fraction=0.01, duplicate_fraction=0.01, ambiguous_fraction=0.05):
+        self.n_samples = n_samples
+        self.seed = seed
+        self.mhc_seqs_path = mhc_seqs_path
+        self.empty_fraction = empty_fraction
+        self.duplicate_fraction = duplicate_fraction
+        self.ambiguous_fraction = ambiguous_fraction
+
+        self.rng = np.random.default_rng(seed)
+        self.pool = allele_pool(mhc_seqs_path)
+        self.alleles = {locus: np.array([allele for allele, pseudosequence in alleles]) for locus, alleles in self.pool.items()}
+
+        #Zipf-like allele frequencies, in random order of the alleles
+        self.frequencies = {}
+        for locus, alleles in self.alleles.items():
+            weights = 1 / self.rng.permutation(np.arange(1, len(alleles) + 1))
+            self.frequencies[locus] = weights / weights.sum()
+
+        self.sample_ids = [f'{"HG" if i % 2 == 0 else "NA"}{i:05d}' for i in range(n_samples)]
+
+    def parameters(self):
+        return cohort_parameters(self.n_samples, self.seed, self.mhc_seqs_path, self.empty_fraction, self.duplicate_fraction, self.ambiguous_fraction)
+
+    def draw(self, locus, size):
+        return self.rng.choice(self.alleles[locus], size=size, p=self.frequencies[locus])
+
+    def gold_standard(self):
+        """
+        Candidates of both haplotypes of every sample and locus: {locus: [[[candidates], [candidates]] per sample]}.
+        """
+        gold_standard = {}
+
+        for locus in LOCI:
+            alleles = self.draw(locus, (self.n_samples, 2))
+            alternatives = self.draw(locus, (self.n_samples, 2))
+            ambiguous = self.rng.random((self.n_samples, 2)) < self.ambiguous_fraction
+
+            gold_standard[locus] = [[[alleles[i, haplotype]] + ([alternatives[i, haplotype]] if ambiguous[i, haplotype] and alternatives[i, haplotype] != alleles[i, haplotype] else [])
+                                     for haplotype in range(2)]
+                                    for i in range(self.n_samples)]
+
+        return gold_standard
+
+    def calls(self, gold_standard, tool):
+        """
+        Calls of a tool: {locus: [[call 1, call 2] per sample]}, or None for samples with an empty output.
+        """
+        accuracy = TOOL_ACCURACY[tool]
+        loci = CLASS_I_LOCI if tool == 'Optitype' else LOCI
+        tool_calls = {}
+
+        for locus in loci:
+            correct = self.rng.random((self.n_samples, 2)) < accuracy
+            wrong_alleles = self.draw(locus, (self.n_samples, 2))
+
+            tool_calls[locus] = [[gold_standard[locus][i][haplotype][0] if correct[i, haplotype] else wrong_alleles[i, haplotype] for haplotype in range(2)]
+                                 for i in range(self.n_samples)]
+
+        empty = self.rng.random(self.n_samples) < self.empty_fraction
+
+        return [None if empty[i] else {locus: tool_calls[locus][i] for locus in loci} for i in range(self.n_samples)]
+
+
+# Output formats
+
+def kourami_result(sample_calls, rng):
+    lines = []
+    for locus, calls in sample_calls.items():
+        for allele in calls:
+            lines.append(f'{allele}:01G\t1.0\t{rng.integers(50, 300)}\t{rng.integers(50, 300)}\n')
+
+    return ''.join(lines)
+
+
+def optitype_result(sample_calls, rng):
+    alleles = [allele for locus in CLASS_I_LOCI for allele in sample_calls[locus]]
+    return '\tA1\tA2\tB1\tB2\tC1\tC2\tReads\tObjective\n' + '\t'.join(['0'] + alleles + [f'{rng.integers(200, 900)}.0', f'{rng.uniform(100, 800):.1f}']) + '\n'
+
+
+def hla_la_result(sample_calls, rng):
+    lines = ['Locus\tChromosome\tAllele\tQ1\tQ2\n']
+    for locus, calls in sample_calls.items():
+        for chromosome, allele in enumerate(calls, start=1):
+            lines.append(f'{locus}\t{chromosome}\t{allele}:01G\t1\t1\n')
+
+    #HLA*LA also types loci, which aren't evaluated
+    lines += ['DQA1\t1\tDQA1*01:01:01G\t1\t1\n', 'DQA1\t2\tDQA1*01:01:01G\t1\t1\n']
+
+    return ''.join(lines)
+
+
+def hisat_genotype_result(sample_calls, rng, candidates):
+    lines = ['hisatgenotype report\n']
+    for locus, calls in sample_calls.items():
+        lines.append(f'\t{locus}\n')
+
+        #Homozygous calls are only reported once
+        ranked_alleles = list(dict.fromkeys(calls)) + [candidates[locus]]
+        abundances = [50.0, 50.0] if len(set(calls)) == 2 else [99.0]
+
+        for rank, allele in enumerate(ranked_alleles, start=1):
+            abundance = abundances[rank - 1] if rank <= len(abundances) else 1.0
+            lines.append(f'\t\t{rank} ranked {allele}:01 (abundance: {abundance:.2f}%)\n')
+
+    return ''.join(lines)
+
+
+def write_file(filepath, content):
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+
+    with open(filepath, 'w') as outfile:
+        outfile.write(content)
+
+
+def write_gold_standard_file(cohort, gold_standard, outfile_path):
+    #Space separated and quoted, as the 1000G file. Some samples are typed twice
+    header = ['id', 'sbgroup'] + [column for locus in LOCI for column in [locus, f'{locus}.1']]
+    duplicated = cohort.rng.random(cohort.n_samples) < cohort.duplicate_fraction
+    populations = cohort.rng.choice(POPULATIONS, size=cohort.n_samples)
+
+    with open(outfile_path, 'w') as outfile:
+        outfile.write(' '.join(f'"{column}"' for column in header) + '\n')
+
+        for i, sample_id in enumerate(cohort.sample_ids):
+            fields = [sample_id, populations[i]] + ['/'.join(field_string(allele) for allele in gold_standard[locus][i][haplotype]) for locus in LOCI for haplotype in range(2)]
+            line = ' '.join(f'"{field}"' for field in fields) + '\n'
+
+            outfile.write(line * (2 if duplicated[i] else 1))
+
+
+def write_cleaned_gold_standard(cohort, gold_standard, outfile_path):
+    #The gold standard as create_gold_standard writes it, for stages which run without it
+    gold_standard_df = pd.DataFrame({locus: gold_standard[locus] for locus in LOCI}, index=pd.Index(cohort.sample_ids, name='id'))
+    gold_standard_df.to_pickle(outfile_path)
+
+
+def write_nomenclature_tables(cohort, outdir):
+    """
+    IMGT tables for the alleles of the pool. Alleles of the same locus and first field with the same pseudosequence
+    share a P group and a G group.
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    with open(os.path.join(outdir, 'Deleted_alleles.txt'), 'w') as outfile:
+        outfile.write('# file: Deleted_alleles.txt\n# synthetic\nAlleleID,Allele,Description\n')
+
+        #Renamed alleles, which are not in the pool
+        for i, locus in enumerate(LOCI):
+            allele = cohort.alleles[locus][0]
+            outfile.write(f'HLA9{i:04d},{allele.split(":")[0]}:999,Renamed {allele}\n')
+
+    groups = {}
+    for locus, alleles in cohort.pool.items():
+        for allele, pseudosequence in alleles:
+            groups.setdefault((locus, field_string(allele).split(':')[0], pseudosequence), []).append(field_string(allele))
+
+    for filename, suffix, group_suffix in [('hla_nom_p.txt', ':01', 'P'), ('hla_nom_g.txt', ':01', ':01G')]:
+        with open(os.path.join(outdir, filename), 'w') as outfile:
+            outfile.write(f'# file: {filename}\n# synthetic\n')
+
+            for (locus, first_field, pseudosequence), fields in groups.items():
+                if len(fields) == 1:
+                    outfile.write(f'{locus}*;{fields[0]}{suffix};\n')
+                else:
+                    outfile.write(f'{locus}*;{"/".join(field + suffix for field in fields)};{fields[0]}{group_suffix}\n')
+
+
+def generate_cohort(outdir, n_samples, seed=0, mhc_seqs_path=E_GROUP_PATH, **fractions):
+    """
+    Write a synthetic cohort of n_samples to outdir. Returns the SyntheticCohort.
+    """
+    cohort = SyntheticCohort(n_samples, seed=seed, mhc_seqs_path=mhc_seqs_path, **fractions)
+    os.makedirs(outdir, exist_ok=True)
+
+    gold_standard = cohort.gold_standard()
+    write_gold_standard_file(cohort, gold_standard, os.path.join(outdir, GOLD_STANDARD_FILENAME))
+    write_cleaned_gold_standard(cohort, gold_standard, os.path.join(outdir, 'gold_standard.pkl'))
+    write_nomenclature_tables(cohort, os.path.join(outdir, '00_IMGT_reference'))
+
+    with open(os.path.join(outdir, 'config.yaml'), 'w') as outfile:
+        outfile.write('sample_urls:\n')
+        for sample_id in cohort.sample_ids:
+            outfile.write(f'  {sample_id}: "ftp://synthetic/{sample_id}.cram"\n')
+
+    #Lower ranked HISAT-genotype candidates
+    hisat_candidates = {locus: cohort.draw(locus, n_samples) for locus in LOCI}
+
+    for tool, tool_folder in TOOL_FOLDERS.items():
+        output_pattern = TOOL_FORMATS[tool].output_pattern
+
+        for i, sample_calls in enumerate(cohort.calls(gold_standard, tool)):
+            filepath = os.path.join(outdir, tool_folder, output_pattern.format(sample_id=cohort.sample_ids[i]))
+
+            if sample_calls is None:
+                write_file(filepath, '')
+            elif tool == 'Kourami':
+                write_file(filepath, kourami_result(sample_calls, cohort.rng))
+            elif tool == 'Optitype':
+                write_file(filepath, optitype_result(sample_calls, cohort.rng))
+            elif tool == 'HLA-LA':
+                write_file(filepath, hla_la_result(sample_calls, cohort.rng))
+            else:
+                write_file(filepath, hisat_genotype_result(sample_calls, cohort.rng, {locus: hisat_candidates[locus][i] for locus in LOCI}))
+
+    #Written last, so a cohort with a cohort.json is complete
+    with open(os.path.join(outdir, COHORT_FILENAME), 'w') as outfile:
+        json.dump(cohort.parameters(), outfile, indent=4)
+
+    return cohort
+
+
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    generate_cohort(args.output, args.samples, seed=args.seed, mhc_seqs_path=args.mhc_seqs)
+
+    print(f'Synthetic cohort of {args.samples} samples written to {args.output}')
+
+
+def get_argparser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('--samples',
+                        help='Number of samples in the cohort',
+                        type=int,
+                        default=1000)
+
+    parser.add_argument('--seed',
+                        help='Seed of the random generator',
+                        type=int,
+                        default=0)
+
+    parser.add_argument('--mhc-seqs',
+                        help='Table with MHC pseudosequences to draw the alleles from',
+                        default=E_GROUP_PATH)
+
+    parser.add_argument('--output',
+                        help='Folder to write the cohort to',
+                        default='results/benchmark/cohort')
+
+    return parser
+
+
+if __name__ == '__main__':
+    main()
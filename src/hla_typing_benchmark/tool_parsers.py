@@ -0,0 +1,209 @@
+"""
+Parsers for the output formats of the HLA typing tools.
+
+Every parser streams one result file without pandas and returns the raw predictions of a sample
+as a compact record: a dict with a tuple of predictions per locus. Each prediction is a tuple of candidate alleles -
+the called allele first, followed by the alternatives the tool reports (ambiguous alleles or lower ranked alleles).
+Reading stops as soon as all loci have two predictions, unless the rest of the file holds candidates.
+
+A tool is plugged in by registering its parser together with its output path from the Snakefile:
+
+    register_tool_format('MyTool', parse_mytool_file, '{sample_id}/{sample_id}_mytool.txt')
+"""
+
+import os
+import re
+from collections import namedtuple
+
+
+LOCI = ('A', 'B', 'C', 'DRB1', 'DQB1')
+
+#Number of predictions per locus, after which a locus is complete
+CALLS_PER_LOCUS = 2
+
+KOURAMI_ALLELE_PATTERN = re.compile(r'(A|B|C|DRB1|DQB1)\*\d{2}:\d{2,3}:?\d{0,3}G?:?\d{0,3}')
+HISAT_GENOTYPE_RANK_PATTERN = re.compile(r'^\t+(\d+)\sranked (A|B|C|DRB1|DQB1)')
+LOCUS_PATTERN = re.compile(r'(A|B|C|DRB1|DQB1)')
+
+
+# Per-sample record
+
+class SampleCalls:
+    """
+    Collects the raw predictions of one sample per locus.
+    """
+    __slots__ = ('calls', 'n_complete')
+
+    def __init__(self):
+        self.calls = {}
+        self.n_complete = 0
+
+    def add(self, allele, locus=None, candidates=()):
+        if locus is None:
+            locus = LOCUS_PATTERN.search(allele).group(0)
+
+        locus_calls = self.calls.setdefault(locus, [])
+        locus_calls.append((allele,) + tuple(candidates))
+
+        if locus in LOCI and len(locus_calls) == CALLS_PER_LOCUS:
+            self.n_complete += 1
+
+    def is_complete(self):
+        #All loci have two predictions, the rest of the file can be skipped
+        return self.n_complete == len(LOCI)
+
+    def record(self):
+        return {locus: tuple(alleles) for locus, alleles in self.calls.items()}
+
+
+def is_empty(filename):
+    return os.stat(filename).st_size == 0
+
+
+# Parsers
+
+def parse_kourami_file(filename):
+    sample_calls = SampleCalls()
+
+    with open(filename, 'r') as infile:
+        for line in infile:
+            #Find the first match / allele prediction
+            allele_searcher = KOURAMI_ALLELE_PATTERN.search(line)
+
+            if allele_searcher is not None:
+                #Ambiguous alleles of the same locus follow the first one on the line
+                candidates = [candidate.group(0) for candidate in KOURAMI_ALLELE_PATTERN.finditer(line, allele_searcher.end())
+                              if candidate.group(1) == allele_searcher.group(1)]
+                sample_calls.add(allele_searcher.group(0), allele_searcher.group(1), candidates)
+
+                if sample_calls.is_complete():
+                    break
+
+    return sample_calls.record()
+
+
+def parse_hla_la_file(filename):
+    sample_calls = SampleCalls()
+
+    with open(filename, 'r') as infile:
+        header = infile.readline().rstrip('\n').split('\t')
+
+        if 'Allele' not in header:
+            return sample_calls.record()
+
+        allele_column = header.index('Allele')
+
+        for line in infile:
+            fields = line.rstrip('\n').split('\t')
+
+            if len(fields) <= allele_column:
+                continue
+
+            #Ambiguous alleles are separated by ';'
+            allele, *candidates = fields[allele_column].split(';')
+
+            if allele.startswith(LOCI):
+                sample_calls.add(allele, candidates=[candidate for candidate in candidates if candidate.startswith(LOCI)])
+
+                if sample_calls.is_complete():
+                    break
+
+    return sample_calls.record()
+
+
+def parse_optitype_file(filename):
+    sample_calls = SampleCalls()
+
+    #Only the first row after the header holds the prediction: index, A1, A2, B1, B2, C1, C2, reads, objective
+    with open(filename, 'r') as infile:
+        infile.readline()
+        first_row = infile.readline().rstrip('\n').split('\t')
+
+    #Loci without a prediction are left empty
+    for allele in first_row[1:7]:
+        if allele != '':
+            sample_calls.add(allele)
+
+    return sample_calls.record()
+
+
+def parse_hisat_genotype_file(filename):
+    hisatgenotype_resultlist = list()
+
+    sample_calls = SampleCalls()
+
+    #Alleles ranked below the top two are candidates for both predictions of their locus
+    ranked_candidates = {locus: [] for locus in LOCI}
+
+    with open(filename, 'r') as infile:
+        for line in infile:
+            rank_searcher = HISAT_GENOTYPE_RANK_PATTERN.match(line)
+
+            if rank_searcher is not None:
+                allele = line.split()[2]
+
+                if rank_searcher.group(1) in ('1', '2'):
+                    #The lower ranked alleles of the last locus have been read as well
+                    if sample_calls.is_complete():
+                        break
+
+                    hisatgenotype_resultlist.append(allele)
+                    sample_calls.add(allele)
+                else:
+                    ranked_candidates[rank_searcher.group(2)].append(allele)
+
+    #Duplicate prediction for an allele in case of homologous case, so that each gene has two predictions.
+    for allele in LOCI:
+        allele_list = [pred for pred in hisatgenotype_resultlist if pred.startswith(allele)]
+
+        if len(allele_list) == 1:
+            hisatgenotype_resultlist.append(allele_list[0])
+            hisatgenotype_resultlist.sort()
+
+    sample_calls = SampleCalls()
+
+    for allele in hisatgenotype_resultlist:
+        locus = LOCUS_PATTERN.search(allele).group(0)
+        sample_calls.add(allele, locus, ranked_candidates.get(locus, []))
+
+    return sample_calls.record()
+
+
+# Registry
+
+ToolFormat = namedtuple('ToolFormat', ['name', 'parse', 'output_pattern', 'result_extension'])
+
+TOOL_FORMATS = {}
+
+
+def register_tool_format(name, parse, output_pattern, result_extension=None):
+    """
+    Register the parser of a tool format.
+    output_pattern is the path of a sample's result file relative to the tool's result folder, containing {sample_id}.
+    result_extension is used to find the result files when walking the result folder, it defaults to the end of output_pattern.
+    """
+    if not output_pattern.startswith('{sample_id}/'):
+        raise ValueError(f"The output pattern of {name} has to start with the sample folder '{{sample_id}}/'")
+
+    if result_extension is None:
+        result_extension = output_pattern.split('{sample_id}')[-1]
+
+    TOOL_FORMATS[name] = ToolFormat(name, parse, output_pattern, result_extension)
+
+    return TOOL_FORMATS[name]
+
+
+def parse_tool_file(tool, filename):
+    """
+    Parse a result file of a tool. An empty file is a sample without predictions.
+    """
+    if is_empty(filename):
+        return {}
+
+    return TOOL_FORMATS[tool].parse(filename)
+
+
+register_tool_format('Kourami', parse_kourami_file, '{sample_id}/{sample_id}_result.tsv')
+register_tool_format('HLA-LA', parse_hla_la_file, '{sample_id}/hla/R1_bestguess_G.txt', 'R1_bestguess_G.txt')
+register_tool_format('Optitype', parse_optitype_file, '{sample_id}/{sample_id}_result.tsv')
+register_tool_format('Hisatgenotype', parse_hisat_genotype_file, '{sample_id}/{sample_id}_results.txt', 'results.txt')
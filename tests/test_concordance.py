@@ -0,0 +1,78 @@
+import os
+
+import pandas as pd
+import pytest
+
+from hla_typing_benchmark import synthetic_cohort
+from hla_typing_benchmark.concordance import add_summary_scores
+from hla_typing_benchmark.parse_data import all_resolutions, configure_nomenclature
+from hla_typing_benchmark.parse_typing_results import load_sample_ids, load_typing_results, score_subject, validate_typing
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MHC_SEQS_PATH = os.path.join(REPO_DIR, 'reference_data', 'classic.mhc_seqs.tsv')
+
+
+@pytest.fixture(scope='module')
+def cohort(tmp_path_factory):
+    #Typing results of a synthetic cohort, with a few calls the parsers don't give on their own
+    cohort_dir = str(tmp_path_factory.mktemp('cohort'))
+    synthetic_cohort.generate_cohort(cohort_dir, 40, seed=2, mhc_seqs_path=MHC_SEQS_PATH)
+
+    imgt_dir = os.path.join(cohort_dir, '00_IMGT_reference')
+    configure_nomenclature(deleted_filepath=os.path.join(imgt_dir, 'Deleted_alleles.txt'),
+                           p_group_filepath=os.path.join(imgt_dir, 'hla_nom_p.txt'),
+                           e_group_filepath=MHC_SEQS_PATH,
+                           g_group_filepath=os.path.join(imgt_dir, 'hla_nom_g.txt'))
+
+    sample_ids = load_sample_ids(os.path.join(cohort_dir, 'config.yaml'))
+    typing_results_dict = load_typing_results(kourami_path=os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['Kourami']),
+                                              hla_la_path=os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['HLA-LA']),
+                                              optitype_path=os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['Optitype']),
+                                              hisat_genotype_path=os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['Hisatgenotype']),
+                                              sample_ids=sample_ids)
+    gold_standard_df = pd.read_pickle(os.path.join(cohort_dir, 'gold_standard.pkl'))
+
+    kourami_results = typing_results_dict['Kourami']
+    subjects = [subject for subject in sample_ids if kourami_results.get(subject)]
+    reference_a = gold_standard_df.loc[subjects[0], 'A'][0][0]
+
+    #One haplotype called
+    kourami_results[subjects[0]]['A'] = [[reference_a]]
+    #Alleles, which can't be converted, and a missing candidate
+    kourami_results[subjects[1]]['B'] = [['B*XX:YY'], [None]]
+    kourami_results[subjects[2]]['C'] = [['not an allele', reference_a], ['C*99:99:99']]
+    #Several candidates, the correct one not first
+    kourami_results[subjects[3]]['A'] = [['A*99:99', gold_standard_df.loc[subjects[3], 'A'][0][0]], gold_standard_df.loc[subjects[3], 'A'][1]]
+
+    return typing_results_dict, gold_standard_df, sample_ids
+
+
+def per_call_results(typing_results_dict, gold_standard_df, sample_ids, resolutions, candidates):
+    #The results of validate_call, summed per tool and locus
+    results_dict = {resolution: {tool: {locus: {'count': 0, 'score': 0} for locus in gold_standard_df.columns} for tool in typing_results_dict} for resolution in resolutions}
+
+    for tool, tool_results in typing_results_dict.items():
+        for subject in sample_ids:
+            correct_alleles = {locus: gold_standard_df.loc[subject, locus] for locus in gold_standard_df.columns}
+            subject_scores = score_subject(tool_results.get(subject, {}), correct_alleles, resolutions, candidates)
+
+            for resolution in resolutions:
+                for locus, (count, num_correct_hits, correct_call, pred_call) in subject_scores[resolution].items():
+                    results_dict[resolution][tool][locus]['count'] += count
+                    results_dict[resolution][tool][locus]['score'] += num_correct_hits
+
+    for resolution in resolutions:
+        for tool in typing_results_dict:
+            add_summary_scores(results_dict[resolution][tool], len(sample_ids))
+
+    return results_dict
+
+
+@pytest.mark.parametrize('candidates', [1, 3, 0])
+def test_bitset_engine_matches_validate_call(cohort, candidates):
+    typing_results_dict, gold_standard_df, sample_ids = cohort
+    resolutions = all_resolutions()
+
+    results_dict, _ = validate_typing(typing_results_dict, gold_standard_df, sample_ids, resolutions=resolutions, full_results=False, candidates=candidates)
+
+    assert results_dict == per_call_results(typing_results_dict, gold_standard_df, sample_ids, resolutions, candidates)
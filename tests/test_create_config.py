@@ -0,0 +1,164 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import yaml
+
+from hla_typing_benchmark import create_config
+
+GOLD_STANDARD_ROWS = ['"id" "sbgroup" "A" "A.1"',
+                      '"S1" "CEPH" "01:01" "02:01"',
+                      '"S2" "YRI" "01:01" "03:01"',
+                      '"S3" "YRI" "02:01" "03:01"',
+                      '"S4" "GBR" "01:01" "01:01"',
+                      #Typed twice
+                      '"S1" "CEPH" "01:01" "02:01"']
+
+#Content-Length of the files on the server, the other paths are missing (404)
+FILE_SIZES = {'/CEU/S1.cram': 1000, '/CEU/S1.cram.crai': 10,
+              '/YRI/S2.cram': 2000,
+              '/YRI/S3.cram.crai': 30}
+
+#Paths, which answer 503 the first time
+UNAVAILABLE_ONCE = {'/YRI/S2.cram'}
+
+#Paths, which answer with a malformed status line
+MALFORMED = {'/YRI/S3.cram'}
+
+
+class ProbeHandler(BaseHTTPRequestHandler):
+    #Keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.n_connections += 1
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.requests.append((self.path, time.monotonic()))
+            n_requests = sum(path == self.path for path, _ in self.server.requests)
+
+        if self.path in MALFORMED:
+            self.wfile.write(b'HTTP/1.1 abc OK\r\n\r\n')
+            self.close_connection = True
+            return
+
+        if self.path in UNAVAILABLE_ONCE and n_requests == 1:
+            status, size = 503, 0
+        elif self.path in FILE_SIZES:
+            status, size = 200, FILE_SIZES[self.path]
+        else:
+            status, size = 404, 0
+
+        self.send_response(status)
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), ProbeHandler)
+    http_server.daemon_threads = True
+    http_server.lock = threading.Lock()
+    http_server.n_connections = 0
+    http_server.requests = []
+
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+
+    yield http_server
+
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def server_url(server, path):
+    return f'http://127.0.0.1:{server.server_address[1]}{path}'
+
+
+def test_probe_reuses_connections(server):
+    urls = [server_url(server, path) for path in ['/CEU/S1.cram', '/CEU/S1.cram.crai', '/GBR/S4.cram'] * 5]
+
+    probe_results = create_config.probe_urls(urls, concurrency=1, retries=0, timeout=5)
+
+    assert [probe_result.status for probe_result in probe_results] == [200, 200, 404] * 5
+    assert [create_config.content_length(probe_result) for probe_result in probe_results] == [1000, 10, None] * 5
+    assert len(server.requests) == 15
+    assert server.n_connections == 1
+
+
+def test_probe_retries_with_backoff(server):
+    url = server_url(server, '/YRI/S2.cram')
+
+    probe_result, = create_config.probe_urls([url], retries=2, backoff=0.2, timeout=5)
+
+    assert probe_result.status == 200
+    assert probe_result.error is None
+
+    #The 503 is asked again once, after the backoff
+    request_times = [request_time for path, request_time in server.requests]
+    assert len(request_times) == 2
+    assert request_times[1] - request_times[0] >= 0.2
+
+
+def test_malformed_response_only_fails_its_url(server):
+    urls = [server_url(server, path) for path in ['/CEU/S1.cram', '/YRI/S3.cram', '/CEU/S1.cram.crai']]
+
+    probe_results = create_config.probe_urls(urls, concurrency=1, retries=1, backoff=0.01, timeout=5)
+
+    assert [probe_result.url for probe_result in probe_results] == urls
+    assert [probe_result.status for probe_result in probe_results] == [200, None, 200]
+    assert probe_results[0].error is None and probe_results[2].error is None
+    assert probe_results[1].error.startswith('ValueError')
+    assert [path for path, _ in server.requests].count('/YRI/S3.cram') == 2
+
+
+def test_main_writes_config_and_manifest(server, tmp_path, monkeypatch):
+    input_path = tmp_path / '1000G_hla_diversity_2014.txt'
+    input_path.write_text('\n'.join(GOLD_STANDARD_ROWS) + '\n')
+
+    #The folder of the config doesn't exist yet
+    output_path = tmp_path / 'snakemake' / 'config.yaml'
+    url_template = server_url(server, '/{population}/{sample_id}.cram')
+
+    monkeypatch.setattr(sys, 'argv', ['create_config',
+                                      '--input', str(input_path),
+                                      '--output', str(output_path),
+                                      '--url-template', url_template,
+                                      '--reference-genome', 'reference.fa',
+                                      '--retries', '1',
+                                      '--backoff', '0.01',
+                                      '--timeout', '5'])
+    create_config.main()
+
+    #S3 only fails its own URL, S4 has no exome alignment
+    with open(output_path) as infile:
+        config = yaml.safe_load(infile)
+
+    assert config == {'reference_genome': {'GRCh38': 'reference.fa'},
+                      'sample_urls': {'S1': server_url(server, '/CEU/S1.cram'),
+                                      'S2': server_url(server, '/YRI/S2.cram')}}
+
+    manifest_df = create_config.read_manifest(os.path.join(tmp_path, 'snakemake', create_config.MANIFEST_FILENAME))
+
+    assert list(manifest_df.columns) == create_config.MANIFEST_COLUMNS
+    assert list(manifest_df['sample_id']) == ['S1', 'S2']
+    assert list(manifest_df['population']) == ['CEU', 'YRI']
+    assert list(manifest_df['cram_bytes']) == [1000, 2000]
+    assert manifest_df['crai_bytes'][0] == 10
+    assert manifest_df['crai_bytes'].isna()[1]
+
+    #Every sample is probed once per file, apart from the retries
+    paths = [path for path, _ in server.requests]
+    assert sorted(set(paths)) == sorted(['/CEU/S1.cram', '/CEU/S1.cram.crai', '/YRI/S2.cram', '/YRI/S2.cram.crai',
+                                         '/YRI/S3.cram', '/YRI/S3.cram.crai', '/GBR/S4.cram', '/GBR/S4.cram.crai'])
+    assert paths.count('/YRI/S2.cram') == 2
+    assert paths.count('/CEU/S1.cram') == 1
@@ -0,0 +1,99 @@
+import os
+
+import pandas as pd
+import pytest
+import yaml
+
+from hla_typing_benchmark.create_gold_standard import GS_LOCI, load_gs_data
+from hla_typing_benchmark.gold_standard_table import load_gold_standard
+from hla_typing_benchmark.parse_data import configure_nomenclature, get_nomenclature
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MHC_SEQS_PATH = os.path.join(REPO_DIR, 'reference_data', 'classic.mhc_seqs.tsv')
+
+GOLD_STANDARD_ROWS = ['"id" "sbgroup" "A" "A.1" "B" "B.1" "C" "C.1" "DRB1" "DRB1.1" "DQB1" "DQB1.1"',
+                      '"S1" "CEPH" "01:01" "02:01" "07:02" "08:01" "07:01" "07:02" "15:01" "03:01" "06:02" "02:01"',
+                      #Typed twice, with entries missing (0000) from either typing
+                      '"S2" "YRI" "01:01" "0000" "07:02" "08:01" "0000" "07:02" "15:01" "03:01" "06:02" "02:01"',
+                      '"S2" "YRI" "0000" "03:01" "07:02" "35:01" "07:01" "0000" "15:01" "03:01" "06:02" "02:01"',
+                      #Ambiguous typing. A*01 has less than two fields and A*01:999 is deleted (renamed A*01:01)
+                      '"S3" "GBR" "01:01/01:02" "24:02/01" "07:02/08:01" "08:01" "07:01" "07:02" "15:01" "03:01" "06:02" "02:01/02:02"',
+                      '"S4" "GBR" "01:999" "02:01" "07:02" "08:01" "07:01" "07:02" "15:01" "03:01" "06:02" "02:01"',
+                      #Not typed at a locus
+                      '"S5" "GBR" "01:01" "02:01" "07:02" "08:01" "07:01" "07:02" NA NA "06:02" "02:01"',
+                      #Not in the config
+                      '"S6" "GBR" "01:01" "02:01" "07:02" "08:01" "07:01" "07:02" "15:01" "03:01" "06:02" "02:01"']
+
+DELETED_ROWS = ['AlleleID,Allele,Description',
+                'HLA90000,A*01:999,Renamed A*01:01']
+
+P_GROUP_ROWS = ['A*;01:01:01/01:02:01;01:01P',
+                'B*;07:02:01/07:02:02;07:02P']
+
+G_GROUP_ROWS = ['A*;01:01:01/01:02:01;01:01:01G',
+                'B*;07:02:01/07:02:02;07:02:01G']
+
+EXPECTED_ALLELES = {'S1': {'A': [['A*01:01'], ['A*02:01']], 'B': [['B*07:02'], ['B*08:01']], 'C': [['C*07:01'], ['C*07:02']],
+                           'DRB1': [['DRB1*15:01'], ['DRB1*03:01']], 'DQB1': [['DQB1*06:02'], ['DQB1*02:01']]},
+                    'S3': {'A': [['A*01:01', 'A*01:02'], ['A*24:02']], 'B': [['B*07:02', 'B*08:01'], ['B*08:01']], 'C': [['C*07:01'], ['C*07:02']],
+                           'DRB1': [['DRB1*15:01'], ['DRB1*03:01']], 'DQB1': [['DQB1*06:02'], ['DQB1*02:01', 'DQB1*02:02']]},
+                    'S4': {'A': [['A*01:01'], ['A*02:01']], 'B': [['B*07:02'], ['B*08:01']], 'C': [['C*07:01'], ['C*07:02']],
+                           'DRB1': [['DRB1*15:01'], ['DRB1*03:01']], 'DQB1': [['DQB1*06:02'], ['DQB1*02:01']]},
+                    #The merged samples are added after the others
+                    'S2': {'A': [['A*01:01'], ['A*03:01']], 'B': [['B*07:02'], ['B*08:01', 'B*35:01']], 'C': [['C*07:01'], ['C*07:02']],
+                           'DRB1': [['DRB1*15:01'], ['DRB1*03:01']], 'DQB1': [['DQB1*06:02'], ['DQB1*02:01']]}}
+
+
+def sorted_candidates(alleles_df):
+    return {subject: {locus: [sorted(candidates) for candidates in alleles_df.loc[subject, locus]] for locus in GS_LOCI}
+            for subject in alleles_df.index}
+
+
+@pytest.fixture
+def gs_paths(tmp_path):
+    imgt_dir = tmp_path / 'imgt'
+    imgt_dir.mkdir()
+    (imgt_dir / 'Deleted_alleles.txt').write_text('\n'.join(DELETED_ROWS) + '\n')
+    (imgt_dir / 'hla_nom_p.txt').write_text('\n'.join(P_GROUP_ROWS) + '\n')
+    (imgt_dir / 'hla_nom_g.txt').write_text('\n'.join(G_GROUP_ROWS) + '\n')
+
+    configure_nomenclature(deleted_filepath=str(imgt_dir / 'Deleted_alleles.txt'),
+                           p_group_filepath=str(imgt_dir / 'hla_nom_p.txt'),
+                           e_group_filepath=MHC_SEQS_PATH,
+                           g_group_filepath=str(imgt_dir / 'hla_nom_g.txt'))
+
+    gs_data_path = tmp_path / '1000G_hla_diversity_2014.txt'
+    gs_data_path.write_text('\n'.join(GOLD_STANDARD_ROWS) + '\n')
+
+    config_path = tmp_path / 'config.yaml'
+    with open(config_path, 'w') as outfile:
+        yaml.safe_dump({'sample_urls': {sample_id: f'{sample_id}.cram' for sample_id in ['S1', 'S2', 'S3', 'S4', 'S5', 'S7']}}, outfile)
+
+    return str(gs_data_path), str(config_path), str(tmp_path / 'gold_standard.gs')
+
+
+def test_load_gs_data(gs_paths):
+    gs_data_path, config_path, outfile_path = gs_paths
+
+    gold_standard = load_gs_data(gs_data_path, outfile_path, resolutions=['two_field', 'p_group'], config_path=config_path)
+    gold_standard_df = gold_standard.to_frame()
+
+    assert list(gold_standard_df.index) == ['S1', 'S3', 'S4', 'S2']
+    assert list(gold_standard_df.columns) == GS_LOCI
+    assert sorted_candidates(gold_standard_df) == EXPECTED_ALLELES
+
+    #The written table has the same alleles, and the reference alleles converted with the nomenclature
+    gold_standard_table = load_gold_standard(outfile_path)
+
+    assert sorted_candidates(gold_standard_table.to_frame()) == EXPECTED_ALLELES
+    assert gold_standard_table.label_resolutions(get_nomenclature()) == ['two_field', 'p_group']
+
+    long_df = gold_standard_table.to_long(resolutions=['two_field', 'p_group'])
+    converter = get_nomenclature().converter
+
+    for resolution in ['two_field', 'p_group']:
+        expected_labels = [converter.convert(allele, resolution) for allele in long_df['allele']]
+        assert [None if pd.isna(label) else label for label in long_df[resolution]] == expected_labels
+
+    #A*01:02 is in the P group of A*01:01
+    assert set(long_df.loc[long_df['allele'] == 'A*01:02', 'p_group']) == {'A*01:01'}
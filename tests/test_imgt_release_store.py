@@ -0,0 +1,117 @@
+import pytest
+
+from hla_typing_benchmark.imgt_release_store import (DELETED_ALLELES_FILENAME, G_GROUP_FILENAME, P_GROUP_FILENAME, ImgtReleaseStore,
+                                                     update_deleted_conversion_dict, update_p_group_dict)
+from hla_typing_benchmark.parse_data import make_deleted_conversion_dict, make_g_group_dict, make_p_group_dict
+
+BASE_RELEASE = {DELETED_ALLELES_FILENAME: ['# version: 3.0.0',
+                                           'AlleleID,Allele,Description',
+                                           'HLA90000,A*01:999,Renamed A*01:01'],
+                P_GROUP_FILENAME: ['# version: 3.0.0',
+                                   'A*;01:01:01:01/01:02:01/01:999:01;01:01P',
+                                   'A*;02:01:01/02:03:01;02:01P',
+                                   'B*;07:02:01/07:04;07:02P',
+                                   'B*;08:01:01/08:77:01;08:01P',
+                                   'B*;08:77:02;08:77P',
+                                   'C*;07:01:01;',
+                                   'DQB1*;06:02:01/06:03;06:02P'],
+                G_GROUP_FILENAME: ['# version: 3.0.0',
+                                   'A*;01:01:01:01/01:02:01:01/01:999:01:01;01:01:01G',
+                                   'A*;02:01:01:01/02:03:01:01;02:01:01G',
+                                   'B*;07:02:01:01/07:04:01;07:02:01G',
+                                   'B*;08:01:01:01/08:77:01:01;08:01:01G',
+                                   'C*;07:01:01:01;',
+                                   'DQB1*;06:02:01:01/06:03:01;06:02:01G']}
+
+#Lines changed and removed, a new locus, and B*08:77 deleted (renamed B*08:01)
+NEW_RELEASE = {DELETED_ALLELES_FILENAME: ['# version: 3.1.0',
+                                          'AlleleID,Allele,Description',
+                                          'HLA90000,A*01:999,Renamed A*01:01',
+                                          'HLA90001,B*08:77,Renamed B*08:01'],
+               P_GROUP_FILENAME: ['# version: 3.1.0',
+                                  'A*;01:01:01:01/01:02:01/01:999:01;01:01P',
+                                  'A*;02:01:01/02:03:01/02:05:01;02:01P',
+                                  'B*;07:02:01/07:04;07:02P',
+                                  'B*;08:01:01/08:77:01;08:01P',
+                                  'B*;08:77:02;08:77P',
+                                  'DQB1*;06:02:01/06:03;06:02P',
+                                  'DRB1*;15:01:01/15:02;15:01P'],
+               G_GROUP_FILENAME: ['# version: 3.1.0',
+                                  'A*;01:01:01:01/01:02:01:01/01:999:01:01;01:01:01G',
+                                  'A*;02:01:01:01/02:05:01;02:01:01G',
+                                  'B*;07:02:01:01/07:04:01;07:02:01G',
+                                  'B*;08:01:01:01/08:77:01:01;08:01:01G',
+                                  'DQB1*;06:02:01:01/06:03:01;06:02:01G',
+                                  'DRB1*;15:01:01:01/15:02:01;15:01:01G']}
+
+
+def write_release(release_dir, release_files):
+    release_dir.mkdir()
+
+    for filename, lines in release_files.items():
+        (release_dir / filename).write_text('\n'.join(lines) + '\n')
+
+    return {filename: str(release_dir / filename) for filename in release_files}
+
+
+@pytest.fixture
+def releases(tmp_path):
+    return write_release(tmp_path / '3.0.0', BASE_RELEASE), write_release(tmp_path / '3.1.0', NEW_RELEASE)
+
+
+def full_build(release_paths):
+    deleted_conversion_dict = make_deleted_conversion_dict(release_paths[DELETED_ALLELES_FILENAME])
+
+    return {'deleted_conversion_dict': deleted_conversion_dict,
+            'p_group_dict': make_p_group_dict(release_paths[P_GROUP_FILENAME], deleted_conversion_dict),
+            'g_group_dict': make_g_group_dict(release_paths[G_GROUP_FILENAME], deleted_conversion_dict)}
+
+
+def test_update_matches_full_build(releases):
+    base_paths, new_paths = releases
+    base_tables, new_tables = full_build(base_paths), full_build(new_paths)
+
+    deleted_conversion_dict, deleted_rows_compiled = update_deleted_conversion_dict(base_tables['deleted_conversion_dict'],
+                                                                                    base_paths[DELETED_ALLELES_FILENAME],
+                                                                                    new_paths[DELETED_ALLELES_FILENAME])
+
+    assert deleted_rows_compiled == 1
+    assert deleted_conversion_dict == new_tables['deleted_conversion_dict']
+    assert deleted_conversion_dict != base_tables['deleted_conversion_dict']
+
+    for table_name, filename in [('p_group_dict', P_GROUP_FILENAME), ('g_group_dict', G_GROUP_FILENAME)]:
+        group_dict, _ = update_p_group_dict(base_tables[table_name],
+                                            base_paths[filename],
+                                            new_paths[filename],
+                                            base_tables['deleted_conversion_dict'],
+                                            deleted_conversion_dict)
+
+        assert group_dict == new_tables[table_name]
+        assert group_dict != base_tables[table_name]
+
+
+def test_changed_deleted_rows_need_full_build(releases, tmp_path):
+    base_paths, _ = releases
+    base_tables = full_build(base_paths)
+
+    #A row of the earlier release is changed instead of appended to
+    changed_release = dict(BASE_RELEASE, **{DELETED_ALLELES_FILENAME: ['AlleleID,Allele,Description', 'HLA90000,A*01:999,Renamed A*01:02']})
+    changed_paths = write_release(tmp_path / 'changed', changed_release)
+
+    assert update_deleted_conversion_dict(base_tables['deleted_conversion_dict'],
+                                          base_paths[DELETED_ALLELES_FILENAME],
+                                          changed_paths[DELETED_ALLELES_FILENAME]) == (None, 0)
+
+
+def test_add_release_matches_full_build(releases, tmp_path):
+    base_paths, new_paths = releases
+    store = ImgtReleaseStore(str(tmp_path / 'store'))
+
+    for release, release_paths in [('3.0.0', base_paths), ('3.1.0', new_paths)]:
+        manifest = store.add_release(release, release_paths[P_GROUP_FILENAME], release_paths[DELETED_ALLELES_FILENAME], release_paths[G_GROUP_FILENAME])
+
+        assert store.load_tables(release) == full_build(release_paths)
+
+    assert manifest['incremental']
+    assert manifest['base_release'] == '3.0.0'
+    assert store.releases() == ['3.0.0', '3.1.0']
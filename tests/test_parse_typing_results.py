@@ -0,0 +1,175 @@
+import gzip
+import json
+import os
+import sys
+from collections import Counter
+
+import pandas as pd
+
+from hla_typing_benchmark import parse_typing_results, synthetic_cohort
+from hla_typing_benchmark.gold_standard_table import write_gold_standard
+from hla_typing_benchmark.parse_data import configure_nomenclature, get_nomenclature
+from hla_typing_benchmark.parse_typing_results import load_all_results, load_sample_ids, load_typing_results, map_typing_results
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MHC_SEQS_PATH = os.path.join(REPO_DIR, 'reference_data', 'classic.mhc_seqs.tsv')
+
+
+def make_cohort(tmp_path, n_samples=20):
+    #Synthetic cohort, where the first sample of the config is missing from the gold standard
+    cohort_dir = str(tmp_path / 'cohort')
+    cohort = synthetic_cohort.generate_cohort(cohort_dir, n_samples, seed=1, mhc_seqs_path=MHC_SEQS_PATH)
+
+    imgt_dir = os.path.join(cohort_dir, '00_IMGT_reference')
+    configure_nomenclature(deleted_filepath=os.path.join(imgt_dir, 'Deleted_alleles.txt'),
+                           p_group_filepath=os.path.join(imgt_dir, 'hla_nom_p.txt'),
+                           e_group_filepath=MHC_SEQS_PATH,
+                           g_group_filepath=os.path.join(imgt_dir, 'hla_nom_g.txt'))
+
+    missing_subject = cohort.sample_ids[0]
+    gold_standard_df = pd.read_pickle(os.path.join(cohort_dir, 'gold_standard.pkl')).drop(index=missing_subject)
+    gs_path = os.path.join(cohort_dir, 'gold_standard.gs')
+    write_gold_standard(gold_standard_df, gs_path, nomenclature=get_nomenclature())
+
+    return cohort_dir, gs_path, missing_subject
+
+
+def test_details_skip_config_samples_missing_from_gold_standard(tmp_path):
+    cohort_dir, gs_path, missing_subject = make_cohort(tmp_path)
+    details_path = str(tmp_path / 'details.jsonl.gz')
+
+    all_results = []
+
+    for cache_dir in [None, str(tmp_path / 'cache')]:
+        results = load_all_results(gs_data=gs_path,
+                                   kourami_path=os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['Kourami']),
+                                   resolutions=['two_field'],
+                                   config=os.path.join(cohort_dir, 'config.yaml'),
+                                   cache_dir=cache_dir,
+                                   details_path=details_path)
+        all_results.append(results)
+
+        with gzip.open(details_path, 'rt') as infile:
+            subjects = {json.loads(line)['subject'] for line in infile}
+
+        assert missing_subject not in subjects
+        assert len(subjects) == 19
+
+    #The calls of the missing sample don't count towards the call rate
+    assert all_results[0] == all_results[1]
+    assert all(locus_results['call_rate'] <= 100 for locus_results in all_results[0]['2-field']['Kourami'].values())
+
+
+def test_map_skips_samples_missing_from_gold_standard(tmp_path):
+    cohort_dir, gs_path, missing_subject = make_cohort(tmp_path)
+    kourami_path = os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['Kourami'])
+
+    #A shard with only the missing sample gives empty partial results
+    partial = map_typing_results(gs_data=gs_path,
+                                 kourami_path=kourami_path,
+                                 resolutions=['two_field'],
+                                 sample_ids=[missing_subject],
+                                 details_path=str(tmp_path / 'missing.details.jsonl.gz'))
+
+    assert partial['subjects'] == {'Kourami': []}
+
+    sample_ids = load_sample_ids(os.path.join(cohort_dir, 'config.yaml'))
+    partial = map_typing_results(gs_data=gs_path,
+                                 kourami_path=kourami_path,
+                                 resolutions=['two_field'],
+                                 sample_ids=sample_ids[:5],
+                                 details_path=str(tmp_path / 'shard.details.jsonl.gz'))
+
+    assert partial['subjects'] == {'Kourami': sample_ids[1:5]}
+
+
+def test_evaluation_cache_converts_again_with_new_nomenclature(tmp_path):
+    cohort_dir, gs_path, missing_subject = make_cohort(tmp_path)
+    kourami_path = os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS['Kourami'])
+    imgt_dir = os.path.join(cohort_dir, '00_IMGT_reference')
+    deleted_filepath = os.path.join(imgt_dir, 'Deleted_alleles.txt')
+    cache_dir = str(tmp_path / 'cache')
+
+    with open(deleted_filepath, 'r') as infile:
+        deleted_alleles = infile.read()
+
+    def kourami_results(renamed_allele, new_name, cache_dir):
+        with open(deleted_filepath, 'w') as outfile:
+            outfile.write(deleted_alleles + f'HLA99999,{renamed_allele},Renamed {new_name}\n')
+
+        configure_nomenclature(deleted_filepath=deleted_filepath,
+                               p_group_filepath=os.path.join(imgt_dir, 'hla_nom_p.txt'),
+                               e_group_filepath=MHC_SEQS_PATH,
+                               g_group_filepath=os.path.join(imgt_dir, 'hla_nom_g.txt'))
+
+        return load_all_results(gs_data=gs_path,
+                                kourami_path=kourami_path,
+                                resolutions=['two_field'],
+                                config=os.path.join(cohort_dir, 'config.yaml'),
+                                cache_dir=cache_dir)
+
+    #A wrong call and a reference allele of the same sample, which wasn't called
+    gold_standard_df = pd.read_pickle(os.path.join(cohort_dir, 'gold_standard.pkl')).drop(index=missing_subject)
+    gold_standard_alleles = {allele for row in gold_standard_df.itertuples(index=False) for haplotypes in row for candidates in haplotypes for allele in candidates}
+    typing_results_dict = load_typing_results(kourami_path=kourami_path, sample_ids=list(gold_standard_df.index))
+
+    renames = [(allele, reference_allele)
+               for subject, subject_results in typing_results_dict['Kourami'].items() for locus, predictions in subject_results.items()
+               for candidates in predictions for allele in candidates[:1] if allele is not None and allele not in gold_standard_alleles
+               for haplotype in gold_standard_df.loc[subject, locus] for reference_allele in haplotype
+               if reference_allele not in [candidates[0] for candidates in predictions if candidates]]
+    renamed_allele, reference_allele = renames[0]
+
+    #The new release renames the allele differently, so the predictions converted with the earlier release are out of date
+    cached_results = kourami_results(renamed_allele, renamed_allele.split(':')[0] + ':9999', cache_dir)
+    results = kourami_results(renamed_allele, reference_allele, cache_dir)
+
+    assert results == kourami_results(renamed_allele, reference_allele, None)
+    assert results != cached_results
+
+
+def read_details(details_path):
+    with gzip.open(details_path, 'rt') as infile:
+        return sorted(infile, key=lambda line: json.dumps(json.loads(line), sort_keys=True))
+
+
+def test_map_reduce_matches_full_run(tmp_path, monkeypatch):
+    cohort_dir, gs_path, _ = make_cohort(tmp_path)
+    imgt_dir = os.path.join(cohort_dir, '00_IMGT_reference')
+    sample_ids = load_sample_ids(os.path.join(cohort_dir, 'config.yaml'))
+    tool_options = {'--kourami': 'Kourami', '--hla-la': 'HLA-LA', '--optitype': 'Optitype', '--hisat-genotype': 'Hisatgenotype'}
+
+    def run(*arguments):
+        monkeypatch.setattr(sys, 'argv', ['parse_typing_results',
+                                          '--gs-data', gs_path,
+                                          '--config', os.path.join(cohort_dir, 'config.yaml'),
+                                          '--deleted-alleles', os.path.join(imgt_dir, 'Deleted_alleles.txt'),
+                                          '--p-group', os.path.join(imgt_dir, 'hla_nom_p.txt'),
+                                          '--g-group', os.path.join(imgt_dir, 'hla_nom_g.txt'),
+                                          '--pseudosequences', MHC_SEQS_PATH,
+                                          '--nomenclature-cache', str(tmp_path / 'nomenclature_cache')] + list(arguments))
+        parse_typing_results.main()
+
+    tool_arguments = [argument for option, tool in tool_options.items() for argument in [option, os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS[tool])]]
+    run('--mode', 'full', *tool_arguments, '--output', str(tmp_path / 'full' / 'typing_results.json'), '--details', str(tmp_path / 'full' / 'details.jsonl.gz'))
+
+    #One map job per tool and batch of samples, as in the Snakefile
+    batches = [sample_ids[:len(sample_ids) // 2], sample_ids[len(sample_ids) // 2:]]
+    partials_dir = tmp_path / 'partials'
+
+    for option, tool in tool_options.items():
+        for batch, batch_sample_ids in enumerate(batches):
+            run('--mode', 'map',
+                '--samples', *batch_sample_ids,
+                option, os.path.join(cohort_dir, synthetic_cohort.TOOL_FOLDERS[tool]),
+                '--output', str(partials_dir / tool / f'batch_{batch}.partial.json'),
+                '--details', str(partials_dir / tool / f'batch_{batch}.details.jsonl.gz'))
+
+    run('--mode', 'reduce', '--partials', str(partials_dir), '--output', str(tmp_path / 'reduce' / 'typing_results.json'), '--details', str(tmp_path / 'reduce' / 'details.jsonl.gz'))
+
+    with open(tmp_path / 'full' / 'typing_results.json') as full_file, open(tmp_path / 'reduce' / 'typing_results.json') as reduce_file:
+        assert reduce_file.read() == full_file.read()
+
+    full_details = read_details(tmp_path / 'full' / 'details.jsonl.gz')
+    assert len(full_details) > 0
+    assert read_details(tmp_path / 'reduce' / 'details.jsonl.gz') == full_details